@@ -0,0 +1,7 @@
+import sys
+import bkup
+from . import bench
+
+# python3 -m benchmarks [options] (in src dir)
+bkup.log_init()
+bench.main(["benchmarks"] + sys.argv[1:])
@@ -0,0 +1,309 @@
+import logging
+import argparse
+import dataclasses
+import datetime
+import json
+import os
+import pathlib
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import typing
+from commands import codec
+from . import tree
+
+try:
+    import resource
+except ImportError:
+    # Windows: no CPU time of children
+    resource = None
+
+log: logging.Logger = logging.getLogger(__name__)
+
+# Benchmark of subcommands on synthetic trees (see tree.py)
+# Each case runs "bkup.py --metrics FILE SUBCMD ..." in a fresh work dir,
+# REPEAT times, and records the median wall time, the CPU time of the
+# process tree and the counters of the metrics record.
+# Dimensions: tree x command x codec (archive, verify, restore) x jobs.
+# Cloud commands run against local stand-ins: an rclone "local" remote,
+# and rsync to a local dir for upload.
+# Results (JSON) are compared with a baseline, and cases slower than the
+# threshold are reported as regressions (exit code 1).
+
+RESULT_VERSION = 1
+BKUP = pathlib.Path(__file__).resolve().parents[1] / "bkup.py"
+# rclone remote of a local dir (rclone config by environment variables)
+REMOTE = "bench"
+# archive files for clean / cloudclean
+CLEAN_FILES = 1000
+CLEAN_KEEP = 10
+
+COMMANDS = ["archive", "verify", "restore", "snapshot", "sync", "clean", "upload", "cloud", "cloudclean"]
+# commands run for each codec (the others use the first codec)
+CODEC_COMMANDS = ["archive", "verify", "restore"]
+# required programs (other than codecs)
+REQUIRES = {
+    "sync": ["rsync"],
+    "upload": ["rsync"],
+    "cloud": ["rclone"],
+    "cloudclean": ["rclone"],
+}
+
+
+@dataclasses.dataclass
+class Measure:
+    wall: float
+    # CPU time of bkup.py and its children (None on Windows)
+    cpu: float | None
+    # metrics record of the subcommand
+    record: dict
+
+
+class Bench:
+    def __init__(self, work: pathlib.Path, repeat: int):
+        self.work = work
+        self.repeat = repeat
+        self.env = dict(
+            os.environ,
+            # hash cache, catalog
+            XDG_CACHE_HOME=str(work / "cache"),
+            RCLONE_CONFIG_BENCH_TYPE="local",
+        )
+        # archive dirs by (tree, codec) for verify, restore, upload and cloud
+        self.archives: dict[tuple[str, str], pathlib.Path] = {}
+        self.results: dict[str, dict] = {}
+
+    def run_bkup(self, argv: list[str]) -> Measure:
+        metrics_path = self.work / "metrics.jsonl"
+        metrics_path.unlink(missing_ok=True)
+        cmd = [sys.executable, str(BKUP), "--metrics", str(metrics_path)] + argv
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN) if resource else None
+        start = time.perf_counter()
+        proc = subprocess.run(cmd, env=self.env, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        wall = time.perf_counter() - start
+        cpu = None
+        if usage is not None:
+            after = resource.getrusage(resource.RUSAGE_CHILDREN)
+            cpu = after.ru_utime - usage.ru_utime + after.ru_stime - usage.ru_stime
+        if proc.returncode != 0:
+            log.error(proc.stdout.decode(errors="replace"))
+            raise RuntimeError(f"bkup.py failed (exit code {proc.returncode}): {' '.join(argv)}")
+        lines = metrics_path.read_text().splitlines() if metrics_path.exists() else []
+        return Measure(wall, cpu, json.loads(lines[-1]) if lines else {})
+
+    # Run prepare(run_dir) => argv, then bkup.py argv, REPEAT times
+    def measure(self, case_id: str, info: dict, prepare: typing.Callable[[pathlib.Path], list[str]]) -> dict:
+        measures = []
+        for _i in range(self.repeat):
+            run_dir = self.work / "run"
+            if run_dir.exists():
+                shutil.rmtree(run_dir)
+            run_dir.mkdir()
+            measures.append(self.run_bkup(prepare(run_dir)))
+        walls = [m.wall for m in measures]
+        cpus = [m.cpu for m in measures if m.cpu is not None]
+        record = measures[-1].record
+        result = {
+            **info,
+            "wall": round(statistics.median(walls), 4),
+            "walls": [round(w, 4) for w in walls],
+            "cpu": round(statistics.median(cpus), 4) if cpus else None,
+            "maxrss_kb": max((p["maxrss_kb"] for p in record.get("processes", [])), default=None),
+            "counters": record.get("counters", {}),
+        }
+        for name in ("input_mb_per_sec", "output_mb_per_sec", "transferred_mb_per_sec", "ratio"):
+            if name in record:
+                result[name] = record[name]
+        self.results[case_id] = result
+        log.info(f"{case_id}: {result['wall']:.3f} sec (cpu {result['cpu']} sec)")
+        return result
+
+    # Archive dir of the tree (made once, not measured)
+    def archive_dir(self, tree_name: str, src: pathlib.Path, codec_name: str) -> pathlib.Path:
+        key = (tree_name, codec_name)
+        if key not in self.archives:
+            dst = self.work / "archives" / tree_name / codec_name
+            if dst.exists():
+                shutil.rmtree(dst)
+            dst.mkdir(parents=True)
+            self.run_bkup(["archive", "--src", str(src), "--dst", str(dst), "--codec", codec_name, "--tag", "bench"])
+            self.archives[key] = dst
+        return self.archives[key]
+
+    # prepare(run_dir) => bkup.py argv of the case
+    def case(self, tree_name: str, src: pathlib.Path, command: str, codec_name: str, jobs: int) -> typing.Callable[[pathlib.Path], list[str]]:
+        if command == "archive":
+            return lambda run_dir: [
+                "archive", "--src", str(src), "--dst", str(run_dir), "--codec", codec_name, "--threads", str(jobs), "--tag", "bench"]
+        if command == "snapshot":
+            return lambda run_dir: [
+                "snapshot", "--src", str(src), "--dst", str(run_dir), "--jobs", str(jobs), "--tag", "bench",
+                "--hash-cache", str(run_dir / "hashcache.sqlite3")]
+        if command == "sync":
+            # top level dirs as sources (--jobs: one rsync per source)
+            src_list = sorted(str(p) for p in src.iterdir() if p.is_dir()) or [str(src)]
+            return lambda run_dir: ["sync", "--src"] + src_list + ["--dst", str(run_dir / "out"), "--jobs", str(jobs), "--force"]
+        if command == "clean":
+            def prepare(run_dir: pathlib.Path) -> list[str]:
+                fill_archives(run_dir)
+                return ["clean", "--dst", str(run_dir), "--keep-count", str(CLEAN_KEEP), "--jobs", str(jobs)]
+            return prepare
+        if command == "cloudclean":
+            def prepare(run_dir: pathlib.Path) -> list[str]:
+                fill_archives(run_dir)
+                return ["cloudclean", "--remote", REMOTE, "--dst", str(run_dir), "--keep-count", str(CLEAN_KEEP), "--jobs", str(jobs)]
+            return prepare
+
+        archives = self.archive_dir(tree_name, src, codec_name)
+        if command == "verify":
+            return lambda run_dir: [
+                "verify", "--dst", str(archives), "--jobs", str(jobs), "--force", "--hash-cache", str(run_dir / "hashcache.sqlite3")]
+        if command == "restore":
+            return lambda run_dir: ["restore", "--src", str(archives), "--dst", str(run_dir / "out"), "--jobs", str(jobs)]
+        if command == "upload":
+            return lambda run_dir: ["upload", "--src", str(archives), "--dst", str(run_dir), "--all-missing", "--transfers", str(jobs)]
+        if command == "cloud":
+            return lambda run_dir: [
+                "cloud", "--src", str(archives), "--remote", REMOTE, "--dst", str(run_dir), "--all-missing", "--transfers", str(jobs)]
+        raise RuntimeError(f"Unknown command: {command}")
+
+    def run_tree(self, tree_name: str, src: pathlib.Path, commands: list[str], codecs: list[str], jobs_list: list[int]):
+        for command in commands:
+            for jobs in jobs_list:
+                for codec_name in codecs if command in CODEC_COMMANDS else codecs[:1]:
+                    if command in CODEC_COMMANDS:
+                        case_id = f"{tree_name}/{command}/{codec_name}/j{jobs}"
+                    else:
+                        case_id = f"{tree_name}/{command}/j{jobs}"
+                    info = {"tree": tree_name, "command": command, "codec": codec_name, "jobs": jobs}
+                    self.measure(case_id, info, self.case(tree_name, src, command, codec_name, jobs))
+
+
+# Dummy archive files for clean / cloudclean (one per hour)
+def fill_archives(dir: pathlib.Path):
+    dt = datetime.datetime(2024, 1, 1)
+    for i in range(CLEAN_FILES):
+        (dir / f"bench_{(dt + datetime.timedelta(hours=i)).strftime('%Y%m%d%H%M')}.tar.zst").touch()
+
+
+# Commands and codecs which can run here
+def available(commands: list[str], codecs: list[str]) -> tuple[list[str], list[str]]:
+    codecs_ok = []
+    for name in codecs:
+        if shutil.which(codec.get(name).prog) is None:
+            log.warning(f"Skip codec {name}: {codec.get(name).prog} is not installed")
+        else:
+            codecs_ok.append(name)
+    commands_ok = []
+    for command in commands:
+        missing = [prog for prog in REQUIRES.get(command, []) if shutil.which(prog) is None]
+        if missing:
+            log.warning(f"Skip {command}: {', '.join(missing)} is not installed")
+        else:
+            commands_ok.append(command)
+    return commands_ok, codecs_ok
+
+
+# Compare results with baseline
+# Return case ids slower than baseline by more than threshold (ratio) and min_delta (sec)
+def compare(results: dict, baseline: dict, threshold: float, min_delta: float) -> list[str]:
+    if baseline.get("version") != RESULT_VERSION:
+        raise RuntimeError("Unsupported baseline version")
+    for key in ("host", "cpus"):
+        if baseline.get(key) != results.get(key):
+            log.warning(f"Baseline {key} differs: {baseline.get(key)} (now {results.get(key)})")
+    regressions = []
+    for case_id, cur in results["results"].items():
+        base = baseline["results"].get(case_id)
+        if base is None:
+            log.info(f"{case_id}: {cur['wall']:.3f} sec (new)")
+            continue
+        change = cur["wall"] / base["wall"] - 1 if base["wall"] > 0 else 0.0
+        if change > threshold and cur["wall"] - base["wall"] > min_delta:
+            status = "REGRESSION"
+            regressions.append(case_id)
+        elif change < -threshold and base["wall"] - cur["wall"] > min_delta:
+            status = "improved"
+        else:
+            status = "ok"
+        log.info(f"{case_id}: {base['wall']:.3f} => {cur['wall']:.3f} sec ({change * 100:+.1f}%) {status}")
+    return regressions
+
+
+def bench(args: argparse.Namespace):
+    if args.repeat < 1:
+        raise RuntimeError("--repeat must be >= 1")
+    if any(j < 1 for j in args.jobs):
+        raise RuntimeError("--jobs must be >= 1")
+    unknown = [c for c in args.command if c not in COMMANDS]
+    if unknown:
+        raise RuntimeError(f"Unknown command: {', '.join(unknown)} (available: {', '.join(COMMANDS)})")
+    for name in args.codec:
+        codec.get(name)
+    trees = [tree.parse_spec(text) for text in args.tree]
+    commands, codecs = available(args.command, args.codec)
+    if not codecs:
+        raise RuntimeError("No codec is installed")
+
+    with tempfile.TemporaryDirectory(prefix="bkup-bench-") as tmpdir:
+        work = pathlib.Path(args.work).expanduser().resolve() if args.work else pathlib.Path(tmpdir)
+        work.mkdir(parents=True, exist_ok=True)
+        b = Bench(work, args.repeat)
+        tree_info = {}
+        for tree_name, spec in trees:
+            src = work / "trees" / tree_name
+            src.parent.mkdir(parents=True, exist_ok=True)
+            stats = tree.generate(src, spec)
+            tree_info[tree_name] = {"spec": dataclasses.asdict(spec), **dataclasses.asdict(stats)}
+            b.run_tree(tree_name, src, commands, codecs, args.jobs)
+            b.archives.clear()
+            shutil.rmtree(work / "archives", ignore_errors=True)
+
+    results = {
+        "version": RESULT_VERSION,
+        "time": datetime.datetime.now().astimezone().isoformat(timespec="seconds"),
+        "host": platform.node(),
+        "cpus": os.cpu_count(),
+        "python": platform.python_version(),
+        "trees": tree_info,
+        "results": b.results,
+    }
+    out = pathlib.Path(args.out or f"bench-{datetime.datetime.now().strftime('%Y%m%d%H%M%S')}.json")
+    out.write_text(json.dumps(results, indent=1))
+    log.info(f"Results: {out}")
+
+    if args.baseline:
+        baseline = json.loads(pathlib.Path(args.baseline).read_text())
+        regressions = compare(results, baseline, args.threshold, args.min_delta)
+        if regressions:
+            raise RuntimeError(f"{len(regressions)} regression(s) beyond {args.threshold * 100:.0f}%: {', '.join(regressions)}")
+        log.info("No regression")
+
+
+def main(argv: list[str]):
+    parser = argparse.ArgumentParser(
+        prog=argv[0],
+        description="Benchmark bkup subcommands on synthetic trees",
+    )
+    parser.add_argument("--tree", "-t", action="append",
+                        help=f"tree preset[,key=value...] (multiple OK) (presets: {', '.join(tree.PRESETS)}) (default: small)")
+    parser.add_argument("--command", "-c", nargs="+", default=COMMANDS, help=f"commands to run (default: {' '.join(COMMANDS)})")
+    parser.add_argument("--codec", nargs="+", default=[codec.DEFAULT], help=f"codecs of archive, verify and restore (default: {codec.DEFAULT})")
+    parser.add_argument("--jobs", "-j", type=int, nargs="+", default=[1], help="worker counts (threads, jobs, transfers) (default: 1)")
+    parser.add_argument("--repeat", "-r", type=int, default=3, help="runs per case (the median is recorded)")
+    parser.add_argument("--work", help="work dir (generated trees are kept and reused) (default: temporary dir)")
+    parser.add_argument("--out", "-o", help="results file (default: bench-DATETIME.json)")
+    parser.add_argument("--baseline", "-b", help="results file to compare with")
+    parser.add_argument("--threshold", type=float, default=0.2, help="regression threshold of wall time (0.2 = 20%% slower)")
+    parser.add_argument("--min-delta", type=float, default=0.05,
+                        help="ignore differences of wall time smaller than this (sec)")
+
+    args = parser.parse_args(argv[1:])
+    if args.tree is None:
+        args.tree = ["small"]
+
+    bench(args)
@@ -0,0 +1,201 @@
+import logging
+import dataclasses
+import json
+import math
+import pathlib
+import random
+import shutil
+import time
+
+log: logging.Logger = logging.getLogger(__name__)
+
+# Synthetic source trees for benchmarks
+# A tree is described by a preset name and overrides:
+#   "mixed", "many-small,files=1000000", "large,large=4,large_size=1G"
+# Trees are generated deterministically from the seed, and reused if the
+# spec file next to the tree dir (DIR.json) matches (generating millions
+# of files is slow).
+
+WRITE_SIZE = 1024 * 1024
+# vocabulary of compressible (text) content
+TEXT_WORDS = 4096
+
+
+@dataclasses.dataclass
+class TreeSpec:
+    # regular files (small files, excluding large and sparse files)
+    files: int = 1000
+    # directory levels below the top dir, and subdirs per dir
+    # (files are spread over all dirs, e.g. depth=30,fanout=1 for deep nesting)
+    depth: int = 2
+    fanout: int = 4
+    # size distribution of files (bytes):
+    #   fixed:N, uniform:MIN:MAX, lognormal:MEDIAN:SIGMA
+    size: str = "lognormal:4K:2"
+    # content of files: text (compressible), random (incompressible), zero, mixed (text / random)
+    content: str = "mixed"
+    # large incompressible files
+    large: int = 0
+    large_size: str = "256M"
+    # large sparse files (a small header, the rest is a hole)
+    sparse: int = 0
+    sparse_size: str = "1G"
+    seed: int = 0
+
+
+PRESETS: dict[str, TreeSpec] = {
+    # quick run (default)
+    "small": TreeSpec(files=500, depth=2, fanout=3),
+    "mixed": TreeSpec(files=20000, depth=3, fanout=6, large=2, large_size="64M"),
+    "many-small": TreeSpec(files=200000, depth=3, fanout=10, size="uniform:0:2K", content="text"),
+    "large": TreeSpec(files=10, depth=0, large=4, large_size="512M", sparse=2, sparse_size="4G"),
+    "incompressible": TreeSpec(files=2000, depth=2, fanout=4, size="lognormal:256K:1.5", content="random"),
+    "deep": TreeSpec(files=3000, depth=40, fanout=1, size="fixed:1K", content="text"),
+}
+
+
+# "10K", "1.5M", "4G" => bytes (1024 based)
+def parse_bytes(text: str) -> int:
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+    text = text.strip().upper().removesuffix("B")
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+# "preset[,key=value...]" => (name, spec)
+def parse_spec(text: str) -> tuple[str, TreeSpec]:
+    preset, *overrides = text.split(",")
+    if preset not in PRESETS:
+        raise RuntimeError(f"Unknown tree preset: {preset} (available: {', '.join(PRESETS)})")
+    spec = dataclasses.replace(PRESETS[preset])
+    fields = {f.name: f.type for f in dataclasses.fields(TreeSpec)}
+    for item in overrides:
+        key, sep, value = item.partition("=")
+        if not sep or key not in fields:
+            raise RuntimeError(f"Invalid tree option: {item} (available: {', '.join(fields)})")
+        setattr(spec, key, int(value) if fields[key] in (int, "int") else value)
+    spec_sizes(spec)
+    return text.replace(",", "_").replace("=", "-"), spec
+
+
+# Size sampler of spec.size
+def size_sampler(spec_size: str, rng: random.Random):
+    kind, _sep, params = spec_size.partition(":")
+    args = params.split(":") if params else []
+    try:
+        if kind == "fixed" and len(args) == 1:
+            size = parse_bytes(args[0])
+            return lambda: size
+        if kind == "uniform" and len(args) == 2:
+            lo, hi = parse_bytes(args[0]), parse_bytes(args[1])
+            return lambda: rng.randint(lo, hi)
+        if kind == "lognormal" and len(args) == 2:
+            mu, sigma = math.log(max(parse_bytes(args[0]), 1)), float(args[1])
+            return lambda: int(rng.lognormvariate(mu, sigma))
+    except ValueError:
+        pass
+    raise RuntimeError(f"Invalid size distribution: {spec_size} (fixed:N, uniform:MIN:MAX, lognormal:MEDIAN:SIGMA)")
+
+
+def spec_sizes(spec: TreeSpec) -> tuple[int, int]:
+    if spec.content not in ("text", "random", "zero", "mixed"):
+        raise RuntimeError(f"Invalid content: {spec.content} (text, random, zero, mixed)")
+    size_sampler(spec.size, random.Random(0))
+    try:
+        return parse_bytes(spec.large_size), parse_bytes(spec.sparse_size)
+    except ValueError:
+        raise RuntimeError(f"Invalid size: {spec.large_size}, {spec.sparse_size}") from None
+
+
+class Content:
+    def __init__(self, rng: random.Random):
+        self.rng = rng
+        words = ["".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(2, 10))) for _ in range(512)]
+        # 1 MiB text block, files are slices of it at random offsets
+        text = " ".join(rng.choice(words) for _ in range(TEXT_WORDS * 64)).encode()
+        self.text = (text * (WRITE_SIZE // len(text) + 2))[:WRITE_SIZE * 2]
+
+    def data(self, kind: str, size: int) -> bytes:
+        if kind == "mixed":
+            kind = "text" if self.rng.random() < 0.7 else "random"
+        if kind == "random":
+            return self.rng.randbytes(size)
+        if kind == "zero":
+            return bytes(size)
+        off = self.rng.randrange(WRITE_SIZE)
+        return self.text[off:off + size]
+
+    def write(self, path: pathlib.Path, kind: str, size: int):
+        with path.open("wb") as fout:
+            while size > 0:
+                n = min(size, WRITE_SIZE)
+                fout.write(self.data(kind, n))
+                size -= n
+
+
+@dataclasses.dataclass
+class TreeStats:
+    files: int
+    dirs: int
+    bytes: int
+    elapsed: float
+
+
+def tree_dirs(top: pathlib.Path, depth: int, fanout: int) -> list[pathlib.Path]:
+    dirs = [top]
+    level = [top]
+    for d in range(depth):
+        level = [p / f"d{d}_{i}" for p in level for i in range(fanout)]
+        dirs += level
+    return dirs
+
+
+# Generate the tree into dir (reused if it was generated by the same spec)
+def generate(dir: pathlib.Path, spec: TreeSpec) -> TreeStats:
+    spec_path = spec_file(dir)
+    spec_dict = dataclasses.asdict(spec)
+    if spec_path.is_file():
+        saved = json.loads(spec_path.read_text())
+        if saved["spec"] == spec_dict:
+            log.info(f"Reuse tree: {dir}")
+            return TreeStats(**saved["stats"])
+        log.info(f"Spec changed, generate again: {dir}")
+    spec_path.unlink(missing_ok=True)
+    if dir.exists():
+        shutil.rmtree(dir)
+
+    start = time.monotonic()
+    large_size, sparse_size = spec_sizes(spec)
+    rng = random.Random(spec.seed)
+    content = Content(rng)
+    sampler = size_sampler(spec.size, rng)
+    dirs = tree_dirs(dir, spec.depth, spec.fanout)
+    for d in dirs:
+        d.mkdir(parents=True, exist_ok=True)
+    total = 0
+    for i in range(spec.files):
+        size = sampler()
+        content.write(dirs[i % len(dirs)] / f"f{i}.dat", spec.content, size)
+        total += size
+        if (i + 1) % 100000 == 0:
+            log.info(f"{i + 1}/{spec.files} files")
+    for i in range(spec.large):
+        content.write(dir / f"large{i}.bin", "random", large_size)
+        total += large_size
+    for i in range(spec.sparse):
+        with (dir / f"sparse{i}.img").open("wb") as fout:
+            fout.write(content.data("text", 4096))
+            fout.truncate(sparse_size)
+        total += sparse_size
+
+    stats = TreeStats(
+        files=spec.files + spec.large + spec.sparse, dirs=len(dirs), bytes=total,
+        elapsed=round(time.monotonic() - start, 3))
+    spec_path.write_text(json.dumps({"spec": spec_dict, "stats": dataclasses.asdict(stats)}))
+    log.info(f"Tree: {dir}: {stats.files} files, {stats.dirs} dirs, {stats.bytes} bytes ({stats.elapsed:.1f} sec)")
+    return stats
+
+
+def spec_file(dir: pathlib.Path) -> pathlib.Path:
+    return dir.with_name(f"{dir.name}.json")
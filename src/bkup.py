@@ -1,7 +1,9 @@
 #!/usr/bin/env python3
 
 import sys
+import argparse
 import commands
+from commands import util, metrics, trace
 import logging
 
 
@@ -14,8 +16,29 @@ def log_init():
     )
 
 
+def global_parser(argv0: str) -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog=argv0, add_help=False)
+    parser.add_argument("--nice", type=int, help="CPU niceness increment")
+    parser.add_argument("--ionice", help="I/O scheduling class: idle, best-effort[:0-7], realtime[:0-7]")
+    parser.add_argument("--threads", type=int, default=0, help="compressor threads (default: all cores)")
+    parser.add_argument("--bwlimit", help="bandwidth limit of rsync, rclone and streaming (e.g. 10M = 10 MiB/s)")
+    parser.add_argument("--max-load", type=float, help="pause child processes while 1 min load average exceeds this")
+    parser.add_argument("--metrics", metavar="FILE", help="append per-stage metrics to the JSON lines file")
+    parser.add_argument("--metrics-prom", metavar="FILE", help="write per-stage metrics to the Prometheus textfile")
+    parser.add_argument("--trace", metavar="FILE", help="write the timeline of phases and child processes (Chrome trace JSON)")
+    parser.add_argument("--profile", action="store_true", help="profile Python code by cProfile (stats to log, and FILE.prof with --trace)")
+    parser.add_argument("subcmd", nargs="?")
+    parser.add_argument("args", nargs=argparse.REMAINDER)
+    return parser
+
+
 def usage(argv0: str):
-    print(f"{argv0} SUBCMD [args...]")
+    print(f"{argv0} [global options] SUBCMD [args...]")
+    print("Global options (resource governor, metrics, trace)")
+    for action in global_parser(argv0)._actions:
+        if action.option_strings:
+            print(f"* {', '.join(action.option_strings)}")
+            print(f"    {action.help}")
     print("Subcommands")
     for _func, name, desc in commands.command_table:
         print(f"* {name}")
@@ -29,12 +52,32 @@ def main(argv: list[str]):
         usage(argv[0])
         sys.exit(0)
 
-    subcmd = argv[1]
-    args = argv[2:]
+    gargs = global_parser(argv[0]).parse_args(argv[1:])
+    if gargs.subcmd is None:
+        usage(argv[0])
+        sys.exit(1)
+
+    util.governor.nice = gargs.nice
+    util.governor.ionice = gargs.ionice
+    util.governor.threads = gargs.threads
+    util.governor.bwlimit = util.parse_size(gargs.bwlimit) if gargs.bwlimit is not None else None
+    util.governor.max_load = gargs.max_load
+    util.governor.apply()
+    metrics.recorder.configure(gargs.metrics, gargs.metrics_prom)
+    trace.tracer.configure(gargs.trace, gargs.profile)
+
+    subcmd = gargs.subcmd
+    args = gargs.args
     found = False
     for func, name, _desc in commands.command_table:
         if name == subcmd:
-            func([subcmd] + args)
+            trace.tracer.start()
+            try:
+                with metrics.recorder.stage(subcmd, subcmd), trace.span(subcmd, "command", {"argv": " ".join(args)}):
+                    func([subcmd] + args)
+            finally:
+                metrics.recorder.finish()
+                trace.tracer.finish()
             found = True
             break
     if not found:
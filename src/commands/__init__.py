@@ -1,13 +1,19 @@
-from . import sync, clean, archive, dockervol, upload
-from . import cloudsetup, cloudclean, cloud
+from . import sync, clean, archive, snapshot, dockervol, upload
+from . import cloudsetup, cloudclean, cloud, run, verify, restore, find, daemon
 
 command_table = [
     (sync.main, "sync", "Make a backup copy of directory"),
     (clean.main, "clean", "Clean old archive files"),
     (archive.main, "archive", "Compress directory and make an archive file"),
+    (snapshot.main, "snapshot", "Make a deduplicated snapshot of directory"),
     (dockervol.main, "dockervol", "Compress Docker volumes and make an archive file"),
     (upload.main, "upload", "Copy the latest archive file to a remote host by rsync"),
     (cloudsetup.main, "cloudsetup", "Setup rclone tool"),
     (cloudclean.main, "cloudclean", "Clean old archive files on the cloud storage"),
     (cloud.main, "cloud", "Copy the latest archive file to the cloud storage"),
+    (run.main, "run", "Run backup stages of config file in one process"),
+    (verify.main, "verify", "Verify that archive files can be read back"),
+    (restore.main, "restore", "Restore files from an archive file or a snapshot"),
+    (find.main, "find", "Find backed-up files in the archive catalog"),
+    (daemon.main, "daemon", "Run jobs of config file on schedule (resident process)"),
 ]
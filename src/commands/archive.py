@@ -6,40 +6,210 @@ import os
 import platform
 import getpass
 import datetime
-from . import util
+import shutil
+from . import util, codec, cloud, upload, tarengine, catalog, trace
 
 log: logging.Logger = logging.getLogger(__name__)
 
 CMD_UNIX = "tar"
 CMD_WIN_FROM_PROGRAM_FILES = "\\7-Zip\\7z.exe"
-EXT_UNIX = "tar.bz2"
 EXT_WIN = "7z"
-TAR_OPTS = ["--use-compress-prog=pbzip2"]
+# incremental archive kind marker (tag_host_KIND_datetime.ext)
+KIND_FULL = "full"
+KIND_INC = "inc"
+SNAR_EXT = "snar"
 
 
-def archive_unix_bz2(src: pathlib.Path, ar_dst: pathlib.Path, dry_run: bool):
-    # mask all permissions for group and other
-    old_umask = os.umask(0o077)
+# tar command writing the archive to stdout
+# sort: stable member order (readdir order depends on the file system history)
+def tar_cmd(src: pathlib.Path, snar: pathlib.Path | None, sort: bool) -> list[str]:
+    # -C: change to directory DIR
+    # -c: create new.
+    # -f -: write to stdout.
+    cmd = [CMD_UNIX, "-C", str(src), "-cf", "-"]
+    # GNU tar incremental dump (only changed files + deleted file info)
+    if snar is not None:
+        cmd += [f"--listed-incremental={snar}"]
+    if sort:
+        cmd += ["--sort=name"]
+    cmd += ["."]
+    return cmd
+
+
+# tar | compressor > ar_dst (permission 600)
+# listing: file listing made from the tar stream
+# Return sha256 hex digest of ar_dst computed in the stream ("" if dry_run)
+def archive_unix_tar(
+        src: pathlib.Path, ar_dst: pathlib.Path, comp_cmd: list[str], dry_run: bool,
+        snar: pathlib.Path | None = None, sort: bool = False, listing: catalog.Listing | None = None) -> str:
+    cmd = tar_cmd(src, snar, sort)
+    tap = listing.tar_tap if listing is not None else None
     try:
-        # -C: change to directory DIR
-        # -c: create new.
-        # -f: specify file name.
-        cmd = [CMD_UNIX, "-C", str(src), "-cf", str(ar_dst)] + TAR_OPTS + ["."]
-        util.exec(cmd, dry_run=dry_run)
-    except subprocess.CalledProcessError as e:
-        if e.returncode == 1:
+        (tar_rc, comp_rc), sha256 = util.exec_pipe([cmd, comp_cmd], ar_dst, dry_run=dry_run, check=False, tap=tap)
+        if tar_rc == 1:
             # Warning (Non fatal error(s)).
             log.warning("tar exit with warning(s)")
-        else:
-            raise
+        elif tar_rc != 0:
+            raise subprocess.CalledProcessError(tar_rc, cmd)
+        if comp_rc != 0:
+            raise subprocess.CalledProcessError(comp_rc, comp_cmd)
     except BaseException:
-        log.error("Exec tar with pbzip2 error.")
-        log.error("[Hint] Did you install pbzip2 (parallel bzip2)?")
-        log.error("e.g. $ sudo apt install pbzip2")
+        log.error(f"Exec tar with {comp_cmd[0]} error.")
         ar_dst.unlink(missing_ok=True)
         raise
-    finally:
-        os.umask(old_umask)
+    return sha256
+
+
+# Return sha256 hex digest of ar_dst ("" if dry_run)
+def archive_unix_python(
+        src: pathlib.Path, ar_dst: pathlib.Path, comp: codec.Codec, level: int | None, threads: int, dry_run: bool,
+        listing: bool = True) -> str:
+    if dry_run:
+        log.info("dry_run")
+        return ""
+    warnings, sha256 = tarengine.archive(src, ar_dst, comp, level, threads, listing)
+    if warnings:
+        log.warning(f"{warnings} file(s) skipped or changed while reading")
+    return sha256
+
+
+# Select "tar" or "python"
+def select_engine(engine: str, comp: codec.Codec, tar_only: bool, dry_run: bool) -> str:
+    if engine == "auto":
+        if comp.available() or tar_only or not codec.native_available(comp):
+            engine = "tar"
+        else:
+            log.warning(f"{comp.prog} not found, use python engine")
+            engine = "python"
+    if engine == "tar":
+        if not dry_run:
+            codec.check_installed(comp)
+    else:
+        if tar_only:
+            raise RuntimeError("--engine python is unavailable with --incremental, --rsyncable, --to-cloud and --to-ssh")
+        if not codec.native_available(comp):
+            raise RuntimeError(f"--engine python does not support {comp.name} on this Python")
+    log.info(f"Engine: {engine}")
+    return engine
+
+
+# tar | compressor | (tee) => sink process stdin (+ local file)
+# sink_cmd: command which writes stdin to the destination
+# cleanup_cmd: command which deletes the partial destination file on error
+# Return sha256 hex digest of the stream ("" if dry_run)
+def stream_unix_tar(
+        src: pathlib.Path, ar_dst: pathlib.Path, comp_cmd: list[str],
+        sink_cmd: list[str], cleanup_cmd: list[str], keep_local: bool, dry_run: bool,
+        snar: pathlib.Path | None = None, sort: bool = False, listing: catalog.Listing | None = None) -> str:
+    cmd = tar_cmd(src, snar, sort)
+    tap = listing.tar_tap if listing is not None else None
+
+    log.info(f"EXEC: {' '.join(sink_cmd)}")
+    if dry_run:
+        util.exec_tee([cmd, comp_cmd], [], dry_run=dry_run)
+        return ""
+
+    sink = util.popen(sink_cmd, stdin=subprocess.PIPE)
+    local = None
+    try:
+        outs = [sink.stdin]
+        if keep_local:
+            fd = os.open(ar_dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            local = os.fdopen(fd, "wb")
+            outs.append(local)
+        (tar_rc, comp_rc), size, sha256 = util.exec_tee([cmd, comp_cmd], outs, check=False, tap=tap)
+        if tar_rc == 1:
+            # Warning (Non fatal error(s)).
+            log.warning("tar exit with warning(s)")
+        elif tar_rc != 0:
+            raise subprocess.CalledProcessError(tar_rc, cmd)
+        if comp_rc != 0:
+            raise subprocess.CalledProcessError(comp_rc, comp_cmd)
+        sink.stdin.close()
+        if sink.wait() != 0:
+            raise subprocess.CalledProcessError(sink.returncode, sink_cmd)
+        if local is not None:
+            local.close()
+    except BaseException:
+        log.error("Streaming archive error.")
+        sink.kill()
+        sink.wait()
+        util.exec(cleanup_cmd, check=False)
+        if local is not None:
+            local.close()
+            ar_dst.unlink(missing_ok=True)
+        raise
+
+    log.info(f"Streamed {size} bytes (sha256: {sha256})")
+    return sha256
+
+
+# Count incremental archives made after the last full archive.
+# Return None if there is no full archive of prefix (tag_host) in dst.
+def count_inc_since_full(dst: pathlib.Path, prefix: str) -> int | None:
+    history: list[tuple[str, str]] = []
+    for p in filter(util.name_filter, dst.iterdir()):
+        body, dt = util.name_parse(p)
+        if not body.startswith(f"{prefix}_"):
+            continue
+        kind = body[len(prefix) + 1:]
+        if kind in (KIND_FULL, KIND_INC):
+            history.append((dt, kind))
+    # sort by datetime (full first if the same datetime)
+    history.sort(key=lambda e: (e[0], e[1] != KIND_FULL))
+
+    count = None
+    for _dt, kind in history:
+        if kind == KIND_FULL:
+            count = 0
+        elif count is not None:
+            count += 1
+
+    return count
+
+
+# Decide full or incremental and prepare the snapshot state file.
+# Return (kind, snar_to_use).
+# tar updates the snapshot file in place, so work on a copy and
+# replace the state file only if tar succeeds.
+def prepare_incremental(dst: pathlib.Path, prefix: str, full_every: int | None, dry_run: bool) -> tuple[str, pathlib.Path]:
+    snar = dst / f"{prefix}.{SNAR_EXT}"
+    snar_tmp = dst / f"{prefix}.{SNAR_EXT}.tmp"
+
+    count = count_inc_since_full(dst, prefix)
+    if not snar.is_file():
+        log.info(f"Snapshot state not found: {snar}")
+        kind = KIND_FULL
+    elif count is None:
+        log.info("Full archive not found")
+        kind = KIND_FULL
+    elif full_every is not None and count + 1 >= full_every:
+        log.info(f"{count} incremental archive(s) since the last full archive (--full-every {full_every})")
+        kind = KIND_FULL
+    else:
+        log.info(f"{count} incremental archive(s) since the last full archive")
+        kind = KIND_INC
+    log.info(f"Archive kind: {kind}")
+
+    if not dry_run:
+        snar_tmp.unlink(missing_ok=True)
+        # the state file lists every path of SRC: owner only like the archive
+        # (tar keeps the mode of an existing file, an empty one means a full archive)
+        fd = os.open(snar_tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wb") as fout:
+            if kind == KIND_INC:
+                with snar.open("rb") as fin:
+                    shutil.copyfileobj(fin, fout)
+
+    return kind, snar_tmp
+
+
+def commit_incremental(dst: pathlib.Path, prefix: str, dry_run: bool):
+    snar = dst / f"{prefix}.{SNAR_EXT}"
+    snar_tmp = dst / f"{prefix}.{SNAR_EXT}.tmp"
+    log.info(f"Update snapshot state: {snar}")
+    if not dry_run:
+        os.replace(snar_tmp, snar)
 
 
 def archive_win_7z(src: pathlib.PureWindowsPath, ar_dst: pathlib.PureWindowsPath, dry_run: bool):
@@ -83,8 +253,7 @@ def archive(args: argparse.Namespace):
     winsrc = pathlib.PureWindowsPath()
     windst = pathlib.PureWindowsPath()
     if util.is_wsl():
-        winsrc = util.to_winpath(src)
-        windst = util.to_winpath(dst)
+        winsrc, windst = util.to_winpaths([src, dst])
         if winsrc is not None:
             log.info("Windows SRC detected")
             log.info("Windows binary mode")
@@ -92,7 +261,8 @@ def archive(args: argparse.Namespace):
 
     # get user@host and datetime for archive file name
     if exe_from_wsl:
-        user = util.get_winuser()
+        # fetch at once (a powershell.exe call costs about a second)
+        user = util.get_winenvs(["UserName", "ProgramFiles"])["UserName"]
     else:
         user = getpass.getuser()
     host = platform.node()
@@ -101,19 +271,103 @@ def archive(args: argparse.Namespace):
     # tag default = user
     tag = args.tag if args.tag is not None else user
 
+    if args.full_every is not None and not args.incremental:
+        raise RuntimeError("--full-every is available only with --incremental")
+    if args.full_every is not None and args.full_every < 1:
+        raise RuntimeError("--full-every must be >= 1")
+    if args.incremental and (iswin or exe_from_wsl):
+        raise RuntimeError("--incremental is unavailable for 7z")
+    stream = args.to_cloud is not None or args.to_ssh is not None
+    if args.to_cloud is not None and args.to_ssh is not None:
+        raise RuntimeError("--to-cloud and --to-ssh are exclusive")
+    if args.keep_local and not stream:
+        raise RuntimeError("--keep-local is available only with --to-cloud or --to-ssh")
+    if stream and args.incremental and not args.keep_local:
+        raise RuntimeError("--incremental with streaming requires --keep-local")
+    if iswin or exe_from_wsl:
+        if args.codec is not None or args.level is not None or args.engine != "auto" or args.rsyncable:
+            raise RuntimeError("--codec, --level, --engine and --rsyncable are unavailable for 7z")
+        if stream:
+            raise RuntimeError("--to-cloud and --to-ssh are unavailable for 7z")
+    else:
+        comp = codec.get(args.codec if args.codec is not None else codec.DEFAULT)
+        comp_cmd = comp.compress_cmd(args.level, args.threads, args.rsyncable)
+        engine = select_engine(args.engine, comp, args.incremental or stream or args.rsyncable, args.dry_run)
+        if engine == "tar":
+            log.info(f"Compressor: {' '.join(comp_cmd)}")
+
     if iswin:
         ar_dst = dst / f"{tag}_{host}_{dt_str}.{EXT_WIN}"
         log.info(f"DST: {ar_dst}")
         archive_win_7z(pathlib.PureWindowsPath(src), pathlib.PureWindowsPath(ar_dst), args.dry_run)
+        # 7z writes the file by itself: one more read to get the checksum
+        sha256 = "" if args.dry_run else util.hash_file(ar_dst)
     elif exe_from_wsl:
         ar_dst = dst / f"{tag}_{host}_{dt_str}.{EXT_WIN}"
         win_ar_dst = windst / ar_dst.name
         log.info(f"DST: {win_ar_dst}")
         archive_win_7z(winsrc, win_ar_dst, args.dry_run)
+        sha256 = "" if args.dry_run else util.hash_file(ar_dst)
     else:
-        ar_dst = dst / f"{tag}_{host}_{dt_str}.{EXT_UNIX}"
-        log.info(f"DST: {ar_dst}")
-        archive_unix_bz2(src, ar_dst, args.dry_run)
+        prefix = f"{tag}_{host}"
+        snar = None
+        if args.incremental:
+            with trace.span("incremental"):
+                kind, snar = prepare_incremental(dst, prefix, args.full_every, args.dry_run)
+            # with seconds: a second run in the same minute must not overwrite the previous one
+            ar_dst = dst / f"{prefix}_{kind}_{dt_now.strftime('%Y%m%d%H%M%S')}.{comp.ext}"
+            # the snapshot state already covers the existing archive
+            if ar_dst.exists():
+                raise RuntimeError(f"{ar_dst} already exists: retry later")
+        else:
+            ar_dst = dst / f"{prefix}_{dt_str}.{comp.ext}"
+        # file listing for the catalog (the python engine writes it by itself)
+        listing = catalog.Listing() if not args.no_listing else None
+        try:
+            if stream:
+                side_name = util.sidecar_path(ar_dst).name
+                if args.to_cloud is not None:
+                    remote, _, remote_dir = args.to_cloud.partition(":")
+                    sink_cmd = cloud.rcat_cmd(remote, remote_dir, ar_dst.name)
+                    cleanup_cmd = cloud.delete_cmd(remote, remote_dir, ar_dst.name)
+                    side_sink_cmd = cloud.rcat_cmd(remote, remote_dir, side_name)
+                else:
+                    sink_cmd = upload.ssh_sink_cmd(args.to_ssh, args.ssh, ar_dst.name)
+                    cleanup_cmd = upload.ssh_delete_cmd(args.to_ssh, args.ssh, ar_dst.name)
+                    side_sink_cmd = upload.ssh_sink_cmd(args.to_ssh, args.ssh, side_name)
+                log.info(f"DST: {' '.join(sink_cmd)}")
+                if args.keep_local:
+                    log.info(f"DST (local copy): {ar_dst}")
+                with trace.span("stream", args={"dst": ar_dst.name}):
+                    sha256 = stream_unix_tar(
+                        src, ar_dst, comp_cmd, sink_cmd, cleanup_cmd, args.keep_local, args.dry_run, snar, args.rsyncable,
+                        listing if args.keep_local else None)
+                # checksum sidecar next to the remote archive
+                util.exec_input(side_sink_cmd, util.sidecar_text(ar_dst.name, sha256).encode(), dry_run=args.dry_run)
+            elif engine == "python":
+                log.info(f"DST: {ar_dst}")
+                with trace.span("python engine", args={"dst": ar_dst.name}):
+                    sha256 = archive_unix_python(src, ar_dst, comp, args.level, args.threads, args.dry_run, listing is not None)
+            else:
+                log.info(f"DST: {ar_dst}")
+                with trace.span("tar pipeline", args={"dst": ar_dst.name}):
+                    sha256 = archive_unix_tar(src, ar_dst, comp_cmd, args.dry_run, snar, args.rsyncable, listing)
+        except BaseException:
+            if snar is not None:
+                snar.unlink(missing_ok=True)
+            raise
+        if args.incremental:
+            commit_incremental(dst, prefix, args.dry_run)
+        if listing is not None and engine == "tar" and (not stream or args.keep_local):
+            listing.write(ar_dst, args.dry_run)
+
+    if stream and not args.keep_local:
+        log.info("No local copy: latest.txt is not updated")
+        log.info(f"OK: {ar_dst.name}")
+        return
+
+    # NAME.sha256 (sha256sum format) for upload/cloud to compare without reading the archive
+    util.write_sidecar(ar_dst, sha256, args.dry_run)
 
     # write ar_dst (not win_ar_dst) to latest.txt
     latest = dst / "latest.txt"
@@ -126,11 +380,32 @@ def archive(args: argparse.Namespace):
 def main(argv: list[str]):
     parser = argparse.ArgumentParser(
         prog=argv[0],
-        description="Archive and compress a directory (Linux: tar.bz2, Windows: 7z)",
+        description=f"Archive and compress a directory (Linux: tar + {', '.join(codec.CODECS)}, Windows: 7z)",
     )
     parser.add_argument("--src", "-s", required=True, help="backup source dir")
     parser.add_argument("--dst", "-d", required=True, help="backup destination dir")
     parser.add_argument("--tag", "-t", help="tag string for archive file name (default: user_name)")
+    parser.add_argument("--codec", "-c", choices=codec.CODECS.keys(), help=f"compressor (tar) (default: {codec.DEFAULT})")
+    parser.add_argument("--level", "-l", type=int, help="compression level (tar) (default: codec default)")
+    parser.add_argument("--threads", type=int, default=0, help="compressor threads (tar) (default: 0 = all cores)")
+    parser.add_argument("--rsyncable", action="store_true",
+                        help="sort files by name and make compressed output which rsync can transfer by delta "
+                        "(tar only, zstd and gzip)")
+    parser.add_argument("--engine", choices=["auto", "tar", "python"], default="auto",
+                        help="tar: tar + external compressor, python: tarfile + process pool (no external tools), "
+                        "auto: tar if the compressor is installed (default: auto)")
+    parser.add_argument("--incremental", "-i", action="store_true",
+                        help="archive only files changed since the last archive (tar only)")
+    parser.add_argument("--full-every", type=int,
+                        help="with --incremental, make a full archive every N archives (default: only the first one)")
+    parser.add_argument("--to-cloud", metavar="REMOTE:DIR",
+                        help="stream the archive to the cloud storage by rclone rcat without writing a local file (tar only)")
+    parser.add_argument("--to-ssh", metavar="USER@HOST:DIR",
+                        help="stream the archive to a remote host by ssh without writing a local file (tar only)")
+    parser.add_argument("--ssh", help='ssh command line for --to-ssh (e.g. --ssh "ssh -p 12345")')
+    parser.add_argument("--keep-local", action="store_true", help="with --to-cloud/--to-ssh, also write the archive to DST")
+    parser.add_argument("--no-listing", action="store_true",
+                        help="do not write the file listing for find (NAME.files.json.gz, hashing all files)")
     parser.add_argument("--dry-run", "-n", action="store_true", help="dry run")
 
     args = parser.parse_args(argv[1:])
@@ -0,0 +1,210 @@
+import logging
+import os
+import pathlib
+import posixpath
+import gzip
+import json
+import hashlib
+import sqlite3
+import tarfile
+import typing
+from . import util, snapshot, metrics, trace
+
+log: logging.Logger = logging.getLogger(__name__)
+
+# File listings and the catalog of backed-up files
+# archive / dockervol write NAME.files.json.gz next to the archive while
+# writing it (from the tar stream, no extra read of the source files):
+#   {"version": 1}
+#   [path, size, mtime, sha256]   (one line per regular file)
+# The catalog (~/.cache/bkup/catalog.sqlite3) loads the listings and the
+# snapshot manifests of archive dirs, indexed by path, file name and hash,
+# so that find can search the whole history without reading archives.
+# Only new or changed listings are loaded again.
+
+LISTING_VERSION = 1
+READ_SIZE = 1024 * 1024
+
+
+class HashReader:
+    # file-like object (read only) hashing bytes as they are read
+    def __init__(self, fin: typing.BinaryIO):
+        self.fin = fin
+        self.sha256 = hashlib.sha256()
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.fin.read(size)
+        self.sha256.update(data)
+        return data
+
+
+# "./dir/file" => "dir/file" ("" for the top dir)
+def normalize(name: str) -> str:
+    p = posixpath.normpath(name).lstrip("/")
+    return "" if p == "." else p
+
+
+class Listing:
+    def __init__(self):
+        # [path, size, mtime, sha256]
+        self.entries: list[list] = []
+        # False if the tar stream was not read to the end
+        self.complete = False
+
+    def add(self, name: str, size: int, mtime: float, digest: str | None):
+        self.entries.append([normalize(name), size, int(mtime), digest])
+
+    # Tap of util.exec_pipe: read the tar stream between tar and the compressor
+    def tar_tap(self, fin: typing.BinaryIO):
+        with tarfile.open(fileobj=fin, mode="r|") as tf:
+            for member in tf:
+                if not member.isreg():
+                    continue
+                reader = HashReader(tf.extractfile(member))
+                while reader.read(READ_SIZE):
+                    pass
+                self.add(member.name, member.size, member.mtime, reader.sha256.hexdigest())
+        self.complete = True
+
+    def write(self, ar_dst: pathlib.Path, dry_run: bool = False):
+        path = listing_path(ar_dst)
+        if dry_run:
+            return
+        if not self.complete:
+            log.warning(f"File listing is not written (incomplete): {path}")
+            return
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o600)
+        with (trace.span("listing", args={"files": len(self.entries)}),
+                os.fdopen(fd, "wb") as raw, gzip.open(raw, "wt", encoding="utf-8") as fout):
+            print(json.dumps({"version": LISTING_VERSION}), file=fout)
+            for entry in self.entries:
+                print(json.dumps(entry, ensure_ascii=False, separators=(",", ":")), file=fout)
+        log.info(f"File listing: {path} ({len(self.entries)} files)")
+        metrics.recorder.add(metrics.FILES, len(self.entries))
+
+
+def listing_path(ar_dst: pathlib.Path) -> pathlib.Path:
+    return ar_dst.with_name(f"{ar_dst.name}.{util.LISTING_EXT}")
+
+
+# Yield [path, size, mtime, sha256]
+def read_listing(path: pathlib.Path) -> typing.Iterator[list]:
+    with gzip.open(path, "rt", encoding="utf-8") as fin:
+        header = json.loads(fin.readline() or "{}")
+        if header.get("version") != LISTING_VERSION:
+            raise RuntimeError(f"Unsupported file listing version: {path}")
+        for line in fin:
+            yield json.loads(line)
+
+
+# Yield [path, size, mtime, sha256] of the files of a snapshot manifest
+def read_manifest(path: pathlib.Path) -> typing.Iterator[list]:
+    for entry in snapshot.load_manifest(path)["entries"]:
+        if entry["type"] == "file":
+            yield [entry["path"], entry["size"], entry["mtime_ns"] // 1_000_000_000, entry.get("sha256")]
+
+
+# Archive name => (listing or manifest path, reader) in dir
+def scan_listings(dir: pathlib.Path) -> dict[str, tuple[pathlib.Path, typing.Callable[[pathlib.Path], typing.Iterator[list]]]]:
+    result = {}
+    for p in dir.iterdir():
+        if p.name.endswith(f".{util.LISTING_EXT}"):
+            name = p.name[:-len(util.LISTING_EXT) - 1]
+            if util.name_filter_str(name):
+                result[name] = (p, read_listing)
+        elif snapshot.manifest_filter_str(p.name):
+            result[p.name] = (p, read_manifest)
+    return result
+
+
+class Catalog:
+    def __init__(self, path: str | os.PathLike | None = None):
+        if path is None:
+            path = util.cache_dir() / "catalog.sqlite3"
+        self.path = path
+        self.db = sqlite3.connect(path, timeout=60)
+        self.db.executescript(
+            "CREATE TABLE IF NOT EXISTS archive ("
+            "id INTEGER PRIMARY KEY, dir TEXT, name TEXT, dt TEXT, "
+            "listing_size INTEGER, listing_mtime_ns INTEGER, UNIQUE (dir, name));"
+            "CREATE TABLE IF NOT EXISTS file ("
+            "archive INTEGER, path TEXT, name TEXT, size INTEGER, mtime INTEGER, sha256 TEXT);"
+            "CREATE INDEX IF NOT EXISTS file_path ON file (path);"
+            "CREATE INDEX IF NOT EXISTS file_name ON file (name);"
+            "CREATE INDEX IF NOT EXISTS file_sha256 ON file (sha256);"
+            "CREATE INDEX IF NOT EXISTS file_archive ON file (archive);")
+
+    # Load new or changed listings of dir and forget deleted archives
+    # Return (loaded, deleted)
+    def sync(self, dir: pathlib.Path) -> tuple[int, int]:
+        dir_str = str(dir)
+        listings = scan_listings(dir)
+        known = {
+            name: (id, size, mtime_ns)
+            for id, name, size, mtime_ns in self.db.execute(
+                "SELECT id, name, listing_size, listing_mtime_ns FROM archive WHERE dir = ?", (dir_str,))}
+        loaded = 0
+        deleted = 0
+        with self.db:
+            for name, (id, _size, _mtime_ns) in known.items():
+                if name not in listings:
+                    self._delete(id)
+                    deleted += 1
+            for name, (path, reader) in sorted(listings.items()):
+                st = path.stat()
+                old = known.get(name)
+                if old is not None:
+                    if old[1:] == (st.st_size, st.st_mtime_ns):
+                        continue
+                    self._delete(old[0])
+                try:
+                    rows = list(reader(path))
+                except (OSError, ValueError, EOFError, RuntimeError) as e:
+                    log.warning(f"Skip broken listing: {path}: {e}")
+                    continue
+                cur = self.db.execute(
+                    "INSERT INTO archive (dir, name, dt, listing_size, listing_mtime_ns) VALUES (?, ?, ?, ?, ?)",
+                    (dir_str, name, (util.name_parse_str(name) or snapshot.manifest_parse_str(name))[1], st.st_size, st.st_mtime_ns))
+                self.db.executemany(
+                    "INSERT INTO file VALUES (?, ?, ?, ?, ?, ?)",
+                    ((cur.lastrowid, p, posixpath.basename(p), size, mtime, digest) for p, size, mtime, digest in rows))
+                loaded += 1
+        return loaded, deleted
+
+    def _delete(self, id: int):
+        self.db.execute("DELETE FROM file WHERE archive = ?", (id,))
+        self.db.execute("DELETE FROM archive WHERE id = ?", (id,))
+
+    # Search files by GLOB pattern of path (pattern with "/") or file name, or by sha256
+    # dirs: only archives in these dirs (None = all)
+    # Return [(path, dir, archive name, size, mtime, sha256)] sorted by path and archive datetime
+    def find(self, pattern: str | None, digest: str | None = None, dirs: list[str] | None = None) -> list[tuple]:
+        where = []
+        params: list = []
+        if pattern is not None:
+            if "/" in pattern:
+                where.append("file.path GLOB ?")
+                params.append(normalize(pattern))
+            else:
+                where.append("file.name GLOB ?")
+                params.append(pattern)
+        if digest is not None:
+            where.append("file.sha256 = ?")
+            params.append(digest.lower())
+        if dirs is not None:
+            where.append(f"archive.dir IN ({', '.join('?' * len(dirs))})")
+            params += dirs
+        return self.db.execute(
+            "SELECT file.path, archive.dir, archive.name, file.size, file.mtime, file.sha256 "
+            "FROM file JOIN archive ON file.archive = archive.id "
+            f"WHERE {' AND '.join(where) or '1'} "
+            "ORDER BY file.path, archive.dt, archive.name", params).fetchall()
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
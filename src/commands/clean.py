@@ -1,49 +1,76 @@
 import logging
 import argparse
+import os
 import pathlib
-import time
-from . import util
+import concurrent.futures
+from . import util, snapshot, retention, metrics, trace
 
 log: logging.Logger = logging.getLogger(__name__)
 
 
+# Archive files and snapshot manifests in dst (one scandir, no stat with time_source "name")
+def scan(dst: pathlib.Path, time_source: str) -> list[retention.Entry]:
+    entries = []
+    with os.scandir(dst) as it:
+        for e in it:
+            # name first: cheaper than is_file() on some file systems
+            if not (util.name_filter_str(e.name) or snapshot.manifest_filter_str(e.name)) or not e.is_file():
+                continue
+            t = retention.name_time(e.name) if time_source == "name" else None
+            if t is None:
+                # cached in DirEntry (Windows: no system call)
+                t = e.stat().st_mtime
+            entries.append(retention.Entry(e.name, t))
+    return entries
+
+
+# Return the number of errors
+def delete_files(paths: list[pathlib.Path], jobs: int) -> int:
+    def unlink(path: pathlib.Path) -> bool:
+        try:
+            path.unlink()
+            log.info(f"delete: {path}")
+            # checksum sidecar and index
+            for companion in util.companion_paths(path):
+                companion.unlink(missing_ok=True)
+            return True
+        except OSError as e:
+            log.error(f"delete failed: {e}")
+            return False
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        results = list(executor.map(unlink, paths))
+    return results.count(False)
+
+
 def clean(args: argparse.Namespace):
     dst = pathlib.Path(args.dst)
     if not dst.is_dir():
         raise RuntimeError("<dst> must be a directory")
 
-    keep_count = args.keep_count
-    keep_days = args.keep_days
-    if keep_count is None and keep_days is None:
-        raise RuntimeError("At least one condition is needed")
-
-    # filter children by FILE (not dir) and name_filter
-    it = filter(lambda p: p.is_file(), dst.iterdir())
-    it = filter(util.name_filter, it)
-    # path => (mtime, path)
-    files = list(map(lambda p: (p.stat().st_mtime, p), it))
-    # sort by mtime (newer one will be processed earlier)
-    files.sort(reverse=True)
-
-    now = time.time()
-    for i, (mtime, path) in enumerate(files):
-        keep = False
-        if keep_count is not None:
-            if i < keep_count:
-                log.info(f"Keep by count ({i + 1}): {str(path)}")
-                keep = True
-        if keep_days is not None:
-            # UNIX time (sec) => (day: float)
-            t = (now - mtime) / (24 * 60 * 60)
-            if t <= keep_days:
-                log.info(f"Keep by days ({int(t)}): {str(path)}")
-                keep = True
-
-        if not keep:
-            log.info(f"delete: {str(path)}")
-            if args.dry_run:
-                log.info("(dry run)")
-            path.unlink()
+    policy = retention.policy_from_args(args)
+    policy.check()
+    if args.jobs < 1:
+        raise RuntimeError("--jobs must be >= 1")
+
+    with trace.span("plan"):
+        decisions = retention.plan(scan(dst, args.time_source), policy)
+    retention.print_plan(decisions)
+
+    delete = [dst / d.entry.name for d in decisions if not d.keep]
+    if args.dry_run:
+        log.info("(dry run)")
+    elif delete:
+        with trace.span("delete", args={"files": len(delete)}):
+            errors = delete_files(delete, args.jobs)
+        metrics.recorder.add(metrics.FILES, len(delete) - errors)
+        if errors:
+            raise RuntimeError(f"{errors} file(s) could not be deleted")
+
+    # snapshot store: delete chunks no longer referenced
+    if (dst / snapshot.CHUNK_DIR).is_dir():
+        with trace.span("gc"):
+            snapshot.gc(dst, args.dry_run)
 
     log.info("OK")
 
@@ -52,12 +79,12 @@ def main(argv: list[str]):
     parser = argparse.ArgumentParser(
         prog=argv[0],
         description="Clean old archive files",
-        epilog="A file will be deleted only if it is out of --keep-count AND out of --keep-days"
+        epilog="A file will be deleted only if it is out of all of --keep-* conditions"
     )
     parser.add_argument("--dst", "-d", required=True, help="archive files dir")
     parser.add_argument("--dry_run", "-n", action="store_true", help="dry run")
-    parser.add_argument("--keep-count", type=int, help="keep the latest N files")
-    parser.add_argument("--keep-days", type=int, help="keep files not expired")
+    retention.add_arguments(parser)
+    parser.add_argument("--jobs", "-j", type=int, default=8, help="parallel deletes")
 
     args = parser.parse_args(argv[1:])
 
@@ -13,55 +13,183 @@
 import logging
 import argparse
 import pathlib
-from . import util
+import glob
+from . import util, rclone, snapshot, trace
 
 log: logging.Logger = logging.getLogger(__name__)
 
 
-def cloud(args: argparse.Namespace):
+def remote_path(remote: str, dst: str, name: str) -> str:
+    if dst != "":
+        return f"{remote}:{dst}/{name}"
+    else:
+        return f"{remote}:{name}"
+
+
+# Write stdin to remote:dst/name (for streaming archive)
+def rcat_cmd(remote: str, dst: str, name: str) -> list[str]:
+    return ["rclone", "rcat", remote_path(remote, dst, name)] + util.governor.rclone_opts()
+
+
+# Delete a partially written file
+def delete_cmd(remote: str, dst: str, name: str) -> list[str]:
+    return ["rclone", "deletefile", remote_path(remote, dst, name)]
+
+
+# Preferred hash types to compare local and remote files (rclone and hashlib names)
+HASH_TYPES = ["sha256", "sha1", "md5"]
+
+
+# Local archive files which are not on remote:dst or differ from it
+# Compared by name and size, then by checksum sidecars if both sides have them
+# (no archive read), otherwise by hash if the remote supports one of HASH_TYPES
+# (local hashes are taken from the sidecar or the hash cache).
+def missing_files(
+        session: rclone.Session, src: pathlib.Path, remote: str, dst: str, hash_cache: util.HashCache) -> list[str]:
+    if (src / snapshot.CHUNK_DIR).is_dir():
+        log.warning(f"Snapshot manifests in {src} are not uploaded (they need the chunk store): use sync")
+    local = util.scan_archives(src)
+    local_digests = {e.name: util.read_sidecar(pathlib.Path(e.path)) for e in local}
+    log.info(f"{len(local)} local archive files")
+
+    remote_files: dict[str, dict] = {}
+    session.list_files(
+        remote, dst, util.archive_patterns() + [f"*.{util.SIDECAR_EXT}"],
+        lambda e: remote_files.__setitem__(e["Name"], e))
+    side_names = [
+        side for side in (util.sidecar_path(pathlib.Path(e.name)).name for e in local)
+        if side in remote_files]
+    remote_digests = util.parse_sidecar(session.cat_files(remote, dst, side_names))
+    remote_count = sum(not name.endswith(f".{util.SIDECAR_EXT}") for name in remote_files)
+    log.info(f"{remote_count} remote archive files, {len(remote_digests)} checksum sidecars")
+
+    missing = []
+    unknown = []
+    for e in local:
+        r = remote_files.get(e.name)
+        local_digest = local_digests[e.name]
+        remote_digest = remote_digests.get(e.name)
+        if r is None:
+            reason = "missing"
+        elif r["Size"] != e.stat().st_size:
+            reason = "size differs"
+        elif local_digest is None or remote_digest is None:
+            unknown.append(e)
+            continue
+        elif local_digest != remote_digest:
+            reason = "checksum differs"
+        else:
+            continue
+        log.info(f"{reason}: {e.name}")
+        missing.append(e.name)
+
+    # the remote may compute hashes by reading files: list again only for files without sidecars
+    supported = session.hash_types(remote) if unknown else []
+    hash_type = next((h for h in HASH_TYPES if h in supported), None)
+    if hash_type is not None:
+        log.info(f"{len(unknown)} file(s) without checksum sidecars, hash: {hash_type}")
+        remote_hashes: dict[str, str] = {}
+        session.list_files(
+            remote, dst, [glob.escape(e.name) for e in unknown],
+            lambda r: remote_hashes.__setitem__(r["Name"], (r.get("Hashes") or {}).get(hash_type) or ""),
+            hash_type=hash_type)
+        for e in unknown:
+            remote_hash = remote_hashes.get(e.name)
+            if not remote_hash:
+                continue
+            if hash_type == util.SIDECAR_EXT and local_digests[e.name] is not None:
+                local_hash = local_digests[e.name]
+            else:
+                local_hash = hash_cache.digest(e.path, hash_type)
+            if local_hash != remote_hash.lower():
+                log.info(f"hash differs: {e.name}")
+                missing.append(e.name)
+    log.info(f"{len(missing)} file(s) to upload")
+
+    return missing
+
+
+# names and their companion files (checksum sidecar, index, file listing) in src
+def with_companions(src: pathlib.Path, names: list[str]) -> list[str]:
+    result = []
+    for name in names:
+        result.append(name)
+        result += [p.name for p in util.companion_paths(src / name) if p.is_file()]
+    return result
+
+
+def cloud_all_missing(args: argparse.Namespace):
     src = pathlib.Path(args.src)
-    dst = f"{args.remote}:{args.dst}"
-    latest = src / "latest.txt"
+    if not src.is_dir():
+        raise RuntimeError(f"{src} is not a directory")
+    if args.transfers < 1:
+        raise RuntimeError("--transfers must be >= 1")
+
+    dry_run = args.dry_run
+    with rclone.session(daemon=not args.no_rcd) as session, util.HashCache(args.hash_cache) as hash_cache:
+        if args.dst != "":
+            session.mkdir(args.remote, args.dst, dry_run)
+        with trace.span("compare"):
+            names = missing_files(session, src, args.remote, args.dst, hash_cache)
+        session.copy_files(src, with_companions(src, names), args.remote, args.dst, args.transfers, args.progress, dry_run)
+    log.info("OK")
 
-    log.info(f"Read the latest archive: {str(latest)}")
-    with latest.open() as fin:
-        latest_file = src / fin.readline().strip()
-    log.info(f"The latest archive: {str(latest_file)}")
-    if not latest_file.is_file():
-        raise RuntimeError(f"{str(latest_file)} is not a valid file")
+
+def cloud(args: argparse.Namespace):
+    if args.all_missing:
+        cloud_all_missing(args)
+        return
+
+    src = pathlib.Path(args.src)
+    latest_files = util.read_latest(src)
 
     dry_run = args.dry_run
-    # print total/used/free
-    util.exec(["rclone", "about", f"{args.remote}:"], dry_run=dry_run)
-    # mkdir if dst doen't exist
-    # dirpath "" causes SEGV
-    if args.dst != "":
-        cmd = ["rclone", "mkdir", dst]
-        if dry_run:
-            cmd += ["-n"]
-        util.exec(cmd)
-
-    cmd = ["rclone", "copy", str(latest_file), dst]
-    if args.progress:
-        cmd += ["-P"]
-    if dry_run:
-        cmd += ["-n"]
-
-    util.exec(cmd)
+    with rclone.session(daemon=not args.no_rcd) as session:
+        # print total/used/free
+        if not dry_run:
+            session.about(args.remote)
+        # mkdir if dst doen't exist
+        # dirpath "" causes SEGV
+        if args.dst != "":
+            session.mkdir(args.remote, args.dst, dry_run)
+
+        # compare checksum sidecars instead of reading the archives
+        remote_digests = {}
+        if any(util.read_sidecar(f) is not None for f in latest_files):
+            side_names = [util.sidecar_path(f).name for f in latest_files]
+            remote_digests = util.parse_sidecar(session.cat_files(args.remote, args.dst, side_names))
+
+        for latest_file in latest_files:
+            local_digest = util.read_sidecar(latest_file)
+            if local_digest is not None:
+                remote_digest = remote_digests.get(latest_file.name)
+                log.info(f"sha256 local: {local_digest}, remote: {remote_digest or '-'}")
+                if remote_digest == local_digest:
+                    log.info(f"Already uploaded: {latest_file.name}")
+                    continue
+
+            session.copy_file(latest_file, args.remote, args.dst, args.progress, dry_run)
+            for companion in util.companion_paths(latest_file):
+                if companion.is_file():
+                    session.copy_file(companion, args.remote, args.dst, False, dry_run)
     log.info("OK")
 
 
 def main(argv: list[str]):
     parser = argparse.ArgumentParser(
         prog=argv[0],
-        description="Copy the latest archive file to a cloud storage",
+        description="Copy the latest archive file(s) to a cloud storage",
         epilog="This is rclone wrapper",
     )
     parser.add_argument("--src", "-s", required=True, help="archive dir")
     parser.add_argument("--remote", "-r", required=True, help="backup destination remote name")
     parser.add_argument("--dst", "-d", default="", help="backup destination dir on remote (remote:HERE)")
     parser.add_argument("--progress", "-P", action="store_true", help="show progress")
+    parser.add_argument("--all-missing", action="store_true", help="copy all archive files missing on the remote, not only the latest")
+    parser.add_argument("--transfers", type=int, default=4, help="files copied at the same time (--all-missing)")
+    parser.add_argument("--hash-cache", help="file hash cache (default: ~/.cache/bkup/hashcache.sqlite3)")
     parser.add_argument("--dry-run", "-n", action="store_true", help="dry run")
+    rclone.add_arguments(parser)
 
     args = parser.parse_args(argv[1:])
 
@@ -12,58 +12,80 @@
 
 import logging
 import argparse
-import json
 import datetime
-from . import util
+import re
+import pathlib
+from . import util, retention, rclone, trace
 
 log: logging.Logger = logging.getLogger(__name__)
 
 
+# RFC 3339 (Python 3.10 fromisoformat() does not accept "Z" and nanoseconds)
+def parse_modtime(s: str) -> datetime.datetime:
+    s = re.sub(r"(\.\d{6})\d+", r"\1", s)
+    if s.endswith("Z"):
+        s = s[:-1] + "+00:00"
+    return datetime.datetime.fromisoformat(s)
+
+
+# List archive files (and names of companion files) on remote:dst
+# rclone filters files by name (and the command output is parsed line by line).
+def list_archives(
+        session: rclone.Session, remote: str, dst: str, time_source: str) -> tuple[list[retention.Entry], set[str]]:
+    entries: list[retention.Entry] = []
+    companions: set[str] = set()
+    received = 0
+
+    def on_entry(obj: dict):
+        nonlocal received
+        received += 1
+        name = obj["Name"]
+        if obj.get("IsDir"):
+            return
+        if any(name.endswith(f".{ext}") for ext in util.COMPANION_EXTS):
+            companions.add(name)
+            return
+        if not util.name_filter_str(name):
+            return
+        t = retention.name_time(name) if time_source == "name" else None
+        if t is None:
+            t = parse_modtime(obj["ModTime"]).timestamp()
+        entries.append(retention.Entry(name, t))
+
+    session.list_files(remote, dst, util.archive_patterns() + [f"*.{ext}" for ext in util.COMPANION_EXTS], on_entry)
+    log.info(f"Received {received} files, {len(entries)} archive files")
+
+    return entries, companions
+
+
 def cloud(args: argparse.Namespace):
     dry_run = args.dry_run
-    keep_count = args.keep_count
-    keep_days = args.keep_days
-    if keep_count is None and keep_days is None:
-        raise RuntimeError("At least one condition is needed")
-
-    # print total/used/free
-    util.exec(["rclone", "about", f"{args.remote}:"])
-    # mkdir if dst doen't exist
-    # dirpath "" causes SEGV
-    if args.dst != "":
-        util.exec(["rclone", "mkdir", f"{args.remote}:{args.dst}"], dry_run=dry_run)
-
-    # lsjson and filter
-    stdout = util.exec_out(["rclone", "lsjson", f"{args.remote}:{args.dst}"])
-    lsresult = json.loads(stdout)
-    print(f"Received {len(lsresult)} files")
-    lsresult = list(filter(lambda e: not e["IsDir"] and util.name_filter_str(e["Name"]), lsresult))
-    print(f"{len(lsresult)} archive files")
-    # convert ISO datetime str
-    for entry in lsresult:
-        entry["ModTime"] = datetime.datetime.fromisoformat(entry["ModTime"])
-    lsresult.sort(key=lambda e: e["ModTime"], reverse=True)
-
-    for i, entry in enumerate(lsresult):
-        keep = False
-        if keep_count is not None:
-            if i < keep_count:
-                log.info(f"Keep by count ({i + 1}): {entry['Name']}")
-                keep = True
-        if keep_days is not None:
-            # Convert to days difference
-            now = datetime.datetime.now(datetime.timezone.utc)
-            t = (now - entry["ModTime"]).days
-            if t <= keep_days:
-                log.info(f"Keep by days ({t}): {entry['Name']}")
-                keep = True
-
-        if not keep:
-            log.info(f"delete: {entry['Name']}")
-            if dry_run:
-                log.info("(dry run)")
-            else:
-                util.exec(["rclone", "delete", f"{args.remote}:{args.dst}/{entry['Name']}"])
+    policy = retention.policy_from_args(args)
+    policy.check()
+    if args.jobs < 1:
+        raise RuntimeError("--jobs must be >= 1")
+
+    with rclone.session(daemon=not args.no_rcd) as session:
+        # print total/used/free
+        session.about(args.remote)
+        # mkdir if dst doen't exist
+        # dirpath "" causes SEGV
+        if args.dst != "":
+            session.mkdir(args.remote, args.dst, dry_run)
+
+        entries, companions = list_archives(session, args.remote, args.dst, args.time_source)
+        with trace.span("plan"):
+            decisions = retention.plan(entries, policy)
+        retention.print_plan(decisions)
+
+        delete = [d.entry.name for d in decisions if not d.keep]
+        # with checksum sidecars and indexes
+        delete += [
+            p.name for name in delete for p in util.companion_paths(pathlib.PurePosixPath(name))
+            if p.name in companions]
+        session.delete_files(args.remote, args.dst, delete, args.jobs, dry_run)
+
+    log.info("OK")
 
 
 def main(argv: list[str]):
@@ -75,8 +97,9 @@ def main(argv: list[str]):
     parser.add_argument("--remote", "-r", required=True, help="backup destination remote name")
     parser.add_argument("--dst", "-d", default="", help="backup destination dir on remote (remote:HERE)")
     parser.add_argument("--dry-run", "-n", action="store_true", help="dry run")
-    parser.add_argument("--keep-count", type=int, help="keep the latest N files")
-    parser.add_argument("--keep-days", type=int, help="keep files not expired")
+    retention.add_arguments(parser)
+    parser.add_argument("--jobs", "-j", type=int, default=4, help="parallel deletes (--no-rcd: rclone delete processes)")
+    rclone.add_arguments(parser)
 
     args = parser.parse_args(argv[1:])
 
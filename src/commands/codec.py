@@ -0,0 +1,160 @@
+import dataclasses
+import shutil
+import bz2
+import gzip
+import lzma
+import typing
+from . import util
+try:
+    # Python 3.14+
+    from compression import zstd as _zstd
+except ImportError:
+    _zstd = None
+
+# Compressor registry for tar archives
+# All of the programs read stdin and write stdout if no file is given,
+# and accept "-d" for decompression (tar --use-compress-program passes "-d").
+
+
+@dataclasses.dataclass(frozen=True)
+class Codec:
+    name: str
+    # archive file extension
+    ext: str
+    # compressor program
+    prog: str
+    # decompressor program (tar --use-compress-program on extraction)
+    dprog: str
+    default_level: int
+    min_level: int
+    max_level: int
+    # multi-thread option format ({} = thread count) or None
+    thread_opt: str | None
+    # option to reset the compression state at content-defined points
+    # (a local change in the input changes only a local part of the output) or None
+    rsyncable_opt: str | None
+    # install hint
+    install: str
+
+    def check_level(self, level: int):
+        if not self.min_level <= level <= self.max_level:
+            raise RuntimeError(f"{self.name}: level must be {self.min_level}..{self.max_level}")
+
+    # level None: default, threads 0: --threads of bkup.py or all cores
+    def compress_cmd(self, level: int | None = None, threads: int = 0, rsyncable: bool = False) -> list[str]:
+        level = self.default_level if level is None else level
+        self.check_level(level)
+        cmd = [self.prog, f"-{level}"]
+        if self.name == "zstd" and level > 19:
+            cmd.append("--ultra")
+        if self.thread_opt is not None:
+            cmd.append(self.thread_opt.format(util.governor.compress_threads(threads)))
+        if rsyncable:
+            if self.rsyncable_opt is None:
+                rsyncable_codecs = [c.name for c in CODECS.values() if c.rsyncable_opt is not None]
+                raise RuntimeError(f"{self.name}: --rsyncable is unavailable (available: {', '.join(rsyncable_codecs)})")
+            cmd.append(self.rsyncable_opt)
+        return cmd
+
+    def decompress_cmd(self) -> list[str]:
+        return [self.dprog, "-d", "-c"]
+
+    def available(self) -> bool:
+        return shutil.which(self.prog) is not None
+
+
+CODECS: dict[str, Codec] = {c.name: c for c in [
+    Codec(
+        name="zstd", ext="tar.zst", prog="zstd", dprog="zstd",
+        default_level=3, min_level=1, max_level=22, thread_opt="-T{}", rsyncable_opt="--rsyncable",
+        install="sudo apt install zstd"),
+    Codec(
+        name="bzip2", ext="tar.bz2", prog="pbzip2", dprog="pbzip2",
+        default_level=9, min_level=1, max_level=9, thread_opt="-p{}", rsyncable_opt=None,
+        install="sudo apt install pbzip2"),
+    Codec(
+        name="xz", ext="tar.xz", prog="xz", dprog="xz",
+        default_level=6, min_level=0, max_level=9, thread_opt="-T{}", rsyncable_opt=None,
+        install="sudo apt install xz-utils"),
+    Codec(
+        name="gzip", ext="tar.gz", prog="pigz", dprog="pigz",
+        default_level=6, min_level=1, max_level=9, thread_opt="-p{}", rsyncable_opt="--rsyncable",
+        install="sudo apt install pigz"),
+    Codec(
+        name="lz4", ext="tar.lz4", prog="lz4", dprog="lz4",
+        default_level=1, min_level=1, max_level=12, thread_opt=None, rsyncable_opt=None,
+        install="sudo apt install lz4"),
+]}
+DEFAULT = "zstd"
+
+
+def get(name: str) -> Codec:
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise RuntimeError(f"Unknown codec: {name} (available: {', '.join(CODECS)})") from None
+
+
+# In-process compression of an independent block (python archive engine)
+# Concatenated outputs are a valid multi-stream/member/frame file for stock tools.
+_NATIVE = {
+    "bzip2": lambda data, level: bz2.compress(data, level),
+    "gzip": lambda data, level: gzip.compress(data, level, mtime=0),
+    "xz": lambda data, level: lzma.compress(data, preset=level),
+}
+if _zstd is not None:
+    _NATIVE["zstd"] = lambda data, level: _zstd.compress(data, level)
+
+
+def native_available(c: Codec) -> bool:
+    return c.name in _NATIVE
+
+
+def compress_block(name: str, data: bytes, level: int) -> bytes:
+    return _NATIVE[name](data, level)
+
+
+# In-process decompression of an independent block (restore of seekable archives)
+_NATIVE_DECOMPRESS = {
+    "bzip2": bz2.decompress,
+    "gzip": gzip.decompress,
+    "xz": lzma.decompress,
+}
+if _zstd is not None:
+    _NATIVE_DECOMPRESS["zstd"] = _zstd.decompress
+
+
+def decompress_block(name: str, data: bytes) -> bytes:
+    return _NATIVE_DECOMPRESS[name](data)
+
+
+# In-process decompression (reads multi-stream/member/frame files)
+_NATIVE_OPEN = {
+    "bzip2": bz2.open,
+    "gzip": gzip.open,
+    "xz": lzma.open,
+}
+if _zstd is not None:
+    _NATIVE_OPEN["zstd"] = _zstd.open
+
+
+def native_decompress_available(c: Codec) -> bool:
+    return c.name in _NATIVE_OPEN
+
+
+def open_decompress(name: str, fileobj: typing.BinaryIO) -> typing.BinaryIO:
+    return _NATIVE_OPEN[name](fileobj, "rb")
+
+
+# Find codec from archive file name
+def by_name(filename: str) -> Codec | None:
+    for c in CODECS.values():
+        if filename.endswith(f".{c.ext}"):
+            return c
+    return None
+
+
+# Raise with install hint if the compressor is not installed
+def check_installed(c: Codec):
+    if not c.available():
+        raise RuntimeError(f"{c.prog} not found ([Hint] e.g. $ {c.install})")
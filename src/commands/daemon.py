@@ -0,0 +1,514 @@
+import logging
+import argparse
+import copy
+import datetime
+import json
+import os
+import pathlib
+import signal
+import socket
+import socketserver
+import threading
+import time
+from . import util, metrics, trace, rclone, run
+
+log: logging.Logger = logging.getLogger(__name__)
+
+# Resident scheduler of the jobs of a run config
+#
+# [[job]]
+# name = "home"
+# # cron expression (minute hour day month weekday, local time)
+# # or @hourly, @daily, @weekly, @monthly, @yearly
+# schedule = "30 3 * * *"
+#
+# Jobs with the same schedule run together as one DAG (same as run), so a
+# stage may depend on stages of other jobs with the same schedule.
+# Jobs without schedule run only by "daemon --trigger JOB".
+# A run is skipped if the previous run of the job is still running.
+# [limits] of the config are shared by all running jobs.
+#
+# State kept warm between runs: WSL probes and path translations, the file
+# hash index (in memory), and one rclone rcd shared by cloud stages.
+# The config is reloaded when it is modified (or by SIGHUP).
+# Status and control: JSON lines over a Unix socket (--status, --trigger,
+# --shutdown).
+
+# max sleep (sec) to follow wall clock changes (suspend, NTP) and config changes
+MAX_SLEEP = 60.0
+# log a run started later than this (sec) after the scheduled time
+LATE_WARNING = 60.0
+CLIENT_TIMEOUT = 10.0
+REQUEST_MAX = 64 * 1024
+
+CRON_ALIASES = {
+    "@hourly": "0 * * * *",
+    "@daily": "0 0 * * *",
+    "@weekly": "0 0 * * 0",
+    "@monthly": "0 0 1 * *",
+    "@yearly": "0 0 1 1 *",
+}
+# (name, min, max), weekday 0 and 7 are Sunday
+CRON_FIELDS = [("minute", 0, 59), ("hour", 0, 23), ("day", 1, 31), ("month", 1, 12), ("weekday", 0, 7)]
+
+
+def parse_cron_field(text: str, name: str, lo: int, hi: int) -> set[int]:
+    values: set[int] = set()
+    for part in text.split(","):
+        rng, sep, step_text = part.partition("/")
+        try:
+            step = int(step_text) if sep else 1
+            if rng == "*":
+                start, end = lo, hi
+            elif "-" in rng:
+                first, last = rng.split("-", 1)
+                start, end = int(first), int(last)
+            else:
+                # "5/15" is "5-max/15"
+                start = int(rng)
+                end = hi if sep else start
+        except ValueError:
+            raise RuntimeError(f"Invalid {name}: {part}") from None
+        if not lo <= start <= end <= hi or step < 1:
+            raise RuntimeError(f"Invalid {name}: {part} ({lo}-{hi})")
+        values.update(range(start, end + 1, step))
+    return values
+
+
+class Cron:
+    def __init__(self, expr: str):
+        self.expr = " ".join(expr.split())
+        fields = CRON_ALIASES.get(self.expr, self.expr).split()
+        if len(fields) != 5:
+            raise RuntimeError(f"Invalid schedule: {expr!r} (minute hour day month weekday)")
+        self.minutes, self.hours, self.days, self.months, weekdays = (
+            parse_cron_field(text, *spec) for text, spec in zip(fields, CRON_FIELDS))
+        self.weekdays = {d % 7 for d in weekdays}
+        # cron: if both day and weekday are restricted, either of them matches
+        self.day_or_weekday = not fields[2].startswith("*") and not fields[4].startswith("*")
+
+    def day_match(self, t: datetime.datetime) -> bool:
+        day = t.day in self.days
+        weekday = t.isoweekday() % 7 in self.weekdays
+        return (day or weekday) if self.day_or_weekday else (day and weekday)
+
+    # The first matching minute after t
+    def next(self, t: datetime.datetime) -> datetime.datetime:
+        t = t.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+        # Feb 29 matches once in 4 years (or 8 years around 2100)
+        limit = t + datetime.timedelta(days=366 * 9)
+        while t < limit:
+            if t.month not in self.months:
+                t = (t.replace(day=1, hour=0, minute=0) + datetime.timedelta(days=32)).replace(day=1)
+            elif not self.day_match(t):
+                t = t.replace(hour=0, minute=0) + datetime.timedelta(days=1)
+            elif t.hour not in self.hours:
+                t = t.replace(minute=0) + datetime.timedelta(hours=1)
+            elif t.minute not in self.minutes:
+                t += datetime.timedelta(minutes=1)
+            else:
+                return t
+        raise RuntimeError(f"Schedule never matches: {self.expr}")
+
+
+def isotime(t: datetime.datetime | None) -> str | None:
+    return t.astimezone().isoformat(timespec="seconds") if t is not None else None
+
+
+# Jobs run together (the same schedule, or one unscheduled job)
+class Group:
+    def __init__(self, jobs: list[str], cron: Cron | None, stages: dict[str, run.Stage]):
+        self.name = "+".join(jobs)
+        self.jobs = jobs
+        self.cron = cron
+        # stage definitions (copied for each run)
+        self.stages = stages
+        self.due: datetime.datetime | None = None
+        # trigger of the requested run ("manual", "startup")
+        self.pending: str | None = None
+        self.thread: threading.Thread | None = None
+        # stages of the running run
+        self.current: dict[str, run.Stage] | None = None
+        self.last: dict | None = None
+        self.runs = 0
+        self.skipped = 0
+
+    def status(self) -> dict:
+        return {
+            "name": self.name,
+            "jobs": self.jobs,
+            "schedule": self.cron.expr if self.cron is not None else None,
+            "next": isotime(self.due),
+            "running": self.current is not None,
+            "stages": {sid: st.result or "pending" for sid, st in (self.current or {}).items()},
+            "runs": self.runs,
+            "skipped": self.skipped,
+            "last": self.last,
+        }
+
+
+def make_groups(config: dict, stages: dict[str, run.Stage]) -> dict[str, Group]:
+    members: dict[str, list[str]] = {}
+    crons: dict[str, Cron | None] = {}
+    for job in config.get("job", []):
+        jname = job["name"]
+        schedule = job.get("schedule")
+        if schedule is None:
+            members[f"job:{jname}"] = [jname]
+            crons[f"job:{jname}"] = None
+            continue
+        if not isinstance(schedule, str):
+            raise RuntimeError(f"{jname}: schedule must be a string")
+        try:
+            cron = Cron(schedule)
+        except RuntimeError as e:
+            raise RuntimeError(f"{jname}: {e}") from None
+        members.setdefault(cron.expr, []).append(jname)
+        crons[cron.expr] = cron
+
+    groups: dict[str, Group] = {}
+    for key, jobs in members.items():
+        group_stages = {sid: st for sid, st in stages.items() if st.job in jobs}
+        for stage in group_stages.values():
+            for dep in stage.after:
+                if stages[dep].job not in jobs:
+                    raise RuntimeError(f"{stage.id}: dependency {dep} is in a job of another schedule")
+        if not group_stages:
+            log.warning(f"No stage in job: {', '.join(jobs)}")
+            continue
+        group = Group(jobs, crons[key], group_stages)
+        groups[group.name] = group
+    return groups
+
+
+class Daemon:
+    def __init__(self, config_path: pathlib.Path, jobs: int, socket_path: pathlib.Path | None,
+                 run_now: bool = False, max_runs: int = 0):
+        # import here: commands/__init__ imports this module
+        from . import command_table
+        self.funcs = {name: func for func, name, _desc in command_table}
+        self.config_path = config_path
+        self.jobs = jobs
+        self.socket_path = socket_path
+        self.run_now = run_now
+        self.max_runs = max_runs
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        # wake up the scheduler (trigger, reload, stop)
+        self.wake = threading.Event()
+        self.groups: dict[str, Group] = {}
+        self.limits = run.Limits({})
+        self.config_mtime: int | None = None
+        self.threads: list[threading.Thread] = []
+        self.server: socketserver.BaseServer | None = None
+        self.started = datetime.datetime.now()
+        self.runs = 0
+        self.load()
+
+    def load(self):
+        mtime = self.config_path.stat().st_mtime_ns
+        config = run.load_config(self.config_path)
+        stages = run.parse_stages(config, set(self.funcs))
+        limits = run.Limits(config.get("limits", {}))
+        groups = make_groups(config, stages)
+        if not groups:
+            raise RuntimeError("No job in config")
+        now = datetime.datetime.now()
+        with self.lock:
+            # keep the state of existing groups (running, last result)
+            for name, group in groups.items():
+                old = self.groups.get(name)
+                if old is not None:
+                    old.stages = group.stages
+                    if old.cron is None or group.cron is None or old.cron.expr != group.cron.expr:
+                        old.cron = group.cron
+                        old.due = None
+                    groups[name] = old
+                group = groups[name]
+                if group.cron is not None and group.due is None:
+                    group.due = group.cron.next(now)
+            self.groups = groups
+            self.limits = limits
+            self.config_mtime = mtime
+        for group in groups.values():
+            log.info(f"  {group.name}: {group.cron.expr if group.cron else '(trigger only)'}, "
+                     f"{len(group.stages)} stage(s), next: {isotime(group.due) or '-'}")
+        if limits.limits:
+            log.info(f"Limits: {', '.join(f'{k}={v}' for k, v in limits.limits.items())}")
+
+    def _reload_if_modified(self):
+        try:
+            mtime = self.config_path.stat().st_mtime_ns
+        except OSError as e:
+            log.warning(f"Cannot stat config: {e}")
+            return
+        if mtime == self.config_mtime:
+            return
+        log.info(f"Reload config: {self.config_path}")
+        try:
+            self.load()
+        except (OSError, ValueError, KeyError, RuntimeError) as e:
+            # keep the current config (until modified again)
+            log.error(f"Config error, not reloaded: {e}")
+            self.config_mtime = mtime
+
+    def reload(self):
+        self.config_mtime = None
+        self.wake.set()
+
+    def stop(self):
+        self.stop_event.set()
+        self.wake.set()
+
+    def trigger(self, job: str) -> str:
+        with self.lock:
+            for group in self.groups.values():
+                if job in group.jobs or job == group.name:
+                    group.pending = "manual"
+                    self.wake.set()
+                    return group.name
+        raise RuntimeError(f"Unknown job: {job}")
+
+    def status(self) -> dict:
+        with self.lock:
+            return {
+                "pid": os.getpid(),
+                "started": isotime(self.started),
+                "config": str(self.config_path),
+                "runs": self.runs,
+                "jobs": [group.status() for group in self.groups.values()],
+                "limits": self.limits.status(),
+            }
+
+    # Request of the status socket
+    def command(self, req: dict) -> dict:
+        cmd = req.get("cmd")
+        if cmd == "status":
+            return self.status()
+        if cmd == "run":
+            return {"ok": True, "job": self.trigger(str(req.get("job")))}
+        if cmd == "shutdown":
+            self.stop()
+            return {"ok": True}
+        raise RuntimeError(f"Unknown request: {cmd}")
+
+    def _start(self, group: Group, trigger: str, scheduled: datetime.datetime):
+        group.pending = None
+        if group.thread is not None and group.thread.is_alive():
+            group.skipped += 1
+            log.warning(f"[{group.name}] previous run is still running, skip ({trigger})")
+            return
+        group.current = {sid: copy.copy(st) for sid, st in group.stages.items()}
+        group.thread = threading.Thread(
+            target=metrics.bind(self._run), args=(group, group.current, trigger, scheduled),
+            name=group.name, daemon=True)
+        self.threads = [t for t in self.threads if t.is_alive()] + [group.thread]
+        group.thread.start()
+
+    def _run(self, group: Group, stages: dict[str, run.Stage], trigger: str, scheduled: datetime.datetime):
+        start = datetime.datetime.now()
+        jitter = (start - scheduled).total_seconds() if trigger == "schedule" else None
+        if jitter is not None and jitter > LATE_WARNING:
+            log.warning(f"[{group.name}] started {jitter:.0f} sec after the scheduled time")
+        log.info(f"[{group.name}] START ({trigger}" + (f", jitter {jitter * 1000:.1f} ms)" if jitter is not None else ")"))
+        t0 = time.monotonic()
+        with trace.span(group.name, "job", {"trigger": trigger}):
+            run.run_dag(stages, self.funcs, self.jobs, self.limits)
+        elapsed = time.monotonic() - t0
+        result = "ok" if all(st.result == "ok" for st in stages.values()) else "failed"
+        with self.lock:
+            group.current = None
+            group.runs += 1
+            group.last = {
+                "trigger": trigger,
+                "start": isotime(start),
+                "elapsed": round(elapsed, 3),
+                "jitter_ms": round(jitter * 1000, 1) if jitter is not None else None,
+                "result": result,
+                "stages": {sid: {"result": st.result, "elapsed": round(st.elapsed, 3)} for sid, st in stages.items()},
+            }
+            self.runs += 1
+            done = self.max_runs > 0 and self.runs >= self.max_runs
+        metrics.recorder.finish()
+        log_func = log.info if result == "ok" else log.error
+        log_func(f"[{group.name}] {result.upper()} ({elapsed:.1f} sec)")
+        for sid, st in stages.items():
+            if st.result != "ok":
+                log.error(f"  {sid}: {st.result}")
+        if done:
+            log.info(f"{self.runs} run(s) done, exit")
+            self.stop()
+
+    def _start_server(self):
+        if not hasattr(socketserver, "ThreadingUnixStreamServer"):
+            raise RuntimeError("Status socket requires Unix domain sockets (use --no-socket)")
+        path = str(self.socket_path)
+        if os.path.exists(path):
+            try:
+                request(self.socket_path, {"cmd": "status"})
+            except RuntimeError:
+                # stale socket of a dead daemon
+                os.unlink(path)
+            else:
+                raise RuntimeError(f"Daemon is already running: {path}")
+        server = socketserver.ThreadingUnixStreamServer(path, Handler)
+        os.chmod(path, 0o600)
+        server.daemon_threads = True
+        server.owner = self
+        threading.Thread(target=server.serve_forever, name="status", daemon=True).start()
+        self.server = server
+        log.info(f"Status socket: {path}")
+
+    def serve(self):
+        # warm state kept between runs
+        util.is_wsl()
+        util.HashCache.enable_memory()
+        rclone.shared.enabled = True
+        if self.socket_path is not None:
+            self._start_server()
+        try:
+            with self.lock:
+                for group in self.groups.values():
+                    if self.run_now and group.cron is not None:
+                        group.pending = "startup"
+            while not self.stop_event.is_set():
+                self.wake.clear()
+                self._reload_if_modified()
+                now = datetime.datetime.now()
+                timeout = MAX_SLEEP
+                with self.lock:
+                    for group in self.groups.values():
+                        if group.pending is not None:
+                            self._start(group, group.pending, now)
+                        if group.due is not None and group.due <= now:
+                            self._start(group, "schedule", group.due)
+                            group.due = group.cron.next(now)
+                        if group.due is not None:
+                            timeout = min(timeout, (group.due - now).total_seconds())
+                self.wake.wait(max(timeout, 0))
+        finally:
+            self._finish()
+
+    def _finish(self):
+        running = [t for t in self.threads if t.is_alive()]
+        if running:
+            log.info(f"Waiting for {len(running)} running job(s)")
+        for thread in running:
+            thread.join()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+            pathlib.Path(self.socket_path).unlink(missing_ok=True)
+        rclone.shared.close()
+        rclone.shared.enabled = False
+
+
+class Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            req = json.loads(self.rfile.readline(REQUEST_MAX))
+            if not isinstance(req, dict):
+                raise ValueError("not an object")
+            resp = self.server.owner.command(req)
+        except ValueError as e:
+            resp = {"error": f"Invalid request: {e}"}
+        except RuntimeError as e:
+            resp = {"error": str(e)}
+        self.wfile.write(json.dumps(resp).encode() + b"\n")
+
+
+# Send a request to the daemon
+def request(path: pathlib.Path, req: dict) -> dict:
+    if not hasattr(socket, "AF_UNIX"):
+        raise RuntimeError("Status socket requires Unix domain sockets")
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(CLIENT_TIMEOUT)
+            sock.connect(str(path))
+            sock.sendall(json.dumps(req).encode() + b"\n")
+            with sock.makefile("rb") as fin:
+                line = fin.readline()
+    except OSError as e:
+        raise RuntimeError(f"Daemon is not running: {path}: {e}") from None
+    try:
+        resp = json.loads(line)
+    except ValueError:
+        raise RuntimeError(f"Invalid response from daemon: {line[:100]!r}") from None
+    if "error" in resp:
+        raise RuntimeError(resp["error"])
+    return resp
+
+
+def daemon(args: argparse.Namespace):
+    socket_path = None if args.no_socket else pathlib.Path(args.socket or util.cache_dir() / "daemon.sock").expanduser()
+
+    if args.status or args.trigger or args.shutdown:
+        if socket_path is None:
+            raise RuntimeError("--status, --trigger and --shutdown require the status socket")
+        if args.status:
+            print(json.dumps(request(socket_path, {"cmd": "status"}), indent=2, ensure_ascii=False))
+        if args.trigger:
+            resp = request(socket_path, {"cmd": "run", "job": args.trigger})
+            log.info(f"Triggered: {resp['job']}")
+        if args.shutdown:
+            request(socket_path, {"cmd": "shutdown"})
+            log.info("Shutdown requested")
+        return
+
+    if args.config is None:
+        raise RuntimeError("--config is required")
+    if args.jobs < 1:
+        raise RuntimeError("--jobs must be >= 1")
+    config_path = pathlib.Path(args.config).expanduser().resolve()
+    log.info(f"Config: {config_path}")
+    bkupd = Daemon(config_path, args.jobs, socket_path, args.now, args.max_runs)
+    if args.dry_run:
+        now = datetime.datetime.now()
+        for group in bkupd.groups.values():
+            if group.cron is None:
+                continue
+            times = []
+            t = now
+            for _ in range(3):
+                t = group.cron.next(t)
+                times.append(isotime(t))
+            log.info(f"  {group.name}: {', '.join(times)}")
+        log.info("(dry run)")
+        return
+
+    # SIGTERM: stop after running jobs, SIGHUP: reload config
+    handlers = {signal.SIGTERM: lambda signum, frame: bkupd.stop()}
+    if hasattr(signal, "SIGHUP"):
+        handlers[signal.SIGHUP] = lambda signum, frame: bkupd.reload()
+    saved = {}
+    if threading.current_thread() is threading.main_thread():
+        saved = {sig: signal.signal(sig, handler) for sig, handler in handlers.items()}
+    try:
+        bkupd.serve()
+    finally:
+        for sig, handler in saved.items():
+            signal.signal(sig, handler)
+    log.info("Daemon stopped")
+
+
+def main(argv: list[str]):
+    parser = argparse.ArgumentParser(
+        prog=argv[0],
+        description="Run jobs of a run config on schedule (resident process)",
+        epilog="Jobs are scheduled by 'schedule' (cron expression) of [[job]] in the config",
+    )
+    parser.add_argument("--config", "-c", help="job config file (.toml or .json)")
+    parser.add_argument("--jobs", "-j", type=int, default=4, help="max stages of a job running at the same time")
+    parser.add_argument("--socket", help="status socket path (default: CACHE_DIR/daemon.sock)")
+    parser.add_argument("--no-socket", action="store_true", help="do not open the status socket")
+    parser.add_argument("--now", action="store_true", help="run scheduled jobs once at startup")
+    parser.add_argument("--max-runs", type=int, default=0, help="exit after N runs of jobs (0: no limit)")
+    parser.add_argument("--dry-run", "-n", action="store_true", help="print schedules and exit")
+    parser.add_argument("--status", action="store_true", help="print the status of the running daemon")
+    parser.add_argument("--trigger", metavar="JOB", help="run a job of the running daemon now")
+    parser.add_argument("--shutdown", action="store_true", help="stop the running daemon (after running jobs)")
+
+    args = parser.parse_args(argv[1:])
+
+    daemon(args)
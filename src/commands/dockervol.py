@@ -3,49 +3,138 @@ import argparse
 import pathlib
 import subprocess
 import datetime
-from . import util
+import concurrent.futures
+import hashlib
+import json
+import os
+from . import util, codec, catalog, metrics, trace
 
 log: logging.Logger = logging.getLogger(__name__)
 
 DOCKER_IMAGE = "busybox:latest"
-DOCKER_MP_DEST = "/tmp/dest"
 DOCKER_MP_VOLUME = "/tmp/vol"
-EXT = "tar.bz2"
+# busybox stat: inode, size, mtime, ctime, raw mode, path
+FINGERPRINT_FORMAT = "%i %s %Y %Z %f %n"
+STATE_VERSION = 1
 
 
-def run_tar(project: str, volumes: list[str], ar_dst: pathlib.Path, dry_run: bool):
-    vol_names = map(lambda v: f"{project}_{v}", volumes)
+# docker run command mounting the volumes at DOCKER_MP_VOLUME/PROJECT_VOLUME
+def docker_cmd(project: str, volumes: list[str]) -> list[str]:
+    cmd = ["docker", "run", "--rm"] + util.governor.docker_opts()
+    for vol in volumes:
+        cmd += ["-v", f"{project}_{vol}:{DOCKER_MP_VOLUME}/{project}_{vol}"]
+    cmd += ["-w", DOCKER_MP_VOLUME, DOCKER_IMAGE]
+    return cmd
+
+
+# Fingerprint of each volume without reading file data:
+# SHA-256 of the sorted metadata lines (inode, size, mtime, ctime, mode, path)
+# of all entries, collected by find + stat in one helper container
+# Return volume => hex digest
+def fingerprints(project: str, volumes: list[str]) -> dict[str, str]:
+    cmd = docker_cmd(project, volumes) + ["find", ".", "-exec", "stat", "-c", FINGERPRINT_FORMAT, "{}", "+"]
+    log.info(f"EXEC: {' '.join(cmd)}")
+    lines: dict[str, list[bytes]] = {f"{project}_{vol}": [] for vol in volumes}
+    with util.popen(cmd, stdout=subprocess.PIPE) as proc:
+        try:
+            for line in proc.stdout:
+                # "... ./PROJECT_VOLUME/path"
+                path = line.rstrip(b"\n").split(b" ", 5)[-1]
+                parts = path.split(b"/", 2)
+                if len(parts) >= 2:
+                    name = parts[1].decode(errors="replace")
+                    if name in lines:
+                        lines[name].append(line)
+        except BaseException:
+            proc.kill()
+            raise
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+    result = {}
+    for vol in volumes:
+        h = hashlib.sha256()
+        for line in sorted(lines[f"{project}_{vol}"]):
+            h.update(line)
+        result[vol] = h.hexdigest()
+    return result
+
+
+# Fingerprint of an archive of volumes (Merkle: hash of the volume hashes)
+def combine(volumes: list[str], fps: dict[str, str]) -> str:
+    if len(volumes) == 1:
+        return fps[volumes[0]]
+    h = hashlib.sha256()
+    for vol in volumes:
+        h.update(f"{vol} {fps[vol]}\n".encode())
+    return h.hexdigest()
+
+
+# DST/PROJECT.dockervol.json (next to latest.txt)
+# {"version": 1, "archives": {key: {"fingerprint": ..., "archive": file name}}}
+# key: volume (--per-volume) or "+".join(volumes)
+def state_path(dst: pathlib.Path, project: str) -> pathlib.Path:
+    return dst / f"{project}.dockervol.json"
+
+
+def load_state(path: pathlib.Path) -> dict:
+    if not path.is_file():
+        return {"version": STATE_VERSION, "archives": {}}
+    with path.open() as fin:
+        state = json.load(fin)
+    if state.get("version") != STATE_VERSION:
+        log.warning(f"Unsupported state version (ignored): {path}")
+        return {"version": STATE_VERSION, "archives": {}}
+    return state
+
+
+def save_state(path: pathlib.Path, state: dict):
+    tmp = path.with_name(path.name + ".tmp")
+    with tmp.open("w") as fout:
+        json.dump(state, fout, indent=2)
+    os.replace(tmp, path)
+
+
+# The container writes an uncompressed tar stream to stdout and
+# the host compresses it (busybox tar is single-threaded and supports only a few formats)
+# The file listing is made from the tar stream on the host.
+# Return sha256 hex digest of ar_dst computed in the stream ("" if dry_run)
+def run_tar(
+        project: str, volumes: list[str], ar_dst: pathlib.Path, comp_cmd: list[str], dry_run: bool,
+        listing: catalog.Listing | None = None) -> str:
     ar_dst = ar_dst.absolute()
-    ar_dir = ar_dst.parent
-    ar_name = ar_dst.name
 
     try:
-        cmd = ["docker", "run", "--rm"]
-        # mount destination (bind)
-        cmd += ["-v", f"{ar_dir}:{DOCKER_MP_DEST}"]
-        # mount volumes
-        for vol in vol_names:
-            cmd += ["-v", f"{vol}:{DOCKER_MP_VOLUME}/{vol}"]
-        # image
-        cmd.append(DOCKER_IMAGE)
-
-        # inside the container: sh -c "umask && tar"
-        cmd += ["sh", "-c"]
         # tar command in the container
-        # a: auto detect compression by EXT
         # c: create
-        # f: archive file name
-        inner_cmd = ["umask", "077", "&&"]
-        inner_cmd += ["tar", "acf", f"{DOCKER_MP_DEST}/{ar_name}", "-C", f"{DOCKER_MP_VOLUME}", "."]
-        cmd.append(" ".join(inner_cmd))
-
-        util.exec(cmd, dry_run=dry_run)
-    except subprocess.CalledProcessError as e:
-        if e.returncode == 1:
+        # f -: write to stdout
+        cmd = docker_cmd(project, volumes) + ["tar", "cf", "-", "-C", f"{DOCKER_MP_VOLUME}", "."]
+
+        tap = listing.tar_tap if listing is not None else None
+        (tar_rc, comp_rc), sha256 = util.exec_pipe([cmd, comp_cmd], ar_dst, dry_run=dry_run, check=False, tap=tap)
+        if tar_rc == 1:
             # Warning (Non fatal error(s)).
             log.warning("tar exit with warning(s)")
-        else:
-            raise
+        elif tar_rc != 0:
+            raise subprocess.CalledProcessError(tar_rc, cmd)
+        if comp_rc != 0:
+            raise subprocess.CalledProcessError(comp_rc, comp_cmd)
+    except BaseException:
+        ar_dst.unlink(missing_ok=True)
+        raise
+    return sha256
+
+
+# Archive volumes to ar_dst (+ file listing, checksum sidecar)
+def archive_one(
+        project: str, volumes: list[str], ar_dst: pathlib.Path, comp_cmd: list[str], listing: bool, dry_run: bool):
+    log.info(f"DST: {ar_dst} ({', '.join(volumes)})")
+    lst = catalog.Listing() if listing else None
+    with trace.span("volume", args={"volumes": ", ".join(volumes), "dst": ar_dst.name}):
+        sha256 = run_tar(project, volumes, ar_dst, comp_cmd, dry_run, lst)
+    if lst is not None:
+        lst.write(ar_dst, dry_run)
+    util.write_sidecar(ar_dst, sha256, dry_run)
 
 
 def archive(args: argparse.Namespace):
@@ -56,32 +145,114 @@ def archive(args: argparse.Namespace):
         raise RuntimeError("DST must be a directory")
     log.info(f"mkdir: {dst}")
 
+    if len(set(args.volume)) != len(args.volume):
+        raise RuntimeError("Duplicate --volume")
+    if args.jobs is not None and args.jobs < 1:
+        raise RuntimeError("--jobs must be >= 1")
+
     # datetime
     dt_now = datetime.datetime.now()
     dt_str = dt_now.strftime('%Y%m%d%H%M')
 
-    ar_dst = dst / f"{args.project}_{dt_str}.{EXT}"
-    log.info(f"DST: {ar_dst}")
-    run_tar(args.project, args.volume, ar_dst, args.dry_run)
+    comp = codec.get(args.codec)
+    # (state key, archive file, volumes)
+    if args.per_volume:
+        targets = [(vol, dst / f"{args.project}_{vol}_{dt_str}.{comp.ext}", [vol]) for vol in args.volume]
+    else:
+        targets = [("+".join(args.volume), dst / f"{args.project}_{dt_str}.{comp.ext}", args.volume)]
+
+    # skip archives whose volumes are not changed since the recorded archive
+    spath = state_path(dst, args.project)
+    state = load_state(spath)
+    fps: dict[str, str] = {}
+    # archives of this run (new or not changed)
+    results = [ar_dst for _key, ar_dst, _volumes in targets]
+    if args.skip_unchanged:
+        if args.dry_run:
+            log.info("dry_run: fingerprints are not checked")
+        else:
+            with trace.span("fingerprint"):
+                fps = fingerprints(args.project, args.volume)
+            todo = []
+            for i, (key, ar_dst, volumes) in enumerate(targets):
+                old = state["archives"].get(key)
+                if old is not None and old["fingerprint"] == combine(volumes, fps) and (dst / old["archive"]).is_file():
+                    log.info(f"Not changed: {key} (archive: {old['archive']})")
+                    results[i] = dst / old["archive"]
+                else:
+                    todo.append((key, ar_dst, volumes))
+            targets = todo
+            if not targets:
+                log.info("All volumes are not changed")
+
+    errors = []
+    # nothing to archive: no compressor check, no tar container
+    if targets:
+        jobs = max(min(args.jobs or len(targets), len(targets)), 1)
+        # share the cores between the compressors running at the same time
+        threads = args.threads
+        if threads == 0 and jobs > 1:
+            threads = max(util.governor.compress_threads(0) // jobs, 1)
+        comp_cmd = comp.compress_cmd(args.level, threads)
+        if not args.dry_run:
+            codec.check_installed(comp)
+        log.info(f"Compressor: {' '.join(comp_cmd)}")
+        log.info(f"{len(targets)} archive(s), {jobs} job(s)")
+
+        # docker and the compressors are separate processes: threads only wait for them
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = {
+                executor.submit(metrics.bind(archive_one), args.project, volumes, ar_dst, comp_cmd, not args.no_listing, args.dry_run): (key, ar_dst, volumes)
+                for key, ar_dst, volumes in targets}
+            for future, (key, ar_dst, volumes) in futures.items():
+                try:
+                    future.result()
+                except Exception as e:
+                    log.error(f"Failed: {ar_dst.name}: {e}")
+                    errors.append(ar_dst.name)
+                    continue
+                if fps:
+                    state["archives"][key] = {"fingerprint": combine(volumes, fps), "archive": ar_dst.name}
+    if fps:
+        # fingerprints were taken before the archives (changes during the run are archived next time)
+        save_state(spath, state)
+    if errors:
+        raise RuntimeError(f"{len(errors)} archive(s) failed: {', '.join(errors)}")
 
-    # write ar_dst (not win_ar_dst) to latest.txt
+    # write all archives of this run to latest.txt (upload and cloud send all of them)
+    # (not changed volumes: the previous archive)
     latest = dst / "latest.txt"
     log.info(f"Write the latest archive name: {str(latest)}")
     if not args.dry_run:
         with latest.open("w") as fout:
-            print(ar_dst, file=fout)
-    log.info(f"OK: {ar_dst}")
+            for ar_dst in results:
+                print(ar_dst, file=fout)
+    for ar_dst in results:
+        log.info(f"OK: {ar_dst}")
 
 
 def main(argv: list[str]):
     parser = argparse.ArgumentParser(
         prog=argv[0],
-        description=f"Archive and compress docker volumes ({EXT})",
+        description=f"Archive and compress docker volumes (tar + {', '.join(codec.CODECS)})",
     )
     parser.add_argument("--project", "-p", required=True, help="Docker compose project name")
     parser.add_argument("--volume", "-v", action="append", required=True,
                         help="Docker volume name to back up (excluding project name) (multiple OK)")
     parser.add_argument("--dst", "-d", required=True, help="backup destination dir")
+    parser.add_argument("--codec", "-c", choices=codec.CODECS.keys(), default=codec.DEFAULT,
+                        help=f"compressor (default: {codec.DEFAULT})")
+    parser.add_argument("--level", "-l", type=int, help="compression level (default: codec default)")
+    parser.add_argument("--threads", type=int, default=0,
+                        help="compressor threads of each archive (default: 0 = all cores shared by the jobs)")
+    parser.add_argument("--per-volume", action="store_true",
+                        help="make an archive per volume (PROJECT_VOLUME_DATETIME.EXT) instead of one archive")
+    parser.add_argument("--jobs", "-j", type=int,
+                        help="archives made at the same time with --per-volume (default: all)")
+    parser.add_argument("--skip-unchanged", action="store_true",
+                        help="skip volumes not changed since the last archive (by metadata fingerprint, PROJECT.dockervol.json)")
+    parser.add_argument("--no-listing", action="store_true",
+                        help="do not write the file listing for find (NAME.files.json.gz, hashing all files)")
     parser.add_argument("--dry-run", "-n", action="store_true", help="dry run")
 
     args = parser.parse_args(argv[1:])
@@ -0,0 +1,72 @@
+import logging
+import argparse
+import datetime
+import pathlib
+import time
+from . import catalog, trace
+
+log: logging.Logger = logging.getLogger(__name__)
+
+# Search backed-up files in the catalog (see catalog.py)
+# Archive dirs given by --dst are synced first (only new or changed
+# listings are loaded), then the indexed catalog is queried.
+
+
+def find(args: argparse.Namespace):
+    if args.pattern is None and args.hash is None:
+        raise RuntimeError("PATTERN or --hash is required")
+    dirs = None
+    if args.dst:
+        dirs = []
+        for d in args.dst:
+            dst = pathlib.Path(d).expanduser().resolve()
+            if not dst.is_dir():
+                raise RuntimeError(f"{dst} is not a directory")
+            dirs.append(dst)
+
+    with catalog.Catalog(args.catalog) as cat:
+        for dst in dirs or []:
+            start = time.monotonic()
+            with trace.span("catalog sync", args={"dir": str(dst)}):
+                loaded, deleted = cat.sync(dst)
+            log.info(f"Catalog: {dst}: {loaded} loaded, {deleted} deleted ({time.monotonic() - start:.3f} sec)")
+        start = time.monotonic()
+        rows = cat.find(args.pattern, args.hash, None if dirs is None else [str(d) for d in dirs])
+        elapsed = time.monotonic() - start
+
+    # per path: archives in time order, with the change of the content
+    last_path = None
+    last_digest = None
+    paths = 0
+    for path, _dir, name, size, mtime, digest in rows:
+        if path != last_path:
+            print(path)
+            last_path = path
+            last_digest = None
+            paths += 1
+            status = "added"
+        elif digest is None or last_digest is None:
+            status = "?"
+        else:
+            status = "same" if digest == last_digest else "changed"
+        last_digest = digest
+        mtime_str = datetime.datetime.fromtimestamp(mtime).strftime("%Y-%m-%d %H:%M:%S")
+        print(f"  {name}  {size} bytes  {mtime_str}  {(digest or '-')[:16]}  {status}")
+    log.info(f"{paths} file(s), {len(rows)} version(s) found ({elapsed * 1000:.1f} ms)")
+
+
+def main(argv: list[str]):
+    parser = argparse.ArgumentParser(
+        prog=argv[0],
+        description="Find backed-up files in the archive catalog",
+    )
+    parser.add_argument("pattern", nargs="?",
+                        help="glob pattern of file name (e.g. '*.conf'), or of path if it has '/' (e.g. 'etc/*.conf')")
+    parser.add_argument("--dst", "-d", action="append",
+                        help="archive dir to sync and search (multiple OK) (default: search the whole catalog without sync)")
+    parser.add_argument("--hash", help="find files by sha256")
+    parser.add_argument("--catalog", help="catalog file (default: ~/.cache/bkup/catalog.sqlite3)")
+
+    args = parser.parse_args(argv[1:])
+
+    find(args)
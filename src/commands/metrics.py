@@ -0,0 +1,244 @@
+import logging
+import os
+import contextlib
+import contextvars
+import datetime
+import json
+import platform
+import subprocess
+import threading
+import time
+import typing
+from . import trace
+
+log: logging.Logger = logging.getLogger(__name__)
+
+# Per-stage metrics (a subcommand, or a stage of run)
+# Configured once by bkup.py global options (--metrics, --metrics-prom).
+# * child processes: wall time, CPU time and max RSS (wait4), exit code
+# * counters reported by subcommands (bytes, files, transfers)
+# A record is appended to the JSON lines file when a stage ends, and
+# all stages of the process are written to the Prometheus textfile
+# (node_exporter textfile collector) at exit (and after each run of the
+# daemon subcommand).
+# Disabled (no-op) unless one of the files is configured.
+
+# Counters (reported by subcommands)
+# bytes read from the source (uncompressed)
+INPUT_BYTES = "input_bytes"
+# bytes written to the destination (archive, chunks, restored files)
+OUTPUT_BYTES = "output_bytes"
+# bytes sent by rsync / rclone
+TRANSFERRED_BYTES = "transferred_bytes"
+# bytes deleted by clean (snapshot chunks)
+DELETED_BYTES = "deleted_bytes"
+# files archived, transferred, verified, restored or deleted
+FILES = "files"
+
+
+class Stage:
+    def __init__(self, name: str, command: str):
+        self.name = name
+        self.command = command
+        self.start_time = time.time()
+        self.start = time.monotonic()
+        self.wall = 0.0
+        self.ok: bool | None = None
+        self.counters: dict[str, float] = {}
+        # {"prog", "wall", "user", "sys", "maxrss_kb", "returncode"}
+        self.processes: list[dict] = []
+
+    def record(self) -> dict:
+        record = {
+            "time": datetime.datetime.fromtimestamp(self.start_time).astimezone().isoformat(timespec="seconds"),
+            "host": platform.node(),
+            "stage": self.name,
+            "command": self.command,
+            "ok": self.ok,
+            "wall": round(self.wall, 3),
+            "cpu_user": round(sum(p["user"] for p in self.processes), 3),
+            "cpu_sys": round(sum(p["sys"] for p in self.processes), 3),
+            "counters": dict(self.counters),
+        }
+        # rates and compression ratio
+        for name, value in self.counters.items():
+            if name.endswith("_bytes") and self.wall > 0:
+                record[f"{name[:-len('_bytes')]}_mb_per_sec"] = round(value / self.wall / 1e6, 3)
+        if self.counters.get(INPUT_BYTES) and OUTPUT_BYTES in self.counters:
+            record["ratio"] = round(self.counters[OUTPUT_BYTES] / self.counters[INPUT_BYTES], 4)
+        record["processes"] = self.processes
+        return record
+
+
+_current: contextvars.ContextVar[Stage | None] = contextvars.ContextVar("metrics_stage", default=None)
+
+
+class Recorder:
+    def __init__(self):
+        self.jsonl_path: str | None = None
+        self.prom_path: str | None = None
+        self.lock = threading.Lock()
+        self.stages: list[Stage] = []
+
+    def configure(self, jsonl_path: str | None, prom_path: str | None):
+        self.jsonl_path = jsonl_path
+        self.prom_path = prom_path
+        self.stages = []
+
+    @property
+    def enabled(self) -> bool:
+        return self.jsonl_path is not None or self.prom_path is not None
+
+    # Stage of the caller (None if disabled or outside of stages)
+    # Threads of subcommands run their tasks by bind() to inherit it.
+    def current(self) -> Stage | None:
+        return _current.get() if self.enabled else None
+
+    @contextlib.contextmanager
+    def stage(self, name: str, command: str):
+        if not self.enabled:
+            yield None
+            return
+        st = Stage(name, command)
+        with self.lock:
+            # the latest run of each stage (daemon runs stages repeatedly)
+            self.stages = [s for s in self.stages if s.name != name]
+            self.stages.append(st)
+        token = _current.set(st)
+        try:
+            yield st
+            st.ok = True
+        except SystemExit as e:
+            st.ok = not e.code
+            raise
+        except BaseException:
+            st.ok = False
+            raise
+        finally:
+            _current.reset(token)
+            st.wall = time.monotonic() - st.start
+            self._write_jsonl(st)
+
+    def add(self, name: str, value: float):
+        st = self.current()
+        if st is None:
+            return
+        with self.lock:
+            st.counters[name] = st.counters.get(name, 0) + value
+
+    def process(self, st: Stage | None, prog: str, wall: float, rusage, returncode: int):
+        if st is None:
+            return
+        entry = {
+            "prog": prog,
+            "wall": round(wall, 3),
+            "user": round(rusage.ru_utime, 3),
+            "sys": round(rusage.ru_stime, 3),
+            # KiB on Linux
+            "maxrss_kb": rusage.ru_maxrss,
+            "returncode": returncode,
+        }
+        with self.lock:
+            st.processes.append(entry)
+
+    def _write_jsonl(self, st: Stage):
+        if self.jsonl_path is None:
+            return
+        line = json.dumps(st.record(), separators=(",", ":"))
+        try:
+            with self.lock, open(self.jsonl_path, "a", encoding="utf-8") as fout:
+                print(line, file=fout)
+        except OSError as e:
+            log.warning(f"Metrics write error: {e}")
+
+    # Prometheus text format (all stages of this process)
+    def prom_text(self) -> str:
+        lines = []
+
+        def metric(name: str, help: str, samples: list[tuple[dict, float]]):
+            lines.append(f"# HELP bkup_{name} {help}")
+            lines.append(f"# TYPE bkup_{name} gauge")
+            for labels, value in samples:
+                label_str = ",".join(f'{k}="{_escape(str(v))}"' for k, v in labels.items())
+                lines.append(f"bkup_{name}{{{label_str}}} {value:g}")
+
+        stages = [st for st in self.stages if st.ok is not None]
+        base = [{"stage": st.name, "command": st.command} for st in stages]
+        metric("stage_success", "1 if the stage succeeded",
+               [(b, 1 if st.ok else 0) for b, st in zip(base, stages)])
+        metric("stage_last_run_timestamp_seconds", "start time of the stage",
+               [(b, st.start_time) for b, st in zip(base, stages)])
+        metric("stage_duration_seconds", "wall time of the stage",
+               [(b, st.wall) for b, st in zip(base, stages)])
+        metric("stage_cpu_seconds", "CPU time of the child processes of the stage",
+               [({**b, "mode": mode}, sum(p[mode] for p in st.processes))
+                for b, st in zip(base, stages) for mode in ("user", "sys")])
+        metric("stage_processes", "child processes run by the stage",
+               [(b, len(st.processes)) for b, st in zip(base, stages)])
+        metric("stage_bytes", "bytes processed by the stage",
+               [({**b, "kind": name[:-len("_bytes")]}, value)
+                for b, st in zip(base, stages) for name, value in sorted(st.counters.items()) if name.endswith("_bytes")])
+        metric("stage_files", "files processed by the stage",
+               [(b, st.counters[FILES]) for b, st in zip(base, stages) if FILES in st.counters])
+        return "\n".join(lines) + "\n"
+
+    # Write the Prometheus textfile (atomic for the collector)
+    def finish(self):
+        if self.prom_path is None:
+            return
+        tmp = f"{self.prom_path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as fout:
+                fout.write(self.prom_text())
+            os.replace(tmp, self.prom_path)
+        except OSError as e:
+            log.warning(f"Metrics write error: {e}")
+
+
+def _escape(s: str) -> str:
+    return s.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+recorder = Recorder()
+
+
+# Run fn in the stage of the caller (for tasks submitted to thread pools)
+# (also profiled with --profile)
+def bind(fn: typing.Callable) -> typing.Callable:
+    ctx = contextvars.copy_context()
+    fn = trace.tracer.wrap(fn)
+
+    def run(*args, **kwargs):
+        return ctx.copy().run(fn, *args, **kwargs)
+    return run
+
+
+# Popen which records CPU time and max RSS of the child (wait4)
+# to the metrics and the trace
+# Popen reaps the child in _try_wait() (wait/communicate/with).
+class ObservedPopen(subprocess.Popen):
+    def __init__(self, cmd: list[str], **kwargs):
+        self._metrics_stage = recorder.current()
+        self._metrics_start = time.perf_counter()
+        super().__init__(cmd, **kwargs)
+        self._metrics_prog = os.path.basename(str(cmd[0]))
+
+    def _try_wait(self, wait_flags):
+        try:
+            pid, sts, rusage = os.wait4(self.pid, wait_flags)
+        except ChildProcessError:
+            # already reaped (e.g. by poll()): no rusage
+            return self.pid, 0
+        if pid == self.pid:
+            end = time.perf_counter()
+            returncode = os.waitstatus_to_exitcode(sts)
+            recorder.process(self._metrics_stage, self._metrics_prog, end - self._metrics_start, rusage, returncode)
+            trace.tracer.process(self.pid, self.args, self._metrics_start, end, rusage, returncode)
+        return pid, sts
+
+
+# Popen class for util.popen
+def popen_class() -> type:
+    if (recorder.enabled or trace.tracer.enabled) and hasattr(os, "wait4") and hasattr(subprocess.Popen, "_try_wait"):
+        return ObservedPopen
+    return subprocess.Popen
@@ -0,0 +1,418 @@
+import logging
+import base64
+import concurrent.futures
+import functools
+import http.client
+import json
+import os
+import pathlib
+import secrets
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+import typing
+import urllib.parse
+from . import util, metrics, trace
+
+log: logging.Logger = logging.getLogger(__name__)
+
+# rclone session shared by cloud subcommands
+# One "rclone rcd" (remote control daemon) is started on 127.0.0.1 with a
+# random port and password, and every operation is sent over its HTTP API
+# (keep-alive connection per thread). Remote config parsing, authentication
+# and Fs (directory) cache are done once in the daemon.
+# If the daemon is unavailable, each operation runs an rclone command.
+# The daemon subcommand keeps one rcd running between commands (shared).
+
+# sec
+START_TIMEOUT = 15.0
+QUIT_TIMEOUT = 10.0
+PROGRESS_INTERVAL = 5.0
+
+
+class RcError(RuntimeError):
+    pass
+
+
+def fs_path(remote: str, dst: str) -> str:
+    return f"{remote}:{dst}"
+
+
+class Session:
+    def __init__(self, daemon: bool = True):
+        self.proc: subprocess.Popen | None = None
+        self.port = 0
+        self.auth = ""
+        self.local = threading.local()
+        # all of per-thread connections (to close)
+        self.conns: list[http.client.HTTPConnection] = []
+        self.conns_lock = threading.Lock()
+        # kept running by close() (SharedSession)
+        self.shared = False
+        # core/stats at the last record (stats of the rcd are cumulative)
+        self.stats_base: dict = {}
+        if daemon:
+            try:
+                self._start()
+            except (OSError, http.client.HTTPException, RcError) as e:
+                log.warning(f"rclone rcd is unavailable, use rclone command: {e}")
+                self._stop()
+        log.info(f"rclone session: {'rcd' if self.daemon else 'command'}")
+
+    @property
+    def daemon(self) -> bool:
+        return self.proc is not None
+
+    def _start(self):
+        if shutil.which("rclone") is None:
+            raise RcError("rclone not found")
+        # free port (bind and release)
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+            sock.bind(("127.0.0.1", 0))
+            self.port = sock.getsockname()[1]
+        user = "bkup"
+        password = secrets.token_urlsafe(24)
+        self.auth = "Basic " + base64.b64encode(f"{user}:{password}".encode()).decode()
+        # --rc-serve: read remote files by GET /[remote:dir]/name
+        cmd = ["rclone", "rcd", "--rc-addr", f"127.0.0.1:{self.port}", "--rc-serve", "-q"] + util.governor.rclone_opts()
+        # credentials by the environment: the command line is visible to every user (ps, /proc/PID/cmdline)
+        env = dict(os.environ, RCLONE_RC_USER=user, RCLONE_RC_PASS=password)
+        log.info(f"EXEC: {' '.join(cmd)}")
+        self.proc = util.popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, env=env)
+
+        deadline = time.monotonic() + START_TIMEOUT
+        while True:
+            if self.proc.poll() is not None:
+                raise RcError(f"rclone rcd exited (exit code {self.proc.returncode})")
+            try:
+                self.call("rc/noop")
+                return
+            except (OSError, http.client.HTTPException):
+                if time.monotonic() > deadline:
+                    raise RcError("rclone rcd start timeout") from None
+                time.sleep(0.1)
+
+    def _stop(self):
+        if self.proc is None:
+            return
+        self._record_stats()
+        try:
+            self.call("core/quit")
+        except (OSError, RcError, http.client.HTTPException):
+            pass
+        try:
+            self.proc.wait(timeout=QUIT_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            self.proc.wait()
+        self.proc = None
+        with self.conns_lock:
+            for conn in self.conns:
+                conn.close()
+            self.conns.clear()
+
+    # Transfer stats of the daemon => metrics
+    # (rclone command mode: process stats only)
+    def _record_stats(self):
+        if metrics.recorder.current() is None:
+            return
+        try:
+            stats = self.call("core/stats")
+        except (OSError, RcError, http.client.HTTPException) as e:
+            log.warning(f"rclone stats error: {e}")
+            return
+        metrics.recorder.add(metrics.TRANSFERRED_BYTES, stats.get("bytes", 0) - self.stats_base.get("bytes", 0))
+        metrics.recorder.add(metrics.FILES, stats.get("transfers", 0) - self.stats_base.get("transfers", 0))
+        self.stats_base = stats
+
+    def close(self):
+        if self.shared:
+            self._record_stats()
+            return
+        self._stop()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _conn(self) -> http.client.HTTPConnection:
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = http.client.HTTPConnection("127.0.0.1", self.port)
+            self.local.conn = conn
+            with self.conns_lock:
+                self.conns.append(conn)
+        return conn
+
+    # Return (status, body)
+    def _request(self, method: str, path: str, body: bytes | None, headers: dict) -> tuple[int, bytes]:
+        headers = {**headers, "Authorization": self.auth}
+        retry = True
+        while True:
+            conn = self._conn()
+            try:
+                conn.request(method, path, body, headers)
+                resp = conn.getresponse()
+                return resp.status, resp.read()
+            except (OSError, http.client.HTTPException) as e:
+                # the connection cannot be reused after an error
+                conn.close()
+                self.local.conn = None
+                # retry once on a keep-alive connection closed by the daemon
+                if not retry or not isinstance(e, (ConnectionResetError, BrokenPipeError)):
+                    raise
+                retry = False
+
+    # Call rc API (POST JSON)
+    def call(self, command: str, params: dict | None = None) -> dict:
+        body = json.dumps(params or {}).encode()
+        with trace.span(command, "rclone"):
+            status, data = self._request("POST", f"/{command}", body, {"Content-Type": "application/json"})
+        try:
+            result = json.loads(data) if data else {}
+        except ValueError:
+            result = {"error": data.decode(errors="replace").strip()}
+        if status != 200:
+            raise RcError(f"rclone rc {command}: {result.get('error', status)}")
+        return result
+
+    # Run as an async job and wait (log progress)
+    def call_job(self, command: str, params: dict, progress: bool) -> dict:
+        jobid = self.call(command, {**params, "_async": True})["jobid"]
+        group = f"job/{jobid}"
+        while True:
+            status = self.call("job/status", {"jobid": jobid})
+            if status.get("finished"):
+                break
+            time.sleep(PROGRESS_INTERVAL if progress else 0.5)
+            if progress:
+                stats = self.call("core/stats", {"group": group})
+                log.info(
+                    f"{stats.get('bytes', 0)}/{stats.get('totalBytes', 0)} bytes, "
+                    f"{stats.get('speed', 0) / 1e6:.1f} MB/s")
+        if not status.get("success"):
+            raise RcError(f"rclone rc {command}: {status.get('error')}")
+        return status.get("output") or {}
+
+    # Print total/used/free
+    def about(self, remote: str):
+        if self.daemon:
+            result = self.call("operations/about", {"fs": f"{remote}:"})
+            log.info(", ".join(f"{k}: {v}" for k, v in result.items()))
+        else:
+            util.exec(["rclone", "about", f"{remote}:"])
+
+    def mkdir(self, remote: str, dst: str, dry_run: bool):
+        if self.daemon:
+            log.info(f"mkdir: {fs_path(remote, dst)}")
+            if not dry_run:
+                self.call("operations/mkdir", {"fs": fs_path(remote, dst), "remote": ""})
+        else:
+            util.exec(["rclone", "mkdir", fs_path(remote, dst)], dry_run=dry_run)
+
+    # Hash types supported by the remote (e.g. "md5", "sha1")
+    def hash_types(self, remote: str) -> list[str]:
+        if self.daemon:
+            features = self.call("operations/fsinfo", {"fs": f"{remote}:"})
+        else:
+            features = json.loads(util.exec_out(["rclone", "backend", "features", f"{remote}:"]))
+        return features.get("Hashes") or []
+
+    # Call on_entry with lsjson entries of files in remote:dst (not recursive)
+    # includes: name filter applied by rclone
+    # hash_type: add "Hashes": {hash_type: hex} (computed by the remote if needed)
+    def list_files(
+            self, remote: str, dst: str, includes: list[str], on_entry: typing.Callable[[dict], None],
+            hash_type: str | None = None):
+        if self.daemon:
+            opt = {"filesOnly": True, "noMimeType": True}
+            if hash_type is not None:
+                opt |= {"showHash": True, "hashTypes": [hash_type]}
+            result = self.call("operations/list", {
+                "fs": fs_path(remote, dst), "remote": "", "opt": opt,
+                "_filter": {"IncludeRule": includes},
+            })
+            for entry in result["list"]:
+                on_entry(entry)
+            return
+
+        # one entry per line (parse while reading)
+        cmd = ["rclone", "lsjson", fs_path(remote, dst), "--files-only", "--no-mimetype"]
+        if hash_type is not None:
+            cmd += ["--hash", "--hash-type", hash_type]
+        for pattern in includes:
+            cmd += ["--include", pattern]
+        decoder = json.JSONDecoder()
+
+        def on_line(line: str):
+            line = line.strip().rstrip(",")
+            if line in ("", "[", "]"):
+                return
+            on_entry(decoder.raw_decode(line)[0])
+
+        util.exec_lines(cmd, on_line)
+
+    # Concatenated contents of small files remote:dst/names (missing files are ignored)
+    def cat_files(self, remote: str, dst: str, names: list[str]) -> str:
+        if not names:
+            return ""
+        if self.daemon:
+            texts = []
+            for name in names:
+                path = "/" + urllib.parse.quote(f"[{fs_path(remote, dst)}]/{name}", safe="[]:/")
+                status, data = self._request("GET", path, None, {})
+                if status == 200:
+                    texts.append(data.decode("utf-8", errors="replace"))
+                elif status != 404:
+                    raise RcError(f"rclone rc GET {path}: {status}")
+            return "".join(texts)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            list_path = pathlib.Path(tmpdir) / "files.txt"
+            with list_path.open("w", encoding="utf-8", newline="\n") as fout:
+                for name in names:
+                    fout.write(f"{name}\n")
+            return util.exec_out([
+                "rclone", "cat", fs_path(remote, dst), "--files-from-raw", str(list_path), "--max-depth", "1"])
+
+    # Copy a local file into remote:dst
+    def copy_file(self, src: pathlib.Path, remote: str, dst: str, progress: bool, dry_run: bool):
+        if self.daemon:
+            log.info(f"copy: {src} => {fs_path(remote, dst)}")
+            if not dry_run:
+                self.call_job("operations/copyfile", {
+                    "srcFs": str(src.parent), "srcRemote": src.name,
+                    "dstFs": fs_path(remote, dst), "dstRemote": src.name,
+                }, progress)
+            return
+
+        cmd = ["rclone", "copy", str(src), fs_path(remote, dst)] + util.governor.rclone_opts()
+        if progress:
+            cmd += ["-P"]
+        if dry_run:
+            cmd += ["-n"]
+        util.exec(cmd)
+
+    # Copy local files src/names into remote:dst, transfers files at the same time
+    # (--bwlimit is the total of all transfers in both modes)
+    def copy_files(
+            self, src: pathlib.Path, names: list[str], remote: str, dst: str,
+            transfers: int, progress: bool, dry_run: bool):
+        if not names:
+            return
+        if self.daemon:
+            def run(name: str):
+                self.copy_file(src / name, remote, dst, False, dry_run)
+                log.info(f"copied: {name}")
+
+            with concurrent.futures.ThreadPoolExecutor(max_workers=transfers) as executor:
+                futures = [executor.submit(metrics.bind(run), name) for name in names]
+                errors = [f.exception() for f in futures if f.exception() is not None]
+            for e in errors:
+                log.error(f"copy failed: {e}")
+            if errors:
+                raise RuntimeError(f"{len(errors)} copy(s) failed")
+            return
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            list_path = pathlib.Path(tmpdir) / "files.txt"
+            with list_path.open("w", encoding="utf-8", newline="\n") as fout:
+                for name in names:
+                    fout.write(f"{name}\n")
+            cmd = [
+                "rclone", "copy", str(src), fs_path(remote, dst), "--files-from-raw", str(list_path),
+                "--transfers", str(transfers), "-v"] + util.governor.rclone_opts()
+            if progress:
+                cmd += ["-P"]
+            if dry_run:
+                cmd += ["-n"]
+            util.exec(cmd)
+
+    # Delete files in remote:dst
+    # daemon: concurrent deletefile calls, command: batched --files-from-raw
+    def delete_files(self, remote: str, dst: str, names: list[str], jobs: int, dry_run: bool):
+        if not names:
+            return
+        with tempfile.TemporaryDirectory() as tmpdir:
+            if self.daemon:
+                tasks = [functools.partial(self._delete_file, remote, dst, name, dry_run) for name in names]
+            else:
+                batches = [names[i::jobs] for i in range(min(jobs, len(names)))]
+                tasks = [
+                    functools.partial(self._delete_batch, remote, dst, batch, pathlib.Path(tmpdir) / f"delete{i}.txt", dry_run)
+                    for i, batch in enumerate(batches)]
+
+            with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+                futures = [executor.submit(metrics.bind(task)) for task in tasks]
+                errors = [f.exception() for f in futures if f.exception() is not None]
+        for e in errors:
+            log.error(f"delete failed: {e}")
+        if errors:
+            raise RuntimeError(f"{len(errors)} delete(s) failed")
+
+    def _delete_file(self, remote: str, dst: str, name: str, dry_run: bool):
+        log.info(f"delete: {fs_path(remote, dst)}/{name}")
+        if not dry_run:
+            self.call("operations/deletefile", {"fs": fs_path(remote, dst), "remote": name})
+
+    def _delete_batch(self, remote: str, dst: str, names: list[str], list_path: pathlib.Path, dry_run: bool):
+        with list_path.open("w", encoding="utf-8", newline="\n") as fout:
+            for name in names:
+                fout.write(f"{name}\n")
+        cmd = [
+            "rclone", "delete", fs_path(remote, dst), "--files-from-raw", str(list_path),
+            "--max-depth", "1", "-v"]
+        util.exec(cmd, dry_run=dry_run)
+
+
+def add_arguments(parser):
+    parser.add_argument("--no-rcd", action="store_true", help="run rclone command per operation instead of rclone rcd")
+
+
+# One rcd shared by commands of the process (daemon subcommand)
+# Sessions are thread safe, so concurrent stages use the same rcd.
+# Remote config parsing, authentication and Fs cache stay warm between runs.
+class SharedSession:
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.session: Session | None = None
+
+    def get(self) -> Session:
+        with self.lock:
+            session = self.session
+            if session is not None and session.proc is not None and session.proc.poll() is not None:
+                log.warning(f"shared rclone rcd exited (exit code {session.proc.returncode}), restart")
+                session.shared = False
+                session.close()
+                session = self.session = None
+            if session is None:
+                session = Session(daemon=True)
+                if not session.daemon:
+                    # command mode, try rcd again next time
+                    return session
+                session.shared = True
+                self.session = session
+            return session
+
+    def close(self):
+        with self.lock:
+            if self.session is not None:
+                self.session.shared = False
+                self.session.close()
+                self.session = None
+
+
+shared = SharedSession()
+
+
+# Session of a command (the shared rcd if enabled)
+def session(daemon: bool = True) -> Session:
+    if daemon and shared.enabled:
+        return shared.get()
+    return Session(daemon=daemon)
@@ -0,0 +1,278 @@
+import logging
+import argparse
+import bisect
+import collections
+import concurrent.futures
+import mmap
+import os
+import pathlib
+import posixpath
+import subprocess
+import sys
+import tarfile
+import typing
+from . import util, codec, tarengine, snapshot, retention, metrics, trace
+
+log: logging.Logger = logging.getLogger(__name__)
+
+# Restore files from archives made by archive / dockervol / snapshot
+# * seekable archives (python engine, with the index NAME.idx.json.gz):
+#   only the frames which contain the selected files are decompressed,
+#   in worker processes (all frames in parallel for a full restore)
+# * other tar archives: tar + decompressor
+#   (incremental archives are restored from the full archive of the chain)
+# * snapshot manifests: chunks of the selected files
+
+# tar extraction filter (Python 3.12+, and security updates of older versions)
+EXTRACT_OPTS: dict = {"filter": "tar"} if hasattr(tarfile, "tar_filter") else {}
+
+
+# Worker process
+def _decompress(name: str, data: bytes) -> bytes:
+    return codec.decompress_block(name, data)
+
+
+# "dir/file", "./dir/file/" => "dir/file"
+def normalize(path: str) -> str:
+    p = posixpath.normpath(path.replace("\\", "/")).lstrip("/")
+    if p in ("", ".") or p == ".." or p.startswith("../"):
+        raise RuntimeError(f"Invalid path: {path}")
+    return p
+
+
+# Tar stream ranges [start, end) of the selected members (adjacent ranges are merged)
+# Return (ranges, number of members)
+def select_ranges(members: list[list], paths: list[str] | None) -> tuple[list[list[int]], int]:
+    ranges: list[list[int]] = []
+    count = 0
+    for name, start, end in members:
+        rpath = posixpath.normpath(name)
+        if paths is not None and (rpath == "." or not snapshot.path_selected(rpath, paths)):
+            continue
+        count += 1
+        if ranges and ranges[-1][1] == start:
+            ranges[-1][1] = end
+        else:
+            ranges.append([start, end])
+    return ranges, count
+
+
+class StreamReader:
+    # file-like object (read only) over an iterator of bytes
+    def __init__(self, chunks: typing.Iterator[bytes]):
+        self.chunks = chunks
+        self.cur = b""
+        self.pos = 0
+        # bytes read
+        self.size = 0
+
+    def read(self, size: int = -1) -> bytes:
+        parts = []
+        while size != 0:
+            if self.pos >= len(self.cur):
+                self.cur = next(self.chunks, b"")
+                self.pos = 0
+                if not self.cur:
+                    break
+            n = len(self.cur) - self.pos if size < 0 else min(size, len(self.cur) - self.pos)
+            parts.append(self.cur[self.pos:self.pos + n])
+            self.pos += n
+            self.size += n
+            if size > 0:
+                size -= n
+        return b"".join(parts)
+
+
+# Yield bytes of ranges in the tar stream
+# Frames are decompressed by executor (at most max_inflight frames in memory)
+def indexed_chunks(
+        buf: mmap.mmap, comp_name: str, frames: list[list[int]], ranges: list[list[int]],
+        executor: concurrent.futures.Executor, max_inflight: int) -> typing.Iterator[bytes]:
+    # frames which overlap the ranges
+    starts = [f[0] for f in frames]
+    needed: list[int] = []
+    for start, end in ranges:
+        i = max(bisect.bisect_right(starts, start) - 1, 0)
+        while i < len(frames) and frames[i][0] < end:
+            if not needed or needed[-1] < i:
+                needed.append(i)
+            i += 1
+    log.info(f"Decompress {len(needed)}/{len(frames)} frames")
+
+    inflight: collections.deque = collections.deque()
+    ri = 0
+    pending = iter(needed)
+    while True:
+        for i in pending:
+            _tar_off, _tar_size, off, size = frames[i]
+            inflight.append((i, executor.submit(_decompress, comp_name, buf[off:off + size])))
+            if len(inflight) >= max_inflight:
+                break
+        if not inflight:
+            return
+        i, future = inflight.popleft()
+        tar_off, tar_size, _off, _size = frames[i]
+        data = future.result()
+        if len(data) != tar_size:
+            raise RuntimeError(f"Broken frame {i}: {len(data)} bytes (expected {tar_size})")
+        tar_end = tar_off + tar_size
+        while ri < len(ranges) and ranges[ri][0] < tar_end:
+            start, end = ranges[ri]
+            if max(start, tar_off) < min(end, tar_end):
+                yield data[max(start, tar_off) - tar_off:min(end, tar_end) - tar_off]
+            if end > tar_end:
+                break
+            ri += 1
+
+
+def extract_stream(fin: typing.BinaryIO, out: pathlib.Path) -> int:
+    with tarfile.open(fileobj=fin, mode="r|") as tf:
+        tf.extractall(out, **EXTRACT_OPTS)
+        return len(tf.getmembers())
+
+
+def restore_indexed(archive: pathlib.Path, index: dict, out: pathlib.Path, paths: list[str] | None, jobs: int):
+    ranges, count = select_ranges(index["members"], paths)
+    if count == 0:
+        raise RuntimeError(f"Not found in the archive: {', '.join(paths or [])}")
+    log.info(f"Seekable archive: {count}/{len(index['members'])} members selected")
+
+    with (archive.open("rb") as fin,
+            mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ) as buf,
+            concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor):
+        chunks = indexed_chunks(buf, index["codec"], index["frames"], ranges, executor, max_inflight=jobs * 2)
+        reader = StreamReader(chunks)
+        extracted = extract_stream(reader, out)
+    log.info(f"Restored {extracted} entries")
+    metrics.recorder.add(metrics.INPUT_BYTES, reader.size)
+    metrics.recorder.add(metrics.FILES, extracted)
+
+
+# Full archive and incremental archives up to archive (in order)
+def incremental_chain(archive: pathlib.Path) -> list[pathlib.Path]:
+    prefix, kind = retention.group_of(archive.name)
+    if kind == "":
+        return [archive]
+    ext = archive.name.split(".", maxsplit=1)[1]
+    dt = util.name_parse(archive)[1]
+    history = []
+    for p in filter(util.name_filter, archive.parent.iterdir()):
+        p_prefix, p_kind = retention.group_of(p.name)
+        p_dt = util.name_parse(p)[1]
+        if p_prefix == prefix and p_kind != "" and p.name.split(".", maxsplit=1)[1] == ext and p_dt <= dt:
+            history.append((p_dt, p_kind, p))
+    history.sort(key=lambda h: (h[0], h[1] != "full"))
+    fulls = [i for i, (_dt, p_kind, _p) in enumerate(history) if p_kind == "full"]
+    if not fulls:
+        raise RuntimeError(f"Full archive of {archive.name} not found")
+    return [p for _dt, _kind, p in history[fulls[-1]:]]
+
+
+# tar messages of members not in the archive (GNU tar / bsdtar, LC_ALL=C)
+TAR_NOT_FOUND = ": Not found in archive"
+TAR_SUMMARY = ("tar: Exiting with failure status due to previous errors", "tar: Error exit delayed from previous errors.")
+
+
+# Run tar -x and return members which are not in the archive
+# Any other error of tar (read error, corrupt archive, disk full, ...) is raised.
+def extract_tar(cmd: list[str], dry_run: bool) -> set[str]:
+    log.info(f"EXEC: {' '.join(cmd)}")
+    if dry_run:
+        log.info("dry_run")
+        return set()
+    # the messages are parsed: no translation
+    env = dict(os.environ, LC_ALL="C")
+    env.pop("LANGUAGE", None)
+    not_found = set()
+    errors = 0
+    with util.popen(cmd, text=True, errors="replace", stderr=subprocess.PIPE, env=env) as proc:
+        try:
+            for line in proc.stderr:
+                line = line.rstrip("\n")
+                if line.endswith(TAR_NOT_FOUND):
+                    not_found.add(line.removeprefix("tar: ").removesuffix(TAR_NOT_FOUND))
+                elif line not in TAR_SUMMARY:
+                    errors += 1
+                    print(line, file=sys.stderr, flush=True)
+        except BaseException:
+            proc.kill()
+            raise
+    if proc.returncode != 0 and (errors or not not_found):
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+    return not_found
+
+
+def restore_tar(archive: pathlib.Path, out: pathlib.Path, paths: list[str] | None, dry_run: bool):
+    comp = codec.by_name(archive.name)
+    if comp is None:
+        raise RuntimeError(f"Unsupported archive: {archive.name} (tar archives and snapshots are supported)")
+    if not dry_run:
+        codec.check_installed(comp)
+    incremental = retention.group_of(archive.name)[1] != ""
+    chain = incremental_chain(archive)
+    # members are "./path"
+    members = [f"./{path}" for path in paths or []]
+    # members not in any archive of the chain
+    missing = set(members)
+    for p in chain:
+        log.info(f"Extract {p.name}")
+        cmd = ["tar", "-C", str(out), "-xf", str(p), f"--use-compress-program={comp.dprog}"]
+        if incremental:
+            # GNU incremental: also delete files which had been deleted at the time of the archive
+            cmd += ["--listed-incremental=/dev/null"]
+        cmd += members
+        # unchanged files are not in incremental archives ("Not found in archive")
+        missing &= extract_tar(cmd, dry_run)
+    if missing:
+        raise RuntimeError(f"Not found in the archive: {', '.join(sorted(m.removeprefix('./') for m in missing))}")
+
+
+def restore(args: argparse.Namespace):
+    src = pathlib.Path(args.src).expanduser().resolve()
+    if src.is_dir():
+        latest_files = util.read_latest(src)
+        if len(latest_files) > 1:
+            raise RuntimeError(f"Several latest archives in {src}: specify one of them")
+        src = latest_files[0]
+    if not src.is_file():
+        raise RuntimeError(f"{src} is not a valid file")
+    out = pathlib.Path(args.dst).expanduser().resolve()
+    paths = [normalize(p) for p in args.paths] if args.paths else None
+    jobs = args.jobs if args.jobs is not None else util.governor.compress_threads(0)
+    if jobs < 1:
+        raise RuntimeError("--jobs must be >= 1")
+    log.info(f"SRC: {src}")
+    log.info(f"DST: {out}")
+    if paths is not None:
+        log.info(f"Paths: {', '.join(paths)}")
+
+    if not args.dry_run:
+        out.mkdir(parents=True, exist_ok=True)
+    if src.name.endswith(f".{snapshot.EXT}"):
+        if not args.dry_run:
+            with trace.span("snapshot restore"):
+                snapshot.restore(src.parent, src, out, paths, jobs)
+    else:
+        index = tarengine.load_index(src)
+        if index is None:
+            restore_tar(src, out, paths, args.dry_run)
+        elif not args.dry_run:
+            with trace.span("indexed restore"):
+                restore_indexed(src, index, out, paths, jobs)
+    log.info("OK")
+
+
+def main(argv: list[str]):
+    parser = argparse.ArgumentParser(
+        prog=argv[0],
+        description="Restore files from an archive file or a snapshot",
+    )
+    parser.add_argument("--src", "-s", required=True, help="archive file, snapshot file, or dir (the latest one)")
+    parser.add_argument("--dst", "-d", required=True, help="restore destination dir")
+    parser.add_argument("--jobs", "-j", type=int, help="decompression worker processes (default: all cores)")
+    parser.add_argument("--dry-run", "-n", action="store_true", help="dry run")
+    parser.add_argument("paths", nargs="*", help="files or dirs to restore (relative to SRC of archive) (default: all)")
+
+    args = parser.parse_args(argv[1:])
+
+    restore(args)
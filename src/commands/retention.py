@@ -0,0 +1,181 @@
+import logging
+import datetime
+import time
+import typing
+from . import util, snapshot
+
+log: logging.Logger = logging.getLogger(__name__)
+
+# Retention planner for archive files (clean, cloudclean)
+# An archive is kept if any of the rules keeps it:
+#   count:   the latest N archives
+#   days:    archives not older than N days
+#   daily/weekly/monthly (grandfather-father-son):
+#            the latest archive of each of the latest N days/weeks/months
+# With per_group, count and GFS rules are applied per tag_host group.
+# A kept incremental archive also keeps its chain back to the full archive.
+
+TIME_SOURCES = ["mtime", "name"]
+# archive.KIND_FULL, archive.KIND_INC (avoid circular import)
+_KIND_FULL = "full"
+_KIND_INC = "inc"
+_NAME_TIME_FORMATS = {8: "%Y%m%d", 12: "%Y%m%d%H%M", 14: "%Y%m%d%H%M%S"}
+
+
+class Entry(typing.NamedTuple):
+    name: str
+    # UNIX time
+    time: float
+
+
+class Policy(typing.NamedTuple):
+    keep_count: int | None = None
+    keep_days: int | None = None
+    keep_daily: int | None = None
+    keep_weekly: int | None = None
+    keep_monthly: int | None = None
+    per_group: bool = False
+
+    def check(self):
+        if all(v is None for v in self[:5]):
+            raise RuntimeError("At least one condition is needed")
+        for name, v in zip(self._fields[:5], self[:5]):
+            if v is not None and v < 0:
+                raise RuntimeError(f"--{name.replace('_', '-')} must be >= 0")
+
+
+class Decision(typing.NamedTuple):
+    entry: Entry
+    # empty: delete
+    reasons: list[str]
+
+    @property
+    def keep(self) -> bool:
+        return bool(self.reasons)
+
+
+# Archive or snapshot manifest name => (body, datetime)
+def _name_parse(name: str) -> tuple[str, str] | None:
+    return util.name_parse_str(name) or snapshot.manifest_parse_str(name)
+
+
+# Archive time from the YYYYMMDD[hhmm[ss]] part of the name (local time)
+def name_time(name: str) -> float | None:
+    parsed = _name_parse(name)
+    if parsed is None:
+        return None
+    fmt = _NAME_TIME_FORMATS.get(len(parsed[1]))
+    if fmt is None:
+        return None
+    try:
+        return datetime.datetime.strptime(parsed[1], fmt).timestamp()
+    except ValueError:
+        return None
+
+
+# tag_host (without _full/_inc) and kind ("full", "inc" or "")
+def group_of(name: str) -> tuple[str, str]:
+    parsed = _name_parse(name)
+    body = parsed[0] if parsed is not None else name
+    for kind in (_KIND_FULL, _KIND_INC):
+        if body.endswith(f"_{kind}"):
+            return body[:-len(kind) - 1], kind
+    return body, ""
+
+
+def _bucket_rules(policy: Policy) -> list[tuple[str, int, typing.Callable[[datetime.datetime], str]]]:
+    rules = []
+    if policy.keep_daily is not None:
+        rules.append(("daily", policy.keep_daily, lambda d: d.strftime("%Y-%m-%d")))
+    if policy.keep_weekly is not None:
+        rules.append(("weekly", policy.keep_weekly, lambda d: "{0}-W{1:02}".format(*d.isocalendar())))
+    if policy.keep_monthly is not None:
+        rules.append(("monthly", policy.keep_monthly, lambda d: d.strftime("%Y-%m")))
+    return rules
+
+
+# entries: sorted by time (newer first)
+def _plan_group(entries: list[Entry], policy: Policy, reasons: dict[str, list[str]]):
+    if policy.keep_count is not None:
+        for i, e in enumerate(entries[:policy.keep_count]):
+            reasons[e.name].append(f"count {i + 1}")
+
+    for rule, n, key in _bucket_rules(policy):
+        seen: set[str] = set()
+        for e in entries:
+            if len(seen) >= n:
+                break
+            bucket = key(datetime.datetime.fromtimestamp(e.time))
+            if bucket not in seen:
+                seen.add(bucket)
+                reasons[e.name].append(f"{rule} {bucket}")
+
+
+# Keep the chain of a kept incremental archive (back to the full archive)
+# entries: one group, sorted by time (newer first)
+def _keep_chain(entries: list[Entry], reasons: dict[str, list[str]]):
+    needed = False
+    for e in entries:
+        kind = group_of(e.name)[1]
+        if needed and not reasons[e.name]:
+            reasons[e.name].append("chain")
+        if kind == _KIND_INC:
+            needed = needed or bool(reasons[e.name])
+        else:
+            needed = False
+
+
+def plan(entries: typing.Iterable[Entry], policy: Policy, now: float | None = None) -> list[Decision]:
+    policy.check()
+    now = time.time() if now is None else now
+    # newer first
+    entries = sorted(entries, key=lambda e: (e.time, e.name), reverse=True)
+    reasons: dict[str, list[str]] = {e.name: [] for e in entries}
+
+    if policy.keep_days is not None:
+        for e in entries:
+            days = (now - e.time) / (24 * 60 * 60)
+            if days <= policy.keep_days:
+                reasons[e.name].append(f"days {int(days)}")
+
+    groups: dict[str, list[Entry]] = {}
+    for e in entries:
+        groups.setdefault(group_of(e.name)[0], []).append(e)
+    if policy.per_group:
+        for group in groups.values():
+            _plan_group(group, policy, reasons)
+    else:
+        _plan_group(entries, policy, reasons)
+    for group in groups.values():
+        _keep_chain(group, reasons)
+
+    return [Decision(e, reasons[e.name]) for e in entries]
+
+
+def print_plan(decisions: list[Decision]):
+    for d in decisions:
+        if d.keep:
+            log.info(f"Keep ({', '.join(d.reasons)}): {d.entry.name}")
+        else:
+            log.info(f"Delete: {d.entry.name}")
+    delete = sum(1 for d in decisions if not d.keep)
+    log.info(f"Plan: {len(decisions) - delete} keep, {delete} delete")
+
+
+def add_arguments(parser):
+    parser.add_argument("--keep-count", type=int, help="keep the latest N files")
+    parser.add_argument("--keep-days", type=int, help="keep files not expired")
+    parser.add_argument("--keep-daily", type=int, help="keep the latest file of each of the latest N days")
+    parser.add_argument("--keep-weekly", type=int, help="keep the latest file of each of the latest N weeks")
+    parser.add_argument("--keep-monthly", type=int, help="keep the latest file of each of the latest N months")
+    parser.add_argument("--per-group", action="store_true", help="apply --keep-count and GFS rules per tag_host")
+    parser.add_argument(
+        "--time-source", choices=TIME_SOURCES, default="mtime",
+        help="file time: mtime or YYYYMMDD[hhmm[ss]] in the name (no stat, fallback: mtime)")
+
+
+def policy_from_args(args) -> Policy:
+    return Policy(
+        keep_count=args.keep_count, keep_days=args.keep_days,
+        keep_daily=args.keep_daily, keep_weekly=args.keep_weekly, keep_monthly=args.keep_monthly,
+        per_group=args.per_group)
@@ -0,0 +1,264 @@
+import logging
+import argparse
+import pathlib
+import json
+import time
+import threading
+import contextlib
+import concurrent.futures
+from . import util, metrics, trace
+
+log: logging.Logger = logging.getLogger(__name__)
+
+# Config file (TOML or JSON)
+#
+# [[job]]
+# name = "home"
+#
+# [[job.stage]]
+# name = "archive"
+# cmd = ["archive", "--src", "~/data", "--dst", "/backup"]
+#
+# [[job.stage]]
+# name = "clean"
+# cmd = ["clean", "--dst", "/backup", "--keep-count", "10"]
+# # dependencies (stage name in the same job or "job/stage")
+# # default: the previous stage in the job
+# after = []
+# # resources used by the stage (default: by subcommand, see DEFAULT_RESOURCES)
+# resources = ["net"]
+#
+# # max stages using a resource at the same time (default: no limit)
+# [limits]
+# cpu = 1
+# net = 2
+
+# Resources used by subcommands
+# (cpu: compression and hashing, io: local disk, net: remote host or cloud)
+DEFAULT_RESOURCES = {
+    "sync": ["io"],
+    "clean": ["io"],
+    "archive": ["cpu", "io"],
+    "snapshot": ["cpu", "io"],
+    "dockervol": ["cpu", "io"],
+    "verify": ["cpu", "io"],
+    "restore": ["cpu", "io"],
+    "find": [],
+    "upload": ["net"],
+    "cloud": ["net"],
+    "cloudclean": ["net"],
+    "cloudsetup": ["net"],
+}
+
+
+class Stage:
+    def __init__(self, job: str, name: str, argv: list[str], after: list[str], resources: list[str] | None = None):
+        self.id = f"{job}/{name}"
+        self.job = job
+        self.argv = argv
+        self.after = after
+        self.resources = resources if resources is not None else DEFAULT_RESOURCES.get(argv[0], [])
+        # None (not yet), "ok", "failed", "skipped"
+        self.result: str | None = None
+        self.elapsed = 0.0
+
+
+def load_config(path: pathlib.Path) -> dict:
+    if path.suffix == ".json":
+        with path.open() as fin:
+            return json.load(fin)
+    try:
+        import tomllib
+    except ImportError:
+        raise RuntimeError("TOML config requires Python 3.11+ (use JSON config)") from None
+    with path.open("rb") as fin:
+        return tomllib.load(fin)
+
+
+def parse_stages(config: dict, command_names: set[str]) -> dict[str, Stage]:
+    stages: dict[str, Stage] = {}
+    for job in config.get("job", []):
+        jname = job["name"]
+        prev: str | None = None
+        for st in job.get("stage", []):
+            cmd = st["cmd"]
+            if not cmd or cmd[0] not in command_names:
+                raise RuntimeError(f"{jname}/{st.get('name')}: unknown subcommand: {cmd[:1]}")
+            if cmd[0] in ("run", "daemon"):
+                raise RuntimeError(f"{jname}/{st.get('name')}: {cmd[0]} cannot be nested")
+            if "after" in st:
+                after = [a if "/" in a else f"{jname}/{a}" for a in st["after"]]
+            else:
+                after = [prev] if prev is not None else []
+            resources = st.get("resources")
+            if resources is not None and not (isinstance(resources, list) and all(isinstance(r, str) for r in resources)):
+                raise RuntimeError(f"{jname}/{st.get('name')}: resources must be a list of names")
+            stage = Stage(jname, st.get("name", cmd[0]), cmd, after, resources)
+            if stage.id in stages:
+                raise RuntimeError(f"Duplicate stage: {stage.id}")
+            stages[stage.id] = stage
+            prev = stage.id
+
+    for stage in stages.values():
+        for dep in stage.after:
+            if dep not in stages:
+                raise RuntimeError(f"{stage.id}: unknown dependency: {dep}")
+    check_cycle(stages)
+
+    return stages
+
+
+def check_cycle(stages: dict[str, Stage]):
+    done: set[str] = set()
+    visiting: set[str] = set()
+
+    def visit(sid: str):
+        if sid in done:
+            return
+        if sid in visiting:
+            raise RuntimeError(f"Dependency cycle: {sid}")
+        visiting.add(sid)
+        for dep in stages[sid].after:
+            visit(dep)
+        visiting.remove(sid)
+        done.add(sid)
+
+    for sid in stages:
+        visit(sid)
+
+
+# Max concurrent stages per resource
+# A stage takes all of its resources at once (no deadlock between stages
+# waiting for each other's resources).
+class Limits:
+    def __init__(self, limits: dict[str, int]):
+        for name, limit in limits.items():
+            if not isinstance(limit, int) or limit < 1:
+                raise RuntimeError(f"Invalid limit: {name} = {limit!r} (integer >= 1)")
+        self.limits = dict(limits)
+        self.used = {name: 0 for name in limits}
+        self.waiting = {name: 0 for name in limits}
+        self.cond = threading.Condition()
+
+    @contextlib.contextmanager
+    def hold(self, resources: list[str]):
+        names = sorted(set(r for r in resources if r in self.limits))
+        if not names:
+            yield
+            return
+        with self.cond:
+            for name in names:
+                self.waiting[name] += 1
+            self.cond.wait_for(lambda: all(self.used[n] < self.limits[n] for n in names))
+            for name in names:
+                self.waiting[name] -= 1
+                self.used[name] += 1
+        try:
+            yield
+        finally:
+            with self.cond:
+                for name in names:
+                    self.used[name] -= 1
+                self.cond.notify_all()
+
+    def status(self) -> dict:
+        with self.cond:
+            return {name: {"limit": limit, "used": self.used[name], "waiting": self.waiting[name]}
+                    for name, limit in self.limits.items()}
+
+
+def run_stage(func, stage: Stage, limits: Limits | None = None) -> bool:
+    threading.current_thread().name = stage.id
+    with limits.hold(stage.resources) if limits is not None else contextlib.nullcontext():
+        log.info(f"[{stage.id}] START: {' '.join(stage.argv)}")
+        start = time.monotonic()
+        try:
+            with metrics.recorder.stage(stage.id, stage.argv[0]), trace.span(stage.id, "stage", {"argv": " ".join(stage.argv)}):
+                func(stage.argv)
+            ok = True
+        except SystemExit as e:
+            # argparse error or sys.exit()
+            ok = not e.code
+        except Exception:
+            log.exception(f"[{stage.id}] error")
+            ok = False
+        stage.elapsed = time.monotonic() - start
+    log.info(f"[{stage.id}] {'OK' if ok else 'FAILED'} ({stage.elapsed:.1f} sec)")
+    return ok
+
+
+# Run stages in dependency order, independent stages in parallel
+def run_dag(stages: dict[str, Stage], funcs: dict, jobs: int, limits: Limits | None = None):
+    running: dict[concurrent.futures.Future, Stage] = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        while True:
+            for stage in stages.values():
+                if stage.result is not None or stage in running.values():
+                    continue
+                deps = [stages[d].result for d in stage.after]
+                if any(r in ("failed", "skipped") for r in deps):
+                    log.warning(f"[{stage.id}] skipped (dependency failed)")
+                    stage.result = "skipped"
+                elif all(r == "ok" for r in deps):
+                    running[executor.submit(metrics.bind(run_stage), funcs[stage.argv[0]], stage, limits)] = stage
+            if not running:
+                # skipped stages may make others skippable
+                if all(s.result is not None for s in stages.values()):
+                    break
+                continue
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                stage = running.pop(future)
+                stage.result = "ok" if future.result() else "failed"
+
+
+def run(args: argparse.Namespace):
+    # import here: commands/__init__ imports this module
+    from . import command_table
+    funcs = {name: func for func, name, _desc in command_table}
+
+    config = load_config(pathlib.Path(args.config).expanduser())
+    stages = parse_stages(config, set(funcs))
+    limits = Limits(config.get("limits", {}))
+    if not stages:
+        raise RuntimeError("No stage in config")
+    log.info(f"{len(stages)} stage(s)")
+    for stage in stages.values():
+        log.info(f"  {stage.id}: {' '.join(stage.argv)} (after: {', '.join(stage.after) or '-'})")
+    if limits.limits:
+        log.info(f"Limits: {', '.join(f'{k}={v}' for k, v in limits.limits.items())}")
+    if args.dry_run:
+        log.info("(dry run)")
+        return
+
+    # probe once (cached) before starting threads
+    util.is_wsl()
+
+    start = time.monotonic()
+    run_dag(stages, funcs, args.jobs, limits)
+    elapsed = time.monotonic() - start
+
+    log.info("Summary")
+    for stage in stages.values():
+        log.info(f"  {stage.id}: {stage.result} ({stage.elapsed:.1f} sec)")
+    log.info(f"  Total: {elapsed:.1f} sec")
+
+    failed = [s.id for s in stages.values() if s.result != "ok"]
+    if failed:
+        raise RuntimeError(f"Failed or skipped: {' '.join(failed)}")
+    log.info("OK")
+
+
+def main(argv: list[str]):
+    parser = argparse.ArgumentParser(
+        prog=argv[0],
+        description="Run backup stages (sync, archive, clean, upload, ...) in one process",
+        epilog="Stages without dependency between them run in parallel",
+    )
+    parser.add_argument("--config", "-c", required=True, help="job config file (.toml or .json)")
+    parser.add_argument("--jobs", "-j", type=int, default=4, help="max stages running at the same time")
+    parser.add_argument("--dry-run", "-n", action="store_true", help="print stages and exit")
+
+    args = parser.parse_args(argv[1:])
+
+    run(args)
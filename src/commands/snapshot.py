@@ -0,0 +1,497 @@
+import logging
+import argparse
+import pathlib
+import os
+import stat
+import json
+import gzip
+import hashlib
+import zlib
+import random
+import getpass
+import platform
+import datetime
+import time
+import contextlib
+import concurrent.futures
+from . import util, metrics, trace
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+
+log: logging.Logger = logging.getLogger(__name__)
+
+# STORE/chunks/XX/SHA256 (zlib compressed)
+CHUNK_DIR = "chunks"
+# STORE/tag_host_datetime.snap.json.gz
+EXT = "snap.json.gz"
+MANIFEST_VERSION = 1
+
+# content-defined chunking
+# Each position gets one bit, the XOR of CUT_MIX fixed random tables applied
+# to the last CUT_MIX bytes (so that a bit is not determined by a single
+# byte of low entropy text), and a chunk ends where the last CUT_BITS bits
+# match a fixed pattern (probability 2^-CUT_BITS per byte). All steps run
+# in C (bytes.translate, int XOR, bytes.find), unlike a per-byte rolling
+# hash in Python.
+# boundary is searched after CHUNK_MIN, forced at CHUNK_MAX
+# average chunk size = CHUNK_MIN + 1 MiB
+CHUNK_MIN = 256 * 1024
+CHUNK_MAX = 4 * 1024 * 1024
+CUT_BITS = 20
+CUT_MIX = 8
+# bits are computed and searched in segments (a boundary is usually found
+# long before CHUNK_MAX)
+CUT_SEGMENT = 64 * 1024
+READ_SIZE = 8 * 1024 * 1024
+COMPRESS_LEVEL = 6
+# chunks whose head does not compress are stored (zlib level 0, still a zlib
+# stream): deflate of incompressible data is slow and gains nothing
+COMPRESS_PROBE = 64 * 1024
+COMPRESS_PROBE_RATIO = 0.95
+
+# STORE/lock
+# Chunks are written (or found existing) before the manifest referencing
+# them, so gc must not run while a snapshot is being made: snapshots take
+# the lock shared, gc takes it exclusive.
+# Without flock (Windows), gc keeps chunks and tmp files modified within
+# GC_GRACE instead, and existing chunks are touched when reused.
+LOCK_NAME = "lock"
+GC_GRACE = 24 * 60 * 60
+
+
+def _cut_tables() -> tuple[list[bytes], bytes]:
+    # fixed seed: chunk boundaries must be stable across runs and hosts
+    rng = random.Random(0x6b6b7570)
+    tables = [bytes(rng.getrandbits(1) for _ in range(256)) for _ in range(CUT_MIX)]
+    pattern = bytes(rng.getrandbits(1) for _ in range(CUT_BITS))
+    return tables, pattern
+
+
+_BIT_TABLES, _CUT_PATTERN = _cut_tables()
+
+
+# Return the end of the chunk starting at data[start]
+# If eof is False, data[start:end] must be longer than CHUNK_MAX
+def find_cut(data: bytes | bytearray, start: int, end: int) -> int:
+    if end - start <= CHUNK_MIN:
+        return end
+    limit = min(end, start + CHUNK_MAX)
+    # the pattern ends at data[start + CHUNK_MIN] or later
+    lo = start + CHUNK_MIN + 1 - CUT_BITS
+    while True:
+        hi = min(limit, lo + CUT_SEGMENT)
+        bits = 0
+        for i, table in enumerate(_BIT_TABLES):
+            # table i is applied to the byte i positions before
+            bits ^= int.from_bytes(data[lo - i:hi - i].translate(table), "little")
+        pos = bits.to_bytes(hi - lo, "little").find(_CUT_PATTERN)
+        if pos >= 0:
+            return lo + pos + CUT_BITS
+        if hi == limit:
+            return limit
+        # the pattern may span segments
+        lo = hi - CUT_BITS + 1
+
+
+def chunk_path(store: pathlib.Path, cid: str) -> pathlib.Path:
+    return store / CHUNK_DIR / cid[:2] / cid
+
+
+# Write a chunk if it does not exist
+# Return (chunk id, compressed size if newly written else 0)
+def put_chunk(store: pathlib.Path, data: bytes) -> tuple[str, int]:
+    cid = hashlib.sha256(data).hexdigest()
+    path = chunk_path(store, cid)
+    if path.exists():
+        if fcntl is not None:
+            return cid, 0
+        # no lock: mark as recently used for gc (GC_GRACE)
+        try:
+            os.utime(path)
+            return cid, 0
+        except FileNotFoundError:
+            # deleted by gc, write again
+            pass
+
+    path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+    probe = data[:COMPRESS_PROBE]
+    if len(zlib.compress(probe, 1)) > len(probe) * COMPRESS_PROBE_RATIO:
+        comp = zlib.compress(data, 0)
+    else:
+        comp = zlib.compress(data, COMPRESS_LEVEL)
+    # tmp + rename: other workers may write the same chunk at the same time
+    tmp = path.with_name(f"{cid}.{os.getpid()}.tmp")
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o600)
+    with os.fdopen(fd, "wb") as fout:
+        fout.write(comp)
+    os.replace(tmp, path)
+
+    return cid, len(comp)
+
+
+@contextlib.contextmanager
+def store_lock(store: pathlib.Path, exclusive: bool):
+    if fcntl is None:
+        yield
+        return
+    mode = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+    fd = os.open(store / LOCK_NAME, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        try:
+            fcntl.flock(fd, mode | fcntl.LOCK_NB)
+        except BlockingIOError:
+            log.info(f"Waiting for the store lock: {store}")
+            fcntl.flock(fd, mode)
+        yield
+    finally:
+        # closing the fd releases the lock
+        os.close(fd)
+
+
+def get_chunk(store: pathlib.Path, cid: str) -> bytes:
+    with chunk_path(store, cid).open("rb") as fin:
+        data = zlib.decompress(fin.read())
+    if hashlib.sha256(data).hexdigest() != cid:
+        raise RuntimeError(f"Broken chunk: {cid}")
+    return data
+
+
+# Split a file into chunks and store them (worker process)
+# Return (chunk id list, compressed bytes newly written, file sha256)
+def store_file(store: pathlib.Path, path: pathlib.Path) -> tuple[list[str], int, str]:
+    chunks: list[str] = []
+    written = 0
+    h = hashlib.sha256()
+    buf = bytearray()
+    eof = False
+    with path.open("rb") as fin:
+        while not eof or buf:
+            while not eof and len(buf) < CHUNK_MAX:
+                data = fin.read(READ_SIZE)
+                if data:
+                    h.update(data)
+                    buf += data
+                else:
+                    eof = True
+            pos = 0
+            while len(buf) - pos >= CHUNK_MAX or (eof and pos < len(buf)):
+                cut = find_cut(buf, pos, len(buf))
+                cid, size = put_chunk(store, bytes(buf[pos:cut]))
+                chunks.append(cid)
+                written += size
+                pos = cut
+            del buf[:pos]
+
+    return chunks, written, h.hexdigest()
+
+
+# Walk src without following symlinks (parent dir first, sorted by name)
+# Yield (posix relative path, stat_result)
+def walk(src: pathlib.Path, rel: str = ""):
+    with os.scandir(src / rel if rel else src) as it:
+        entries = sorted(it, key=lambda e: e.name)
+    for entry in entries:
+        rpath = f"{rel}/{entry.name}" if rel else entry.name
+        st = entry.stat(follow_symlinks=False)
+        yield rpath, st
+        if stat.S_ISDIR(st.st_mode):
+            yield from walk(src, rpath)
+
+
+# Manifest name => (tag_host, datetime)
+# Manifests are not archives (util.scan_archives): they are useless without the chunks.
+def manifest_parse_str(name: str) -> tuple[str, str] | None:
+    return util.name_parse_str(name, (EXT,))
+
+
+def manifest_filter_str(name: str) -> bool:
+    return manifest_parse_str(name) is not None
+
+
+# Manifest files in store (sorted by name)
+def scan_manifests(store: str | os.PathLike) -> list[os.DirEntry]:
+    with os.scandir(store) as it:
+        entries = [e for e in it if manifest_filter_str(e.name) and e.is_file()]
+    entries.sort(key=lambda e: e.name)
+    return entries
+
+
+def manifest_files(store: pathlib.Path, prefix: str | None = None) -> list[pathlib.Path]:
+    result = []
+    for e in scan_manifests(store):
+        if prefix is not None and manifest_parse_str(e.name)[0] != prefix:
+            continue
+        result.append(pathlib.Path(e.path))
+    # sort by datetime
+    result.sort(key=lambda p: manifest_parse_str(p.name)[1])
+    return result
+
+
+def load_manifest(path: pathlib.Path) -> dict:
+    with gzip.open(path, "rt", encoding="utf-8") as fin:
+        manifest = json.load(fin)
+    if manifest.get("version") != MANIFEST_VERSION:
+        raise RuntimeError(f"Unsupported manifest version: {path}")
+    return manifest
+
+
+def write_manifest(path: pathlib.Path, manifest: dict):
+    tmp = path.with_name(path.name + ".tmp")
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o600)
+    with os.fdopen(fd, "wb") as raw, gzip.open(raw, "wt", encoding="utf-8") as fout:
+        json.dump(manifest, fout, separators=(",", ":"))
+    os.replace(tmp, path)
+
+
+def make_snapshot(
+        src: pathlib.Path, store: pathlib.Path, prefix: str, manifest_path: pathlib.Path,
+        hash_cache: util.HashCache, jobs: int, dry_run: bool):
+    # files not changed since the previous snapshot reuse its chunk list
+    # (by path + size + mtime, or by content hash in the hash cache for moved files)
+    prev: dict[str, dict] = {}
+    prev_by_hash: dict[str, dict] = {}
+    prev_list = manifest_files(store, prefix)
+    if prev_list:
+        log.info(f"Previous snapshot: {prev_list[-1]}")
+        for entry in load_manifest(prev_list[-1])["entries"]:
+            if entry["type"] == "file":
+                prev[entry["path"]] = entry
+                if "sha256" in entry:
+                    prev_by_hash[entry["sha256"]] = entry
+
+    entries: list[dict] = []
+    # index in entries => (file path, stat)
+    changed: dict[int, tuple[pathlib.Path, os.stat_result]] = {}
+    read_bytes = 0
+    moved = 0
+    for rpath, st in walk(src):
+        entry = {"path": rpath, "mode": stat.S_IMODE(st.st_mode), "mtime_ns": st.st_mtime_ns}
+        if stat.S_ISDIR(st.st_mode):
+            entry["type"] = "dir"
+        elif stat.S_ISLNK(st.st_mode):
+            entry["type"] = "symlink"
+            entry["target"] = os.readlink(src / rpath)
+        elif stat.S_ISREG(st.st_mode):
+            entry["type"] = "file"
+            entry["size"] = st.st_size
+            old = prev.get(rpath)
+            if old is None or old["size"] != st.st_size or old["mtime_ns"] != st.st_mtime_ns:
+                digest = hash_cache.get(st)
+                old = prev_by_hash.get(digest) if digest is not None else None
+                if old is not None:
+                    moved += 1
+            if old is not None:
+                entry["chunks"] = old["chunks"]
+                if "sha256" in old:
+                    entry["sha256"] = old["sha256"]
+            else:
+                changed[len(entries)] = (src / rpath, st)
+                read_bytes += st.st_size
+        else:
+            log.warning(f"Skip special file: {src / rpath}")
+            continue
+        entries.append(entry)
+
+    log.info(f"{len(entries)} entries, {moved} moved file(s), {len(changed)} changed file(s), {read_bytes} bytes to read")
+    if dry_run:
+        log.info("(dry run)")
+        return
+
+    (store / CHUNK_DIR).mkdir(mode=0o700, exist_ok=True)
+    written = 0
+    with (trace.span("store chunks", args={"files": len(changed)}),
+            concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor):
+        futures = {executor.submit(store_file, store, path): idx for idx, (path, _st) in changed.items()}
+        for future in concurrent.futures.as_completed(futures):
+            idx = futures[future]
+            chunks, size, digest = future.result()
+            entries[idx]["chunks"] = chunks
+            entries[idx]["sha256"] = digest
+            hash_cache.put(changed[idx][1], digest)
+            written += size
+    log.info(f"Stored {written} bytes of new chunks")
+    metrics.recorder.add(metrics.INPUT_BYTES, read_bytes)
+    metrics.recorder.add(metrics.OUTPUT_BYTES, written)
+    metrics.recorder.add(metrics.FILES, len(changed))
+
+    manifest = {
+        "version": MANIFEST_VERSION,
+        "src": str(src),
+        "entries": entries,
+    }
+    write_manifest(manifest_path, manifest)
+
+
+def check_relpath(rpath: str):
+    p = pathlib.PurePosixPath(rpath)
+    if p.is_absolute() or ".." in p.parts:
+        raise RuntimeError(f"Invalid path in manifest: {rpath}")
+
+
+# True if rpath is one of paths or under one of them (paths: None = all)
+def path_selected(rpath: str, paths: list[str] | None) -> bool:
+    if paths is None:
+        return True
+    return any(rpath == p or rpath.startswith(f"{p}/") for p in paths)
+
+
+def restore_file(store: pathlib.Path, entry: dict, dst: pathlib.Path):
+    h = hashlib.sha256()
+    with dst.open("wb") as fout:
+        for cid in entry["chunks"]:
+            data = get_chunk(store, cid)
+            h.update(data)
+            fout.write(data)
+    if "sha256" in entry and h.hexdigest() != entry["sha256"]:
+        raise RuntimeError(f"Hash mismatch: {entry['path']}")
+    os.chmod(dst, entry["mode"])
+    os.utime(dst, ns=(entry["mtime_ns"], entry["mtime_ns"]))
+
+
+# paths: restore only these files or dirs (posix relative paths, None = all)
+# Files are restored by jobs threads (zlib and hashlib release the GIL).
+def restore(
+        store: pathlib.Path, manifest_path: pathlib.Path, out: pathlib.Path,
+        paths: list[str] | None = None, jobs: int = 1):
+    manifest = load_manifest(manifest_path)
+    out.mkdir(parents=True, exist_ok=True)
+
+    dirs = []
+    files = []
+    count = 0
+    for entry in manifest["entries"]:
+        rpath = entry["path"]
+        check_relpath(rpath)
+        if not path_selected(rpath, paths):
+            continue
+        count += 1
+        dst = out / rpath
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        match entry["type"]:
+            case "dir":
+                dst.mkdir(exist_ok=True)
+                dirs.append((dst, entry))
+            case "symlink":
+                os.symlink(entry["target"], dst)
+            case "file":
+                files.append((entry, dst))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        for future in [executor.submit(restore_file, store, entry, dst) for entry, dst in files]:
+            future.result()
+    # set dir attributes after its children are created
+    for dst, entry in reversed(dirs):
+        os.chmod(dst, entry["mode"])
+        os.utime(dst, ns=(entry["mtime_ns"], entry["mtime_ns"]))
+
+    if count == 0:
+        raise RuntimeError(f"Not found in the snapshot: {', '.join(paths or [])}")
+    log.info(f"Restored {count} entries")
+    metrics.recorder.add(metrics.FILES, len(files))
+
+
+# Return (deleted chunks, deleted bytes, referenced chunks)
+def _gc(store: pathlib.Path, dry_run: bool) -> tuple[int, int, int]:
+    referenced: set[str] = set()
+    for path in manifest_files(store):
+        for entry in load_manifest(path)["entries"]:
+            referenced.update(entry.get("chunks", []))
+
+    # no lock: keep recent files of running snapshots
+    keep_after = time.time() - GC_GRACE if fcntl is None else None
+    count = 0
+    size = 0
+    for subdir in (store / CHUNK_DIR).iterdir():
+        for p in subdir.iterdir():
+            # tmp: leftover of an interrupted snapshot
+            if not p.name.endswith(".tmp") and p.name in referenced:
+                continue
+            try:
+                st = p.stat()
+                if keep_after is not None and st.st_mtime > keep_after:
+                    continue
+                if not dry_run:
+                    p.unlink()
+            except FileNotFoundError:
+                continue
+            count += 1
+            size += st.st_size
+    return count, size, len(referenced)
+
+
+# Delete chunks not referenced by any manifest in the store
+def gc(store: pathlib.Path, dry_run: bool):
+    with store_lock(store, exclusive=True):
+        count, size, referenced = _gc(store, dry_run)
+    log.info(f"GC: {referenced} chunks referenced, {count} chunks ({size} bytes) deleted")
+    if dry_run:
+        log.info("(dry run)")
+    else:
+        metrics.recorder.add(metrics.DELETED_BYTES, size)
+
+
+def snapshot(args: argparse.Namespace):
+    store = pathlib.Path(args.dst).expanduser().resolve()
+
+    if args.restore_to is not None:
+        if args.manifest is not None:
+            manifest_path = store / args.manifest
+        else:
+            manifests = manifest_files(store)
+            if not manifests:
+                raise RuntimeError(f"No snapshot in {store}")
+            manifest_path = manifests[-1]
+        log.info(f"Restore: {manifest_path}")
+        restore(store, manifest_path, pathlib.Path(args.restore_to).expanduser().resolve(), jobs=args.jobs)
+        log.info("OK")
+        return
+
+    if args.src is None:
+        raise RuntimeError("--src or --restore-to is required")
+    src = pathlib.Path(args.src).expanduser().resolve()
+    if not src.is_dir():
+        raise RuntimeError("SRC must be a directory")
+    store.mkdir(mode=0o700, parents=True, exist_ok=True)
+    log.info(f"SRC: {src}")
+    log.info(f"STORE: {store}")
+
+    # tag_host_datetime (same as archive)
+    user = getpass.getuser()
+    host = platform.node()
+    dt_str = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
+    tag = args.tag if args.tag is not None else user
+    prefix = f"{tag}_{host}"
+    manifest_path = store / f"{prefix}_{dt_str}.{EXT}"
+    log.info(f"DST: {manifest_path}")
+
+    with util.HashCache(args.hash_cache) as hash_cache, store_lock(store, exclusive=False):
+        make_snapshot(src, store, prefix, manifest_path, hash_cache, args.jobs, args.dry_run)
+
+    if not args.dry_run:
+        latest = store / "latest.txt"
+        log.info(f"Write the latest snapshot name: {str(latest)}")
+        with latest.open("w") as fout:
+            print(manifest_path, file=fout)
+    log.info(f"OK: {manifest_path}")
+
+
+def main(argv: list[str]):
+    parser = argparse.ArgumentParser(
+        prog=argv[0],
+        description="Make a deduplicated snapshot of a directory (content-defined chunk store)",
+        epilog="Old snapshots can be deleted by clean (unreferenced chunks are deleted at the same time)",
+    )
+    parser.add_argument("--src", "-s", help="backup source dir")
+    parser.add_argument("--dst", "-d", required=True, help="chunk store dir")
+    parser.add_argument("--tag", "-t", help="tag string for snapshot file name (default: user_name)")
+    parser.add_argument("--jobs", "-j", type=int, default=os.cpu_count(), help="number of worker processes")
+    parser.add_argument("--hash-cache", help="file hash cache (default: ~/.cache/bkup/hashcache.sqlite3)")
+    parser.add_argument("--restore-to", help="restore a snapshot into this dir instead of making a snapshot")
+    parser.add_argument("--manifest", "-m", help="snapshot file name to restore (default: the latest)")
+    parser.add_argument("--dry-run", "-n", action="store_true", help="dry run")
+
+    args = parser.parse_args(argv[1:])
+
+    snapshot(args)
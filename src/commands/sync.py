@@ -3,26 +3,80 @@ import argparse
 import pathlib
 import multiprocessing
 import os
-from . import util
+import re
+import time
+import typing
+import threading
+import concurrent.futures
+from . import util, metrics
 
 log: logging.Logger = logging.getLogger(__name__)
 
 
+class SyncResult(typing.NamedTuple):
+    src: str
+    returncode: int
+    # None if unknown
+    transferred: int | None
+    elapsed: float
+
+
+# Run func(src) -> SyncResult for each source in a bounded thread pool
+def run_parallel(func: typing.Callable[[str], SyncResult], src_list: list[str], jobs: int) -> list[SyncResult]:
+    log.info(f"Run {len(src_list)} source(s) in parallel (jobs={jobs})")
+    start = time.monotonic()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        results = list(executor.map(metrics.bind(func), src_list))
+    elapsed = time.monotonic() - start
+
+    log.info("Summary")
+    for r in results:
+        transferred = f"{r.transferred} bytes" if r.transferred is not None else "- bytes"
+        log.info(f"  {r.src}: exit={r.returncode}, {transferred}, {r.elapsed:.1f} sec")
+    total = sum(r.transferred for r in results if r.transferred is not None)
+    slowest = max(r.elapsed for r in results)
+    log.info(f"  Total: {total} bytes, {elapsed:.1f} sec (slowest source {slowest:.1f} sec)")
+    return results
+
+
 def sync_win_robocopy(
         src_list: list[str], dst: pathlib.Path,
         exclude_file: list[str], exclude_dir: list[str],
-        dry_run: bool, force: bool):
+        dry_run: bool, force: bool, jobs: int = 1):
     assert src_list
+    if jobs <= 1:
+        for src in src_list:
+            srcpath = pathlib.PureWindowsPath(src)
+            dstdir = dst / srcpath.name
+            robocopy_one(src, dstdir, exclude_file, exclude_dir, dry_run, force)
+        return
+
+    # each source is mirrored (/MIR) to DST/NAME: two robocopy of the same name would delete the other's files
+    names = [pathlib.PureWindowsPath(src).name.casefold() for src in src_list]
+    dups = sorted(set(name for name in names if names.count(name) > 1))
+    if dups:
+        raise RuntimeError(f"Sources with the same name are mirrored to the same dir in parallel: {' '.join(dups)}")
+
+    # confirm all of them first, then run in parallel
+    cmds = {}
     for src in src_list:
         srcpath = pathlib.PureWindowsPath(src)
         dstdir = dst / srcpath.name
-        robocopy_one(src, dstdir, exclude_file, exclude_dir, dry_run, force)
+        cmds[src] = robocopy_cmd(src, dstdir, exclude_file, exclude_dir, dry_run)
+        if not force:
+            robocopy_confirm(cmds[src])
 
+    def run(src: str) -> SyncResult:
+        start = time.monotonic()
+        returncode = robocopy_run(cmds[src])
+        return SyncResult(src, returncode, None, time.monotonic() - start)
 
-# dir sync for windows
-def robocopy_one(
+    run_parallel(run, src_list, jobs)
+
+
+def robocopy_cmd(
         src: str, dst: pathlib.Path, exclude_file: list[str],
-        exclude_dir: list[str], dry_run: bool, force: bool):
+        exclude_dir: list[str], dry_run: bool) -> list[str]:
     nproc = max(multiprocessing.cpu_count(), 128)
     cmd = [
         "Robocopy.exe", str(src), str(dst),
@@ -51,28 +105,83 @@ def robocopy_one(
         cmd += exclude_dir
     if dry_run:
         cmd.append("/L")
+    return cmd
 
-    if not force:
-        # + /QUIT
-        util.exec(cmd + ["/QUIT"])
-        log.warning("Caution!")
-        log.warning("Mirror (/MIR) option may destruct the destination dir.")
-        log.warning("(You can skip this by --force option for automation)")
-        log.warning("OK? (y/N)")
-        ans = input()
-        if ans != "y" and ans != "Y":
-            log.info("Cancelled")
-            raise RuntimeError("Cancelled")
 
-    log.info(f"EXEC: {' '.join(cmd)}")
+def robocopy_confirm(cmd: list[str]):
+    # + /QUIT
+    util.exec(cmd + ["/QUIT"])
+    log.warning("Caution!")
+    log.warning("Mirror (/MIR) option may destruct the destination dir.")
+    log.warning("(You can skip this by --force option for automation)")
+    log.warning("OK? (y/N)")
+    ans = input()
+    if ans != "y" and ans != "Y":
+        log.info("Cancelled")
+        raise RuntimeError("Cancelled")
+
+
+def robocopy_run(cmd: list[str]) -> int:
     returncode = util.exec(cmd, check=False)
     if returncode >= 8:
         log.warning(f"Robocopy returned: {returncode}")
     else:
         log.info(f"Robocopy returned: {returncode}")
+    return returncode
+
+
+# dir sync for windows
+def robocopy_one(
+        src: str, dst: pathlib.Path, exclude_file: list[str],
+        exclude_dir: list[str], dry_run: bool, force: bool):
+    cmd = robocopy_cmd(src, dst, exclude_file, exclude_dir, dry_run)
+    if not force:
+        robocopy_confirm(cmd)
+    robocopy_run(cmd)
+
 
+# "Total transferred file size: 1,234 bytes"
+_RSYNC_TRANSFERRED = re.compile(r"^Total transferred file size: ([\d,.]+) bytes")
+# Partial transfer due to vanished source files
+RSYNC_VANISHED = 24
 
-def sync_unix_rsync(src_list: list[str], dst: pathlib.Path, exclude: list[str], exclude_from: list[str], dry_run: bool, force: bool):
+
+# One rsync per source is the same as one rsync for all sources only if
+# each source has its own dir DST/NAME. "dir/" copies the entries into DST,
+# and --delete of each rsync would delete the files copied by the others.
+def rsync_parallel_ok(src_list: list[str]) -> bool:
+    if any(src.endswith("/") for src in src_list):
+        return False
+    names = [pathlib.PurePath(src).name for src in src_list]
+    return len(set(names)) == len(names)
+
+
+def rsync_one(cmd: list[str], src: str, dst: pathlib.Path) -> SyncResult:
+    transferred = None
+    lock = threading.Lock()
+
+    def on_line(line: str):
+        nonlocal transferred
+        m = _RSYNC_TRANSFERRED.match(line)
+        if m:
+            transferred = int(re.sub(r"[,.]", "", m.group(1)))
+        util.rsync_stat(line)
+        with lock:
+            print(f"[{src}] {line}", flush=True)
+
+    start = time.monotonic()
+    returncode = util.exec_lines(cmd + ["--stats", src, str(dst)], on_line, check=False)
+    elapsed = time.monotonic() - start
+    if returncode == RSYNC_VANISHED:
+        log.warning(f"{src}: some files vanished before they could be transferred")
+    elif returncode != 0:
+        log.error(f"{src}: rsync returned: {returncode}")
+    return SyncResult(src, returncode, transferred, elapsed)
+
+
+def sync_unix_rsync(
+        src_list: list[str], dst: pathlib.Path, exclude: list[str], exclude_from: list[str],
+        dry_run: bool, force: bool, jobs: int = 1):
     # command and -param
     cmd = [
         "rsync",
@@ -80,7 +189,7 @@ def sync_unix_rsync(src_list: list[str], dst: pathlib.Path, exclude: list[str],
         "-av",
         # sync (delete if src does not contain)
         "--delete",
-    ]
+    ] + util.governor.rsync_opts()
     for pattern in exclude:
         cmd.append(f"--exclude={pattern}")
     for file in exclude_from:
@@ -91,6 +200,7 @@ def sync_unix_rsync(src_list: list[str], dst: pathlib.Path, exclude: list[str],
     # But check again because rsync dst will be destroyed ant it is dangerous.
     assert type(src_list) is list and all((isinstance(src, str) for src in src_list))
     assert isinstance(dst, os.PathLike)
+    opts = list(cmd)
     # SRC...
     cmd.extend(map(str, src_list))
     # DST
@@ -107,7 +217,18 @@ def sync_unix_rsync(src_list: list[str], dst: pathlib.Path, exclude: list[str],
             log.info("Cancelled")
             raise RuntimeError("Cancelled")
 
-    util.exec(cmd)
+    if jobs > 1 and not rsync_parallel_ok(src_list):
+        log.warning("Sources ending with / or with the same name share the destination dir, run one rsync")
+        jobs = 1
+    if jobs <= 1:
+        util.exec_rsync(cmd)
+        return
+
+    # one rsync per source (DST/NAME for each, see rsync_parallel_ok)
+    results = run_parallel(lambda src: rsync_one(opts, src, dst), src_list, jobs)
+    failed = [r.src for r in results if r.returncode not in (0, RSYNC_VANISHED)]
+    if failed:
+        raise RuntimeError(f"rsync failed: {' '.join(failed)}")
 
 
 def sync(args: argparse.Namespace):
@@ -135,8 +256,8 @@ def sync(args: argparse.Namespace):
 
     exe_from_wsl = False
     if util.is_wsl():
-        winsrc_list = list(map(util.to_winpath, src_list))
-        windst = util.to_winpath(dst)
+        # one batched translation for all of SRC and DST
+        *winsrc_list, windst = util.to_winpaths(src_list + [dst])
         # if all of elements are not None, windows binary mode
         if all(winsrc_list):
             log.info("Windows SRC detected")
@@ -151,15 +272,15 @@ def sync(args: argparse.Namespace):
     if iswin:
         if args.exclude or args.exclude_from:
             raise RuntimeError("--exclude and --exclude-from are unavailable for Robocopy")
-        sync_win_robocopy(src_list, dst, args.exclude_file, args.exclude_dir, args.dry_run, args.force)
+        sync_win_robocopy(src_list, dst, args.exclude_file, args.exclude_dir, args.dry_run, args.force, args.jobs)
     elif exe_from_wsl:
         if args.exclude or args.exclude_from:
             raise RuntimeError("--exclude and --exclude-from are unavailable for Robocopy")
-        sync_win_robocopy(winsrc_list, windst, args.exclude_file, args.exclude_dir, args.dry_run, args.force)
+        sync_win_robocopy(winsrc_list, windst, args.exclude_file, args.exclude_dir, args.dry_run, args.force, args.jobs)
     else:
         if args.exclude_file or args.exclude_dir:
             raise RuntimeError("--exclude-file and --exclude-dir are unavailable for rsync")
-        sync_unix_rsync(src_list, dst, args.exclude, args.exclude_from, args.dry_run, args.force)
+        sync_unix_rsync(src_list, dst, args.exclude, args.exclude_from, args.dry_run, args.force, args.jobs)
 
     log.info("OK")
 
@@ -178,6 +299,8 @@ def main(argv: list[str]):
     parser.add_argument("--exclude-from", nargs="*", default=[], help="exclude list files (rsync)")
     parser.add_argument("--exclude-file", nargs="*", default=[], help="exclude files (Robocopy)")
     parser.add_argument("--exclude-dir", nargs="*", default=[], help="exclude dirs (Robocopy)")
+    parser.add_argument("--jobs", "-j", type=int, default=1,
+                        help="sync N sources in parallel (one rsync/robocopy per source) (default: 1)")
     parser.add_argument("--dry-run", "-n", action="store_true", help="dry run")
     parser.add_argument("--force", "-f", action="store_true", help="run without confirmation")
 
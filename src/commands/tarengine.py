@@ -0,0 +1,271 @@
+import logging
+import pathlib
+import os
+import stat
+import tarfile
+import time
+import collections
+import hashlib
+import gzip
+import json
+import concurrent.futures
+from . import codec, util, catalog, metrics, trace
+
+log: logging.Logger = logging.getLogger(__name__)
+
+# Python archive engine
+# tarfile writes a tar stream into BlockWriter, independent blocks are
+# compressed in worker processes and written in order.
+# The output is a multi-stream (bzip2/xz), multi-member (gzip) or
+# multi-frame (zstd) file which stock tools can decompress.
+# SHA-256 of the output and of each file are computed while writing
+# (checksum sidecar, file listing for the catalog).
+# The index (NAME.idx.json.gz) maps each block to its offset in the file and
+# each member to its range in the tar stream, so that restore can decompress
+# only the blocks of the selected files (in parallel).
+
+BLOCK_SIZE = 8 * 1024 * 1024
+PROGRESS_INTERVAL = 10.0
+INDEX_VERSION = 1
+
+
+# Worker process: return (compressed data, elapsed sec)
+def _compress(name: str, data: bytes, level: int) -> tuple[bytes, float]:
+    start = time.perf_counter()
+    result = codec.compress_block(name, data, level)
+    return result, time.perf_counter() - start
+
+
+class BlockWriter:
+    # file-like object for tarfile (write only)
+    # at most max_inflight blocks are kept in memory
+    def __init__(
+            self, fout, comp: codec.Codec, level: int,
+            executor: concurrent.futures.Executor, max_inflight: int, block_size: int = BLOCK_SIZE):
+        self.fout = fout
+        self.comp = comp
+        self.level = level
+        self.executor = executor
+        self.max_inflight = max_inflight
+        self.block_size = block_size
+        self.buf = bytearray()
+        self.inflight: collections.deque = collections.deque()
+        self.block_count = 0
+        self.in_bytes = 0
+        self.out_bytes = 0
+        self.sha256 = hashlib.sha256()
+        # [tar offset, tar size, file offset, compressed size]
+        self.frames: list[list[int]] = []
+        self.start = time.monotonic()
+        self.last_progress = self.start
+
+    def write(self, data: bytes) -> int:
+        self.buf += data
+        while len(self.buf) >= self.block_size:
+            self._submit(bytes(self.buf[:self.block_size]))
+            del self.buf[:self.block_size]
+        return len(data)
+
+    def _submit(self, block: bytes):
+        while len(self.inflight) >= self.max_inflight:
+            self._write_oldest()
+        future = self.executor.submit(_compress, self.comp.name, block, self.level)
+        self.inflight.append((len(block), future))
+
+    def _write_oldest(self):
+        in_size, future = self.inflight.popleft()
+        data, elapsed = future.result()
+        self.fout.write(data)
+        self.sha256.update(data)
+        self.frames.append([self.in_bytes, in_size, self.out_bytes, len(data)])
+        self.block_count += 1
+        self.in_bytes += in_size
+        self.out_bytes += len(data)
+        log.debug(
+            f"block {self.block_count}: {in_size} => {len(data)} bytes, "
+            f"{in_size / max(elapsed, 1e-9) / 1e6:.1f} MB/s")
+
+        now = time.monotonic()
+        if now - self.last_progress >= PROGRESS_INTERVAL:
+            self.last_progress = now
+            log.info(
+                f"{self.in_bytes} bytes read, {self.block_count} blocks, "
+                f"{self.in_bytes / (now - self.start) / 1e6:.1f} MB/s "
+                f"(last block {in_size / max(elapsed, 1e-9) / 1e6:.1f} MB/s)")
+
+    def close(self):
+        if self.buf:
+            self._submit(bytes(self.buf))
+            self.buf.clear()
+        while self.inflight:
+            self._write_oldest()
+
+    def report(self):
+        metrics.recorder.add(metrics.INPUT_BYTES, self.in_bytes)
+        metrics.recorder.add(metrics.OUTPUT_BYTES, self.out_bytes)
+        elapsed = time.monotonic() - self.start
+        ratio = self.out_bytes / self.in_bytes if self.in_bytes else 0.0
+        log.info(
+            f"{self.in_bytes} => {self.out_bytes} bytes (ratio {ratio:.3f}), {self.block_count} blocks, "
+            f"{elapsed:.1f} sec, {self.in_bytes / max(elapsed, 1e-9) / 1e6:.1f} MB/s")
+
+
+class SizedReader:
+    # file-like object (read only) returning exactly size bytes
+    # A file shrunk after gettarinfo() is padded with zeros (same as GNU tar)
+    # so that the tar stream stays aligned; bytes beyond size are ignored.
+    def __init__(self, fin, size: int):
+        self.fin = fin
+        self.remaining = size
+        self.padded = 0
+
+    def read(self, size: int = -1) -> bytes:
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        chunks = []
+        got = 0
+        while got < size:
+            data = self.fin.read(size - got)
+            if not data:
+                break
+            chunks.append(data)
+            got += len(data)
+        if got < size:
+            chunks.append(bytes(size - got))
+            self.padded += size - got
+        self.remaining -= size
+        return b"".join(chunks)
+
+
+class TarWriter:
+    def __init__(self, tf: tarfile.TarFile, listing: bool = True):
+        self.tf = tf
+        self.hashing = listing
+        self.warnings = 0
+        # [name, start, end] (tar stream range of header + data)
+        self.members: list[list] = []
+        self.listing = catalog.Listing()
+
+    # like "tar -C src -cf - ." (parent dir first, sorted by name)
+    def add_tree(self, src: pathlib.Path, arcname: str = "."):
+        self.add(src, arcname)
+        try:
+            with os.scandir(src) as it:
+                names = sorted(e.name for e in it)
+        except OSError as e:
+            self._warn(e)
+            return
+        for name in names:
+            path = src / name
+            sub = f"{arcname}/{name}"
+            try:
+                if stat.S_ISDIR(path.lstat().st_mode):
+                    self.add_tree(path, sub)
+                else:
+                    self.add(path, sub)
+            except OSError as e:
+                self._warn(e)
+
+    def add(self, path: pathlib.Path, arcname: str):
+        try:
+            tarinfo = self.tf.gettarinfo(str(path), arcname)
+        except OSError as e:
+            self._warn(e)
+            return
+        if tarinfo is None:
+            log.warning(f"Skip special file: {path}")
+            return
+        if tarinfo.isreg():
+            # open before addfile so that an unreadable file does not break the stream
+            try:
+                fin = path.open("rb")
+            except OSError as e:
+                self._warn(e)
+                return
+            start = self.tf.offset
+            with fin:
+                sized = SizedReader(fin, tarinfo.size)
+                reader = catalog.HashReader(sized) if self.hashing else sized
+                try:
+                    self.tf.addfile(tarinfo, reader)
+                except OSError as e:
+                    # the header and a part of the data are already written (not skippable)
+                    raise RuntimeError(f"Read error in the middle of {path}: {e}") from e
+                if self.hashing:
+                    self.listing.add(tarinfo.name, tarinfo.size, tarinfo.mtime, reader.sha256.hexdigest())
+            if sized.padded:
+                log.warning(f"{path}: file shrank by {sized.padded} bytes; padding with zeros")
+                self.warnings += 1
+        else:
+            start = self.tf.offset
+            self.tf.addfile(tarinfo)
+        self.members.append([tarinfo.name, start, self.tf.offset])
+
+    def _warn(self, e: OSError):
+        # same as tar (exit code 1): non fatal
+        log.warning(f"Skip: {e}")
+        self.warnings += 1
+
+
+def index_path(ar_dst: pathlib.Path) -> pathlib.Path:
+    return ar_dst.with_name(f"{ar_dst.name}.{util.INDEX_EXT}")
+
+
+def write_index(ar_dst: pathlib.Path, comp: codec.Codec, frames: list[list[int]], members: list[list]):
+    path = index_path(ar_dst)
+    index = {
+        "version": INDEX_VERSION,
+        "codec": comp.name,
+        "frames": frames,
+        "members": members,
+    }
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o600)
+    with os.fdopen(fd, "wb") as raw, gzip.open(raw, "wt", encoding="utf-8") as fout:
+        json.dump(index, fout, separators=(",", ":"))
+    log.info(f"Index: {path} ({len(frames)} frames, {len(members)} members)")
+
+
+# Return None if ar_dst has no index
+def load_index(ar_dst: pathlib.Path) -> dict | None:
+    path = index_path(ar_dst)
+    if not path.is_file():
+        return None
+    with gzip.open(path, "rt", encoding="utf-8") as fin:
+        index = json.load(fin)
+    if index.get("version") != INDEX_VERSION:
+        raise RuntimeError(f"Unsupported index version: {path}")
+    return index
+
+
+# Write ar_dst, its index and file listing
+# Return (the number of warnings (skipped or shrunk files), sha256 hex digest of ar_dst)
+def archive(
+        src: pathlib.Path, ar_dst: pathlib.Path, comp: codec.Codec, level: int | None, threads: int,
+        listing: bool = True) -> tuple[int, str]:
+    level = comp.default_level if level is None else level
+    comp.check_level(level)
+    workers = util.governor.compress_threads(threads)
+    log.info(f"Python engine: {comp.name} level {level}, {workers} worker process(es)")
+
+    fd = os.open(ar_dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o600)
+    try:
+        with (os.fdopen(fd, "wb") as fout,
+                concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor):
+            writer = BlockWriter(fout, comp, level, executor, max_inflight=workers * 2)
+            with tarfile.open(fileobj=writer, mode="w|", format=tarfile.PAX_FORMAT) as tf:
+                tw = TarWriter(tf, listing)
+                tw.add_tree(src)
+                tw.listing.complete = True
+            writer.close()
+        writer.report()
+        with trace.span("index"):
+            write_index(ar_dst, comp, writer.frames, tw.members)
+        if listing:
+            tw.listing.write(ar_dst)
+    except BaseException:
+        ar_dst.unlink(missing_ok=True)
+        index_path(ar_dst).unlink(missing_ok=True)
+        catalog.listing_path(ar_dst).unlink(missing_ok=True)
+        raise
+
+    return tw.warnings, writer.sha256.hexdigest()
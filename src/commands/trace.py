@@ -0,0 +1,170 @@
+import logging
+import os
+import contextlib
+import cProfile
+import io
+import json
+import pstats
+import threading
+import time
+import typing
+
+log: logging.Logger = logging.getLogger(__name__)
+
+# Timeline trace and profile of the whole process
+# Configured once by bkup.py global options (--trace FILE, --profile).
+# * spans: subcommands, stages of run, phases of subcommands, probes
+#   (one track per thread)
+# * child processes started by util.popen: start, end, exit code,
+#   CPU time and max RSS (one track per child)
+# The trace is written in the Chrome trace event format (JSON), which
+# can be opened in Perfetto (ui.perfetto.dev) or chrome://tracing.
+# --profile runs the main thread and thread pool tasks under cProfile;
+# the merged stats are logged (top functions) and written to FILE.prof
+# with --trace FILE.
+# Disabled (no-op) unless one of the options is given.
+
+# functions logged by --profile
+PROFILE_TOP = 25
+# max length of argv in the trace
+ARGV_MAX = 500
+
+
+class Tracer:
+    def __init__(self):
+        self.path: str | None = None
+        self.profiling = False
+        self.lock = threading.Lock()
+        self.events: list[dict] = []
+        self.threads: set[int] = set()
+        self.profiles: list[cProfile.Profile] = []
+        self.main_profile: cProfile.Profile | None = None
+        self.t0 = time.perf_counter()
+
+    def configure(self, path: str | None, profiling: bool):
+        self.path = path
+        self.profiling = profiling
+        self.events = []
+        self.threads = set()
+        self.profiles = []
+        self.t0 = time.perf_counter()
+
+    @property
+    def enabled(self) -> bool:
+        return self.path is not None
+
+    # perf_counter => microseconds from the start
+    def _us(self, t: float) -> int:
+        return int((t - self.t0) * 1e6)
+
+    def _add(self, event: dict):
+        with self.lock:
+            self.events.append(event)
+
+    def _thread_track(self) -> int:
+        tid = threading.get_native_id()
+        if tid not in self.threads:
+            self.threads.add(tid)
+            self._add({
+                "ph": "M", "name": "thread_name", "pid": os.getpid(), "tid": tid,
+                "args": {"name": threading.current_thread().name}})
+        return tid
+
+    # Span of the current thread
+    @contextlib.contextmanager
+    def span(self, name: str, cat: str = "phase", args: dict | None = None):
+        if not self.enabled:
+            yield
+            return
+        tid = self._thread_track()
+        start = time.perf_counter()
+        ok = True
+        try:
+            yield
+        except BaseException:
+            ok = False
+            raise
+        finally:
+            end = time.perf_counter()
+            self._add({
+                "ph": "X", "name": name, "cat": cat, "pid": os.getpid(), "tid": tid,
+                "ts": self._us(start), "dur": self._us(end) - self._us(start),
+                "args": {**(args or {}), "ok": ok}})
+
+    # Child process (track per child)
+    def process(self, pid: int, cmd: list, start: float, end: float, rusage, returncode: int):
+        if not self.enabled:
+            return
+        prog = os.path.basename(str(cmd[0]))
+        argv = " ".join(map(str, cmd))
+        self._add({"ph": "M", "name": "thread_name", "pid": os.getpid(), "tid": pid, "args": {"name": f"{prog} [{pid}]"}})
+        self._add({
+            "ph": "X", "name": prog, "cat": "process", "pid": os.getpid(), "tid": pid,
+            "ts": self._us(start), "dur": self._us(end) - self._us(start),
+            "args": {
+                "argv": argv[:ARGV_MAX],
+                "returncode": returncode,
+                "user": round(rusage.ru_utime, 3),
+                "sys": round(rusage.ru_stime, 3),
+                "maxrss_kb": rusage.ru_maxrss,
+            }})
+
+    # Run fn under cProfile (for tasks of thread pools)
+    def wrap(self, fn: typing.Callable) -> typing.Callable:
+        if not self.profiling:
+            return fn
+
+        def run(*args, **kwargs):
+            prof = cProfile.Profile()
+            try:
+                prof.enable()
+            except ValueError:
+                # Python 3.12+: one profiler at a time, and the main profile covers all threads
+                return fn(*args, **kwargs)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                prof.disable()
+                with self.lock:
+                    self.profiles.append(prof)
+        return run
+
+    def start(self):
+        if self.enabled:
+            self._add({"ph": "M", "name": "process_name", "pid": os.getpid(), "args": {"name": "bkup.py"}})
+        if self.profiling:
+            self.main_profile = cProfile.Profile()
+            self.main_profile.enable()
+
+    # Stop profiling, write the trace and the profile
+    def finish(self):
+        profiles = list(self.profiles)
+        if self.main_profile is not None:
+            self.main_profile.disable()
+            profiles.insert(0, self.main_profile)
+            self.main_profile = None
+        if profiles:
+            stats = pstats.Stats(profiles[0], stream=io.StringIO())
+            for prof in profiles[1:]:
+                stats.add(prof)
+            stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(PROFILE_TOP)
+            log.info(f"Profile ({len(profiles)} thread(s)):\n{stats.stream.getvalue().strip()}")
+            if self.path is not None:
+                stats.dump_stats(f"{self.path}.prof")
+                log.info(f"Profile: {self.path}.prof")
+        if self.path is None:
+            return
+        try:
+            with open(self.path, "w", encoding="utf-8") as fout:
+                json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, fout, separators=(",", ":"))
+            log.info(f"Trace: {self.path} ({len(self.events)} events)")
+        except OSError as e:
+            log.warning(f"Trace write error: {e}")
+
+
+tracer = Tracer()
+
+
+# Shortcut of tracer.span
+def span(name: str, cat: str = "phase", args: dict | None = None):
+    return tracer.span(name, cat, args)
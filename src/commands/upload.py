@@ -1,60 +1,320 @@
 import logging
 import argparse
 import pathlib
-from . import util
+import os
+import posixpath
+import shlex
+import shutil
+import tempfile
+import subprocess
+import concurrent.futures
+from . import util, retention, snapshot, metrics, trace
 
 log: logging.Logger = logging.getLogger(__name__)
 
 
-def upload(args: argparse.Namespace):
-    src = pathlib.Path(args.src)
-    latest = src / "latest.txt"
+# Split rsync style destination
+# user@host:dir => ("user@host", "dir"), local/dir => (None, "local/dir")
+def parse_dst(dst: str) -> tuple[str | None, str]:
+    host, sep, path = dst.partition(":")
+    if not sep or "/" in host:
+        return None, dst
+    return host, path
 
-    log.info(f"Read the latest archive: {str(latest)}")
-    with latest.open() as fin:
-        latest_file = src / fin.readline().strip()
-    log.info(f"The latest archive: {str(latest_file)}")
-    if not latest_file.is_file():
-        raise RuntimeError(f"{str(latest_file)} is not a valid file")
 
-    dst: str = args.dst
-    if not dst.endswith("/"):
-        dst += "/"
+def ssh_cmd(ssh: str | None) -> list[str]:
+    return shlex.split(ssh) if ssh else ["ssh"]
+
 
+# Write stdin to user@host:dir/name via ssh (for streaming archive)
+def ssh_sink_cmd(dst: str, ssh: str | None, name: str) -> list[str]:
+    host, path = parse_dst(dst)
+    if host is None:
+        raise RuntimeError(f"Remote destination (user@host:dir) is required: {dst}")
+    dirpath = path if path != "" else "."
+    filepath = posixpath.join(dirpath, name)
+    remote_cmd = f"umask 077 && mkdir -p {shlex.quote(dirpath)} && cat > {shlex.quote(filepath)}"
+    return ssh_cmd(ssh) + [host, remote_cmd]
+
+
+# Delete a partially written file
+def ssh_delete_cmd(dst: str, ssh: str | None, name: str) -> list[str]:
+    host, path = parse_dst(dst)
+    filepath = posixpath.join(path if path != "" else ".", name)
+    return ssh_cmd(ssh) + [host, f"rm -f {shlex.quote(filepath)}"]
+
+
+def rsync_cmd(ssh: str | None, dry_run: bool, checksum: bool = True, shares: int = 1) -> list[str]:
     cmd = [
         "rsync",
-        # archive mode (=-rlptgoD), use checksum to check if the file is changed
-        "-acv",
+        # archive mode (=-rlptgoD), use checksum (-c) to check if the file is changed
+        "-acv" if checksum else "-av",
         # backup data may contain sensitive data
         # set permission dir=700, file=600 (owner only)
         "--chmod=D700,F600"
-    ]
-    if args.dry_run:
+    ] + util.governor.rsync_opts(shares)
+    if dry_run:
         cmd += ["-n"]
-    if args.ssh:
+    if ssh:
         cmd += [
             "-e",
-            args.ssh,
+            ssh,
         ]
-    cmd += [
-        # SRC
-        str(latest_file),
-        # DST
-        dst,
-    ]
-
-    util.exec(cmd)
+    return cmd
+
+
+# Checksum sidecar of dst/name (None if not found)
+def read_remote_sidecar(dst: str, ssh: str | None, name: str) -> str | None:
+    host, path = parse_dst(dst)
+    if host is None:
+        return util.read_sidecar(pathlib.Path(path) / name)
+    side = posixpath.join(path if path != "" else ".", util.sidecar_path(pathlib.PurePosixPath(name)).name)
+    try:
+        text = util.exec_out(ssh_cmd(ssh) + [host, f"cat {shlex.quote(side)}"])
+    except subprocess.CalledProcessError:
+        return None
+    return util.parse_sidecar(text).get(name)
+
+
+# All checksum sidecars in dst ({archive name: digest}) by one ssh call
+def read_remote_sidecars(dst: str, ssh: str | None) -> dict[str, str]:
+    host, path = parse_dst(dst)
+    if host is None:
+        result = {}
+        for p in pathlib.Path(path).glob(f"*.{util.SIDECAR_EXT}"):
+            result |= util.parse_sidecar(p.read_text(encoding="utf-8", errors="replace"))
+        return result
+    dirpath = shlex.quote(path if path != "" else ".")
+    out = util.exec_out(ssh_cmd(ssh) + [host, f"cat {dirpath}/*.{util.SIDECAR_EXT} 2>/dev/null; true"])
+    return util.parse_sidecar(out)
+
+
+# Read dst/name on the remote host (not locally) and compare with the sidecar
+def verify_remote(dst: str, ssh: str | None, name: str, digest: str, dry_run: bool):
+    host, path = parse_dst(dst)
+    if host is None:
+        actual = "" if dry_run else util.hash_file(pathlib.Path(path) / name)
+    else:
+        filepath = shlex.quote(posixpath.join(path if path != "" else ".", name))
+        out = util.exec_out(ssh_cmd(ssh) + [host, f"sha256sum {filepath}"], dry_run=dry_run)
+        actual = out.split(" ", 1)[0]
+    if dry_run:
+        return
+    if actual != digest:
+        raise RuntimeError(f"Checksum mismatch on {dst}: {name} (expected {digest}, actual {actual})")
+    log.info(f"Verified: {name} (sha256: {digest})")
+
+
+# Previous archive of the same tag, host, kind and codec in src (delta transfer basis)
+def previous_archive(src: pathlib.Path, name: str) -> str | None:
+    group = retention.group_of(name)
+    ext = name.split(".", maxsplit=1)[1]
+    candidates = [
+        e.name for e in util.scan_archives(src)
+        if e.name < name and e.name.split(".", maxsplit=1)[1] == ext and retention.group_of(e.name) == group]
+    return candidates[-1] if candidates else None
+
+
+# Copy dst/prev to dst/name on the destination (copy-then-update)
+# rsync then sends only the blocks which differ from the previous archive.
+# Return True if seeded.
+def seed(dst: str, ssh: str | None, prev: str, name: str, dry_run: bool) -> bool:
+    host, path = parse_dst(dst)
+    log.info(f"Seed {name} from {prev}")
+    if host is None:
+        prev_path = pathlib.Path(path) / prev
+        name_path = pathlib.Path(path) / name
+        if not prev_path.is_file() or name_path.exists():
+            log.info("Seed not found on DST")
+            return False
+        if not dry_run:
+            shutil.copyfile(prev_path, name_path)
+            os.chmod(name_path, 0o600)
+        return True
+
+    dirpath = shlex.quote(path if path != "" else ".")
+    prev_q = shlex.quote(prev)
+    name_q = shlex.quote(name)
+    # reflink (no data copy) if the file system supports it
+    remote_cmd = (
+        f"cd {dirpath} && if [ -f {prev_q} ] && [ ! -e {name_q} ]; then "
+        f"(umask 077 && {{ cp --reflink=auto {prev_q} {name_q} 2>/dev/null || cp {prev_q} {name_q}; }}) "
+        f"|| {{ rm -f {name_q}; exit 1; }}; echo seeded; fi")
+    try:
+        out = util.exec_out(ssh_cmd(ssh) + [host, remote_cmd], dry_run=dry_run)
+    except subprocess.CalledProcessError as e:
+        log.warning(f"Seed failed: {e}")
+        return False
+    if dry_run:
+        return True
+    if out.strip() != "seeded":
+        log.info("Seed not found on DST")
+        return False
+    return True
+
+
+def write_list(path: pathlib.Path, names: list[str]):
+    with path.open("w", encoding="utf-8", newline="\n") as fout:
+        for name in names:
+            fout.write(f"{name}\n")
+
+
+# Send all archive files missing on (or different from) dst
+# Archives whose checksum sidecars match the remote ones are skipped,
+# archives whose sidecars differ are sent again, and the others are
+# compared by rsync dry run by name, size and mtime (archive mode keeps mtime).
+# Then up to transfers rsync processes share the total bandwidth.
+def upload_all_missing(args: argparse.Namespace, src: pathlib.Path, dst: str):
+    if args.transfers < 1:
+        raise RuntimeError("--transfers must be >= 1")
+    if (src / snapshot.CHUNK_DIR).is_dir():
+        log.warning(f"Snapshot manifests in {src} are not uploaded (they need the chunk store): use sync")
+    names = [e.name for e in util.scan_archives(src)]
+    log.info(f"{len(names)} local archive files")
+    local_digests = {name: util.read_sidecar(src / name) for name in names}
+    remote_digests = read_remote_sidecars(dst, args.ssh)
+
+    missing = []
+    unknown = []
+    for name in names:
+        local_digest = local_digests[name]
+        remote_digest = remote_digests.get(name)
+        if local_digest is None or remote_digest is None:
+            unknown.append(name)
+        elif local_digest != remote_digest:
+            log.info(f"checksum differs: {name}")
+            missing.append(name)
+    log.info(f"{len(names) - len(missing) - len(unknown)} file(s) matched by checksum sidecars")
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        if unknown:
+            all_list = pathlib.Path(tmpdir) / "all.txt"
+            write_list(all_list, unknown)
+            cmd = rsync_cmd(args.ssh, dry_run=True, checksum=False) + [
+                "--out-format=%n", f"--files-from={all_list}", f"{src}/", dst]
+            out = util.exec_out(cmd)
+            # other lines: file list and stats of -v
+            name_set = set(unknown)
+            missing += [line for line in out.splitlines() if line in name_set]
+        log.info(f"{len(missing)} file(s) to upload")
+        if not missing:
+            return
+
+        groups = [missing[i::args.transfers] for i in range(min(args.transfers, len(missing)))]
+
+        def run(i: int):
+            group_list = pathlib.Path(tmpdir) / f"group{i}.txt"
+            # with checksum sidecars and indexes
+            files = []
+            for name in groups[i]:
+                files.append(name)
+                files += [p.name for p in util.companion_paths(src / name) if p.is_file()]
+            write_list(group_list, files)
+            # already compared: send without the quick check (size and mtime)
+            cmd = rsync_cmd(args.ssh, args.dry_run, checksum=False, shares=len(groups)) + ["--ignore-times"]
+            if args.delta:
+                # basis: a similarly named file (the previous archive) on dst
+                cmd += ["--fuzzy", "--no-whole-file"]
+            cmd += [f"--files-from={group_list}", f"{src}/", dst]
+            util.exec_rsync(cmd)
+            if args.verify:
+                for name in groups[i]:
+                    if local_digests[name] is not None:
+                        verify_remote(dst, args.ssh, name, local_digests[name], args.dry_run)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(groups)) as executor:
+            futures = [executor.submit(metrics.bind(run), i) for i in range(len(groups))]
+            errors = [f.exception() for f in futures if f.exception() is not None]
+    for e in errors:
+        log.error(f"rsync failed: {e}")
+    if errors:
+        raise RuntimeError(f"{len(errors)} rsync(s) failed")
+
+
+def upload(args: argparse.Namespace):
+    src = pathlib.Path(args.src)
+
+    dst: str = args.dst
+    if not dst.endswith("/"):
+        dst += "/"
+
+    if args.all_missing:
+        upload_all_missing(args, src, dst)
+        log.info("OK")
+        return
+
+    for latest_file in util.read_latest(src):
+        upload_latest(args, src, dst, latest_file)
     log.info("OK")
 
 
+def upload_latest(args: argparse.Namespace, src: pathlib.Path, dst: str, latest_file: pathlib.Path):
+    # compare checksum sidecars instead of reading the archive on both hosts (rsync -c)
+    seeded = False
+    local_digest = util.read_sidecar(latest_file)
+    if local_digest is None:
+        log.info("Checksum sidecar not found: compare by rsync checksum")
+        cmd = rsync_cmd(args.ssh, args.dry_run) + [str(latest_file), dst]
+    else:
+        with trace.span("remote sidecar"):
+            remote_digest = read_remote_sidecar(dst, args.ssh, latest_file.name)
+        log.info(f"sha256 local: {local_digest}, remote: {remote_digest or '-'}")
+        if remote_digest == local_digest:
+            log.info(f"Already uploaded: {latest_file.name}")
+            if args.verify:
+                verify_remote(dst, args.ssh, latest_file.name, local_digest, args.dry_run)
+            return
+        cmd = rsync_cmd(args.ssh, args.dry_run, checksum=False)
+        if remote_digest is not None:
+            # the remote archive differs: send without the quick check (size and mtime)
+            cmd += ["--ignore-times"]
+        elif args.delta:
+            prev = previous_archive(src, latest_file.name)
+            if prev is None:
+                log.info("Previous archive not found: send the whole file")
+            elif seed(dst, args.ssh, prev, latest_file.name, args.dry_run):
+                seeded = True
+                cmd += ["--ignore-times"]
+        if args.delta:
+            # rsync sends whole files between local paths by default
+            cmd += ["--no-whole-file"]
+        cmd += [
+            # SRC (archive and its companion files)
+            str(latest_file),
+        ] + [str(p) for p in util.companion_paths(latest_file) if p.is_file()] + [
+            # DST
+            dst,
+        ]
+
+    try:
+        util.exec_rsync(cmd)
+    except BaseException:
+        if seeded:
+            # do not leave the previous archive with the new name
+            host, path = parse_dst(dst)
+            if host is None:
+                (pathlib.Path(path) / latest_file.name).unlink(missing_ok=True)
+            else:
+                util.exec(ssh_delete_cmd(dst, args.ssh, latest_file.name), check=False)
+        raise
+    if args.verify and local_digest is not None:
+        verify_remote(dst, args.ssh, latest_file.name, local_digest, args.dry_run)
+
+
 def main(argv: list[str]):
     parser = argparse.ArgumentParser(
         prog=argv[0],
-        description="Copy the latest archive file to a remote host by rsync",
+        description="Copy the latest archive file(s) to a remote host by rsync",
     )
     parser.add_argument("--src", "-s", required=True, help="archive dir")
     parser.add_argument("--dst", "-d", required=True, help="rsync destination (user@host:dir)")
     parser.add_argument("--ssh", help='ssh command line (e.g. --ssh "ssh -p 12345")')
+    parser.add_argument("--all-missing", action="store_true", help="send all archive files missing on DST, not only the latest")
+    parser.add_argument("--transfers", type=int, default=4, help="rsync processes running at the same time (--all-missing)")
+    parser.add_argument("--delta", action="store_true",
+                        help="send only the differences from the previous archive on DST (archive --rsyncable)")
+    parser.add_argument("--verify", action="store_true",
+                        help="read the uploaded archive on the remote host and compare with the checksum sidecar")
     parser.add_argument("--dry-run", "-n", action="store_true", help="dry run")
 
     args = parser.parse_args(argv[1:])
@@ -1,18 +1,174 @@
 import logging
 import os
+import json
+import configparser
+import hashlib
+import typing
 import pathlib
 import platform
 import subprocess
 import re
+import sqlite3
+import threading
+import signal
+import time
+import shutil
+from . import metrics, trace
 
 log: logging.Logger = logging.getLogger(__name__)
 
 
+# Parse "10M" style size (K/M/G = 1024^n) to bytes
+def parse_size(s: str) -> int:
+    units = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    m = re.fullmatch(r"(\d+(?:\.\d+)?)([KMG]?)B?", s.strip().upper())
+    if m is None:
+        raise RuntimeError(f"Invalid size: {s}")
+    return int(float(m.group(1)) * units[m.group(2)])
+
+
+# Resource governor for backup jobs running on production hosts
+# Configured once by bkup.py global options and applied to all child processes.
+class Governor:
+    # check interval of --max-load (sec)
+    LOAD_INTERVAL = 5.0
+    # resume if load average < max_load * LOAD_RESUME
+    LOAD_RESUME = 0.8
+
+    def __init__(self):
+        self.nice: int | None = None
+        # idle, best-effort[:0-7], realtime[:0-7]
+        self.ionice: str | None = None
+        # compressor threads (0: all cores)
+        self.threads: int = 0
+        # bytes/sec
+        self.bwlimit: int | None = None
+        # pause child processes while the 1 min load average exceeds this
+        self.max_load: float | None = None
+        self._bw_lock = threading.Lock()
+        self._bw_next = 0.0
+
+    # Lower CPU and I/O priority of this process
+    # (inherited by all child processes, including worker processes)
+    def apply(self):
+        if is_win():
+            if self.nice is not None or self.ionice is not None:
+                log.warning("--nice and --ionice are unavailable on Windows")
+            return
+        if self.nice is not None:
+            log.info(f"nice: {os.nice(self.nice)}")
+        if self.ionice is not None:
+            cls, _, level = self.ionice.partition(":")
+            classes = {"realtime": "1", "best-effort": "2", "idle": "3"}
+            if cls not in classes:
+                raise RuntimeError(f"Invalid ionice class: {cls}")
+            if shutil.which("ionice") is None:
+                log.warning("ionice not found, --ionice is ignored")
+                return
+            cmd = ["ionice", "-c", classes[cls]]
+            if level:
+                cmd += ["-n", level]
+            exec(cmd + ["-p", str(os.getpid())])
+
+    def compress_threads(self, threads: int) -> int:
+        if threads > 0:
+            return threads
+        if self.threads > 0:
+            return self.threads
+        return os.cpu_count()
+
+    # shares: split bwlimit into parallel processes
+    def rsync_opts(self, shares: int = 1) -> list[str]:
+        if self.bwlimit is None:
+            return []
+        # KiB/s
+        return [f"--bwlimit={max(self.bwlimit // shares // 1024, 1)}"]
+
+    def rclone_opts(self) -> list[str]:
+        if self.bwlimit is None:
+            return []
+        return ["--bwlimit", f"{max(self.bwlimit // 1024, 1)}K"]
+
+    # docker run options for containers (not children of this process)
+    def docker_opts(self) -> list[str]:
+        opts = []
+        if self.threads > 0:
+            opts.append(f"--cpus={self.threads}")
+        if self.nice is not None and self.nice > 0:
+            # default 1024
+            opts.append(f"--cpu-shares={max(1024 >> (self.nice // 4 + 1), 2)}")
+        if self.ionice is not None and self.ionice.startswith("idle"):
+            opts.append("--blkio-weight=10")
+        return opts
+
+    # Sleep to keep total throughput of streams under bwlimit
+    def throttle(self, size: int):
+        if self.bwlimit is None:
+            return
+        with self._bw_lock:
+            now = time.monotonic()
+            start = max(self._bw_next, now)
+            self._bw_next = start + size / self.bwlimit
+        if start > now:
+            time.sleep(start - now)
+
+    # Pause (SIGSTOP) the process group while load average is high
+    def watch(self, proc: subprocess.Popen):
+        if self.max_load is None or is_win():
+            return
+
+        def run():
+            paused = False
+            while proc.poll() is None:
+                load = os.getloadavg()[0]
+                try:
+                    if not paused and load > self.max_load:
+                        log.info(f"Pause pid={proc.pid} (load {load:.2f} > {self.max_load})")
+                        os.killpg(proc.pid, signal.SIGSTOP)
+                        paused = True
+                    elif paused and load < self.max_load * self.LOAD_RESUME:
+                        log.info(f"Resume pid={proc.pid} (load {load:.2f})")
+                        os.killpg(proc.pid, signal.SIGCONT)
+                        paused = False
+                except ProcessLookupError:
+                    break
+                time.sleep(self.LOAD_INTERVAL)
+            if paused:
+                try:
+                    os.killpg(proc.pid, signal.SIGCONT)
+                except ProcessLookupError:
+                    pass
+
+        threading.Thread(target=run, name=f"governor-{proc.pid}", daemon=True).start()
+
+
+governor = Governor()
+
+
+# Popen with governor
+def popen(cmd: list[str], **kwargs) -> subprocess.Popen:
+    # own process group to pause all of its descendants
+    if governor.max_load is not None and not is_win():
+        kwargs["start_new_session"] = True
+    # with --metrics / --trace: CPU time and max RSS of the child are recorded when it is reaped
+    proc = metrics.popen_class()(cmd, **kwargs)
+    governor.watch(proc)
+    return proc
+
+
 # Print command and run
 def exec(cmd: list[str], *, dry_run: bool = False, cwd: str | None = None, check: bool = True):
     log.info(f"EXEC: {' '.join(cmd)}")
     if not dry_run:
-        return subprocess.run(cmd, check=check, cwd=cwd).returncode
+        with popen(cmd, cwd=cwd) as proc:
+            try:
+                proc.wait()
+            except BaseException:
+                proc.kill()
+                raise
+        if check and proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, cmd)
+        return proc.returncode
     else:
         log.info("dry_run")
         return 0
@@ -22,13 +178,287 @@ def exec(cmd: list[str], *, dry_run: bool = False, cwd: str | None = None, check
 def exec_out(cmd: list[str], *, dry_run: bool = False) -> str:
     log.info(f"EXEC: {' '.join(cmd)}")
     if not dry_run:
-        proc = subprocess.run(cmd, check=True, text=True, stdout=subprocess.PIPE, stderr=None)
-        return proc.stdout
+        with popen(cmd, text=True, stdout=subprocess.PIPE, stderr=None) as proc:
+            try:
+                stdout, _ = proc.communicate()
+            except BaseException:
+                proc.kill()
+                raise
+        if proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, cmd, stdout)
+        return stdout
     else:
         log.info("dry_run")
         return ""
 
 
+# Print command, run, and pass each stdout line to on_line (stderr will be as is)
+def exec_lines(
+        cmd: list[str], on_line: typing.Callable[[str], None], *,
+        dry_run: bool = False, check: bool = True) -> int:
+    log.info(f"EXEC: {' '.join(cmd)}")
+    if dry_run:
+        log.info("dry_run")
+        return 0
+
+    with popen(cmd, text=True, stdout=subprocess.PIPE, stderr=None) as proc:
+        try:
+            for line in proc.stdout:
+                on_line(line.rstrip("\n"))
+        except BaseException:
+            proc.kill()
+            raise
+    if check and proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+    return proc.returncode
+
+
+# rsync --stats lines => metrics counters
+_RSYNC_STATS = {
+    "Number of regular files transferred": metrics.FILES,
+    "Total bytes sent": metrics.TRANSFERRED_BYTES,
+}
+
+
+# Record a line of rsync --stats (e.g. "Total bytes sent: 1,234") to metrics
+def rsync_stat(line: str):
+    key, sep, value = line.partition(": ")
+    if sep and key in _RSYNC_STATS:
+        m = re.match(r"[\d,.]+", value)
+        if m:
+            metrics.recorder.add(_RSYNC_STATS[key], int(re.sub(r"[,.]", "", m.group(0))))
+
+
+# Print rsync command, run with --stats, and print its output (stats are recorded to metrics)
+def exec_rsync(cmd: list[str], *, check: bool = True) -> int:
+    def on_line(line: str):
+        rsync_stat(line)
+        print(line, flush=True)
+    return exec_lines(cmd[:1] + ["--stats"] + cmd[1:], on_line, check=check)
+
+
+TEE_BUFSIZE = 1024 * 1024
+
+
+class TapReader:
+    # file-like object (read only) over the stdout of a command
+    # forwarding bytes to the stdin of the next command in large chunks
+    def __init__(self, src: typing.BinaryIO, dst: typing.BinaryIO):
+        self.src = src
+        self.dst = dst
+        self.broken = False
+        self.buf = b""
+        self.pos = 0
+        # bytes read from src
+        self.size = 0
+
+    def _fill(self) -> bool:
+        self.buf = self.src.read1(TEE_BUFSIZE) if hasattr(self.src, "read1") else self.src.read(TEE_BUFSIZE)
+        self.pos = 0
+        self.size += len(self.buf)
+        if self.buf and not self.broken:
+            try:
+                self.dst.write(self.buf)
+            except (OSError, ValueError):
+                # the next command is stopped (reported by its return code)
+                self.broken = True
+        return bool(self.buf)
+
+    def read(self, size: int = -1) -> bytes:
+        if self.pos >= len(self.buf) and not self._fill():
+            return b""
+        end = len(self.buf) if size is None or size < 0 else min(self.pos + size, len(self.buf))
+        data = self.buf[self.pos:end]
+        self.pos = end
+        return data
+
+    # forward the rest (the tap stopped reading)
+    def drain(self):
+        while self._fill():
+            pass
+
+
+# Thread: tap(reader) reads the stream between two commands
+# The stream is always forwarded to the end (an error of tap is only logged).
+def _run_tap(tap: typing.Callable[[typing.BinaryIO], None], reader: TapReader):
+    src = reader.src
+    dst = reader.dst
+    try:
+        try:
+            with trace.span("tap"):
+                tap(reader)
+        except Exception as e:
+            log.warning(f"Stream tap error: {e}")
+        reader.drain()
+    except (OSError, ValueError):
+        # the pipeline is stopped
+        pass
+    finally:
+        for f in (src, dst):
+            try:
+                f.close()
+            except OSError:
+                pass
+
+
+# Print command pipeline, run, and copy the stdout of the last command to outs
+# with computing size and SHA-256 in the stream.
+# tap: function which reads the stream between the first and the second command
+# in another thread (e.g. file listing of the tar stream)
+# Return (return codes, size, sha256 hex digest)
+def exec_tee(
+        cmds: list[list[str]], outs: list[typing.BinaryIO], *,
+        dry_run: bool = False, check: bool = True,
+        tap: typing.Callable[[typing.BinaryIO], None] | None = None) -> tuple[list[int], int, str]:
+    log.info(f"EXEC: {' | '.join(map(' '.join, cmds))} | (tee)")
+    if dry_run:
+        log.info("dry_run")
+        return [0] * len(cmds), 0, ""
+
+    procs: list[subprocess.Popen] = []
+    stdin = None
+    tapper = None
+    reader = None
+    h = hashlib.sha256()
+    size = 0
+    try:
+        for cmd in cmds:
+            if tapper is None and tap is not None and stdin is not None:
+                proc = popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+                reader = TapReader(stdin, proc.stdin)
+                tapper = threading.Thread(target=metrics.bind(_run_tap), args=(tap, reader))
+                tapper.start()
+            else:
+                proc = popen(cmd, stdin=stdin, stdout=subprocess.PIPE)
+                if stdin is not None:
+                    stdin.close()
+            stdin = proc.stdout
+            procs.append(proc)
+
+        while True:
+            buf = stdin.read(TEE_BUFSIZE)
+            if not buf:
+                break
+            h.update(buf)
+            size += len(buf)
+            governor.throttle(len(buf))
+            for out in outs:
+                out.write(buf)
+    except BaseException:
+        for proc in procs:
+            proc.kill()
+            proc.wait()
+        raise
+    finally:
+        if stdin is not None:
+            stdin.close()
+        if tapper is not None:
+            tapper.join()
+
+    returncodes = [proc.wait() for proc in procs]
+    if reader is not None:
+        # stream between the first and the second command (e.g. tar stream)
+        metrics.recorder.add(metrics.INPUT_BYTES, reader.size)
+    metrics.recorder.add(metrics.OUTPUT_BYTES, size)
+    if check:
+        for cmd, returncode in zip(cmds, returncodes):
+            if returncode != 0:
+                raise subprocess.CalledProcessError(returncode, cmd)
+    return returncodes, size, h.hexdigest()
+
+
+# Print command pipeline and run (cmd1 | cmd2 | ... > stdout_path)
+# SHA-256 of the output is computed in the same stream (no extra read).
+# The output file is created with permission 600.
+# If check is True, raise CalledProcessError of the first failed command.
+# Return (return codes, sha256 hex digest ("" if dry_run))
+def exec_pipe(
+        cmds: list[list[str]], stdout_path: str | os.PathLike, *,
+        dry_run: bool = False, check: bool = True,
+        tap: typing.Callable[[typing.BinaryIO], None] | None = None) -> tuple[list[int], str]:
+    if dry_run:
+        log.info(f"EXEC: {' | '.join(map(' '.join, cmds))} > {stdout_path}")
+        log.info("dry_run")
+        return [0] * len(cmds), ""
+    fd = os.open(stdout_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o600)
+    with os.fdopen(fd, "wb") as fout:
+        returncodes, size, sha256 = exec_tee(cmds, [fout], check=check, tap=tap)
+    log.info(f"{size} bytes written: {stdout_path}")
+    return returncodes, sha256
+
+
+# Print command, run with data as stdin
+def exec_input(cmd: list[str], data: bytes, *, dry_run: bool = False):
+    log.info(f"EXEC: {' '.join(cmd)} (stdin: {len(data)} bytes)")
+    if dry_run:
+        log.info("dry_run")
+        return
+    with popen(cmd, stdin=subprocess.PIPE) as proc:
+        try:
+            proc.communicate(data)
+        except BaseException:
+            proc.kill()
+            raise
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+
+# Checksum sidecar: NAME.sha256 next to the archive (sha256sum format)
+# written while the archive is written, and compared with the remote copy
+# instead of reading the archive (rsync -c).
+SIDECAR_EXT = "sha256"
+
+
+def sidecar_path(path: pathlib.Path) -> pathlib.Path:
+    return path.with_name(f"{path.name}.{SIDECAR_EXT}")
+
+
+# Index of seekable archives (python engine)
+INDEX_EXT = "idx.json.gz"
+# File listing for the catalog (path, size, mtime, sha256)
+LISTING_EXT = "files.json.gz"
+# Files named NAME.EXT which belong to the archive NAME
+# (copied and deleted with the archive)
+COMPANION_EXTS = [SIDECAR_EXT, INDEX_EXT, LISTING_EXT]
+
+
+def companion_paths(path: pathlib.Path) -> list[pathlib.Path]:
+    return [path.with_name(f"{path.name}.{ext}") for ext in COMPANION_EXTS]
+
+
+def sidecar_text(name: str, digest: str) -> str:
+    return f"{digest}  {name}\n"
+
+
+# Return {name: digest} (sha256sum output, multiple lines OK)
+def parse_sidecar(text: str) -> dict[str, str]:
+    result = {}
+    for line in text.splitlines():
+        m = re.fullmatch(r"([0-9a-fA-F]{64}) [ *](.+)", line.strip())
+        if m is not None:
+            result[m.group(2)] = m.group(1).lower()
+    return result
+
+
+def write_sidecar(path: pathlib.Path, digest: str, dry_run: bool = False):
+    side = sidecar_path(path)
+    log.info(f"Write checksum: {side} (sha256: {digest})")
+    if dry_run:
+        return
+    fd = os.open(side, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w", encoding="utf-8", newline="\n") as fout:
+        fout.write(sidecar_text(path.name, digest))
+
+
+# Digest in the sidecar of path or None
+def read_sidecar(path: pathlib.Path) -> str | None:
+    try:
+        text = sidecar_path(path).read_text(encoding="utf-8")
+    except OSError:
+        return None
+    return parse_sidecar(text).get(path.name)
+
+
 # [not-num*]YYYYMMDD[num*]
 _PAT = re.compile(r"^(.*)\D(\d{8,})$")
 # archive file extensions
@@ -36,20 +466,27 @@ _EXTS = {
     "tar.gz",
     "tar.bz2",
     "tar.xz",
+    "tar.zst",
+    "tar.lz4",
     "zip",
     "7z",
 }
 
 
-def name_parse_str(path: str) -> tuple[str, str] | None:
+# Glob patterns of archive files (e.g. rclone --include)
+def archive_patterns() -> list[str]:
+    return [f"*.{ext}" for ext in sorted(_EXTS)]
+
+
+def name_parse_str(path: str, exts: typing.Collection[str] = _EXTS) -> tuple[str, str] | None:
     # split at the first "."
     tokens = path.split(".", maxsplit=1)
     if len(tokens) < 2:
-        return False
+        return None
     noext, ext = tokens
 
-    if ext not in _EXTS:
-        return False
+    if ext not in exts:
+        return None
 
     m = _PAT.match(noext)
     if m:
@@ -71,6 +508,30 @@ def name_filter(path: pathlib.Path) -> bool:
     return name_filter_str(path.name)
 
 
+# Archive files listed in dir/latest.txt
+# (one per line, several archives for dockervol --per-volume)
+def read_latest(dir: pathlib.Path) -> list[pathlib.Path]:
+    latest = dir / "latest.txt"
+    log.info(f"Read the latest archive: {latest}")
+    with latest.open() as fin:
+        files = [dir / line.strip() for line in fin if line.strip()]
+    if not files:
+        raise RuntimeError(f"{latest} is empty")
+    for f in files:
+        log.info(f"The latest archive: {f}")
+        if not f.is_file():
+            raise RuntimeError(f"{f} is not a valid file")
+    return files
+
+
+# Archive files in dir (sorted by name)
+def scan_archives(dir: str | os.PathLike) -> list[os.DirEntry]:
+    with os.scandir(dir) as it:
+        entries = [e for e in it if name_filter_str(e.name) and e.is_file()]
+    entries.sort(key=lambda e: e.name)
+    return entries
+
+
 _is_wsl: bool | None = None
 
 
@@ -81,9 +542,10 @@ def is_wsl() -> bool:
 
     try:
         # ignore exit code and output
-        subprocess.run(
-            ["wslpath"], check=False,
-            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        with trace.span("wslpath", "probe"):
+            subprocess.run(
+                ["wslpath"], check=False,
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
     except FileNotFoundError:
         _is_wsl = False
         return _is_wsl
@@ -96,43 +558,332 @@ def is_win() -> bool:
     return platform.system() == "Windows"
 
 
-def to_winpath(wslpath: str | os.PathLike) -> pathlib.PureWindowsPath | None:
-    assert is_wsl()
+# WSL <=> Windows path and Windows environment variable translation
+# /mnt/<drive> paths are converted directly, other paths by one batched
+# wslpath call, and Windows environment variables by one powershell call.
+# Results are cached in memory and on disk (cache_dir()/wsl.json).
+# The disk cache is invalidated after WSL_CACHE_TTL, or if the distro or
+# /etc/wsl.conf (automount root) is changed.
+class WslBridge:
+    WSL_CONF = "/etc/wsl.conf"
+    CACHE_NAME = "wsl.json"
+    CACHE_VERSION = 1
+    WSL_CACHE_TTL = 24 * 60 * 60
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.cache: dict | None = None
+        self.dirty = False
+        self._root: str | None = None
+        self._mounts: dict[str, bool] = {}
+
+    # [automount] root of wsl.conf (default /mnt/)
+    def automount_root(self) -> str:
+        if self._root is None:
+            parser = configparser.ConfigParser(interpolation=None)
+            try:
+                parser.read(self.WSL_CONF, encoding="utf-8")
+                root = parser.get("automount", "root", fallback="/mnt/").strip().strip('"')
+            except (OSError, configparser.Error) as e:
+                log.warning(f"Cannot read {self.WSL_CONF}: {e}")
+                root = "/mnt/"
+            self._root = root.rstrip("/") + "/"
+        return self._root
+
+    def _cache_key(self) -> dict:
+        try:
+            conf_mtime = os.stat(self.WSL_CONF).st_mtime_ns
+        except OSError:
+            conf_mtime = 0
+        return {
+            "version": self.CACHE_VERSION,
+            "distro": os.getenv("WSL_DISTRO_NAME", ""),
+            "conf_mtime": conf_mtime,
+        }
+
+    def _load(self) -> dict:
+        if self.cache is not None:
+            return self.cache
+        key = self._cache_key()
+        path = cache_dir() / self.CACHE_NAME
+        try:
+            with path.open(encoding="utf-8") as fin:
+                cache = json.load(fin)
+            if cache.get("key") != key or time.time() - cache.get("time", 0) > self.WSL_CACHE_TTL:
+                log.debug(f"WSL cache expired: {path}")
+                cache = None
+        except (OSError, ValueError):
+            cache = None
+        if cache is None:
+            cache = {"key": key, "time": time.time(), "winpath": {}, "wslpath": {}, "env": {}}
+        self.cache = cache
+        return cache
+
+    def _save(self):
+        if not self.dirty:
+            return
+        path = cache_dir() / self.CACHE_NAME
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        try:
+            with tmp.open("w", encoding="utf-8") as fout:
+                json.dump(self.cache, fout)
+            os.replace(tmp, path)
+        except OSError as e:
+            log.warning(f"Cannot write WSL cache: {e}")
+            tmp.unlink(missing_ok=True)
+        self.dirty = False
+
+    def _is_mount(self, drive: str) -> bool:
+        if drive not in self._mounts:
+            self._mounts[drive] = os.path.ismount(self.automount_root() + drive)
+        return self._mounts[drive]
+
+    # /mnt/c/foo => C:\foo (None if not a drive path)
+    def drive_to_win(self, path: str) -> pathlib.PureWindowsPath | None:
+        root = self.automount_root()
+        m = re.fullmatch(re.escape(root) + r"([a-zA-Z])(?:/(.*))?", path, re.DOTALL)
+        if m is None or not self._is_mount(m.group(1)):
+            return None
+        rest = [part for part in (m.group(2) or "").split("/") if part]
+        return pathlib.PureWindowsPath(f"{m.group(1).upper()}:\\", *rest)
+
+    # C:\foo => /mnt/c/foo (None if not a drive path)
+    def drive_to_wsl(self, winpath: str) -> pathlib.Path | None:
+        m = re.fullmatch(r"([a-zA-Z]):[\\/](.*)", winpath, re.DOTALL)
+        if m is None:
+            return None
+        rest = [part for part in re.split(r"[\\/]", m.group(2)) if part]
+        return pathlib.Path(self.automount_root() + m.group(1).lower(), *rest)
+
+    # Run "wslpath OPT path" for all paths in one process
+    # (empty string for a path wslpath cannot convert)
+    def _wslpath(self, opt: str, paths: list[str]) -> list[str]:
+        script = f'for p; do wslpath {opt} "$p" || echo; done'
+        with trace.span("wslpath", "probe", {"paths": len(paths)}):
+            proc = subprocess.run(
+                ["sh", "-c", script, "sh", *paths],
+                check=True, text=True, stdout=subprocess.PIPE, stderr=None)
+        lines = proc.stdout.splitlines()
+        if len(lines) != len(paths):
+            raise RuntimeError(f"wslpath: unexpected output: {proc.stdout!r}")
+        return [line.strip() for line in lines]
+
+    def _translate(self, kind: str, opt: str, paths: list[str], direct) -> list[str]:
+        with self.lock:
+            cache = self._load()[kind]
+            result: dict[str, str] = {}
+            query = []
+            for p in paths:
+                converted = direct(p)
+                if converted is not None:
+                    result[p] = str(converted)
+                elif p in cache:
+                    result[p] = cache[p]
+                elif p not in query:
+                    query.append(p)
+            if query:
+                for p, converted in zip(query, self._wslpath(opt, query)):
+                    result[p] = cache[p] = converted
+                self.dirty = True
+                self._save()
+            return [result[p] for p in paths]
+
+    def to_winpaths(self, paths: typing.Iterable[str | os.PathLike]) -> list[pathlib.PureWindowsPath | None]:
+        assert is_wsl()
+        paths = [os.path.abspath(p) for p in paths]
+        result = []
+        for converted in self._translate("winpath", "-wa", paths, self.drive_to_win):
+            # not convertible or \\wsl$, \\wsl.localhost (linux file system)
+            if not converted or converted.startswith("\\\\wsl"):
+                result.append(None)
+            else:
+                result.append(pathlib.PureWindowsPath(converted))
+        return result
+
+    def to_wslpaths(self, winpaths: typing.Iterable[str | os.PathLike]) -> list[pathlib.Path]:
+        assert is_wsl()
+        winpaths = [str(p) for p in winpaths]
+        converted = self._translate("wslpath", "-ua", winpaths, self.drive_to_wsl)
+        for winpath, p in zip(winpaths, converted):
+            if not p:
+                raise RuntimeError(f"wslpath: cannot convert: {winpath}")
+        return [pathlib.Path(p) for p in converted]
+
+    # Missing variables are ""
+    def winenvs(self, names: typing.Iterable[str]) -> dict[str, str]:
+        assert is_wsl()
+        names = list(names)
+        with self.lock:
+            cache = self._load()["env"]
+            query = [name for name in dict.fromkeys(names) if name not in cache]
+            if query:
+                for name in query:
+                    if not re.fullmatch(r"[A-Za-z_][A-Za-z0-9_()]*", name):
+                        raise RuntimeError(f"Invalid environment variable name: {name}")
+                script = "@{" + "; ".join(f"'{name}'=${{env:{name}}}" for name in query) + "} | ConvertTo-Json -Compress"
+                with trace.span("powershell.exe", "probe", {"names": len(query)}):
+                    proc = subprocess.run(
+                        ["powershell.exe", "-NoProfile", "-NonInteractive", "-Command", script],
+                        check=True, text=True, stdout=subprocess.PIPE, stderr=None)
+                values = json.loads(proc.stdout)
+                for name in query:
+                    cache[name] = values.get(name) or ""
+                self.dirty = True
+                self._save()
+            return {name: cache[name] for name in names}
+
+
+wsl = WslBridge()
 
-    proc = subprocess.run(
-        ["wslpath", "-wa", str(wslpath)],
-        check=True, text=True, stdout=subprocess.PIPE, stderr=None)
-    result = proc.stdout.strip()
 
-    if result.startswith("\\\\wsl"):
-        return None
-    else:
-        return pathlib.PureWindowsPath(result)
+def to_winpath(wslpath: str | os.PathLike) -> pathlib.PureWindowsPath | None:
+    return wsl.to_winpaths([wslpath])[0]
 
 
-def to_wslpath(winpath: str | os.PathLike) -> pathlib.Path:
-    assert is_wsl()
+def to_winpaths(wslpaths: typing.Iterable[str | os.PathLike]) -> list[pathlib.PureWindowsPath | None]:
+    return wsl.to_winpaths(wslpaths)
 
-    proc = subprocess.run(
-        ["wslpath", "-ua", str(winpath)],
-        check=True, text=True, stdout=subprocess.PIPE, stderr=None)
 
-    return pathlib.Path(proc.stdout.strip())
+def to_wslpath(winpath: str | os.PathLike) -> pathlib.Path:
+    return wsl.to_wslpaths([winpath])[0]
 
 
 # Win/WSL only
-def get_winenv(name: str) -> str:
+# Missing variables are ""
+def get_winenvs(names: typing.Iterable[str]) -> dict[str, str]:
     if is_win():
-        return os.getenv(name, "")
+        return {name: os.getenv(name, "") for name in names}
     else:
-        assert is_wsl()
-        proc = subprocess.run(
-            ["powershell.exe", f"$env:{name}"],
-            check=True, text=True, stdout=subprocess.PIPE, stderr=None)
+        return wsl.winenvs(names)
 
-        return proc.stdout.strip()
+
+# Win/WSL only
+def get_winenv(name: str) -> str:
+    return get_winenvs([name])[name]
 
 
 # Win/WSL only
 def get_winuser() -> str:
     return get_winenv("UserName")
+
+
+# Per-user cache dir (XDG_CACHE_HOME/bkup, %LOCALAPPDATA%/bkup)
+def cache_dir() -> pathlib.Path:
+    if is_win():
+        base = os.getenv("LOCALAPPDATA")
+    else:
+        base = os.getenv("XDG_CACHE_HOME")
+    if not base:
+        base = pathlib.Path.home() / ".cache"
+    path = pathlib.Path(base) / "bkup"
+    path.mkdir(mode=0o700, parents=True, exist_ok=True)
+    return path
+
+
+HASH_BUFSIZE = 1024 * 1024
+
+
+def hash_file(path: str | os.PathLike, algo: str = "sha256") -> str:
+    h = hashlib.new(algo)
+    with open(path, "rb") as fin:
+        while buf := fin.read(HASH_BUFSIZE):
+            h.update(buf)
+    return h.hexdigest()
+
+
+# Persistent file hash cache shared by subcommands
+# (algo, device, inode) => (size, mtime_ns, digest)
+# An entry is valid only if size and mtime_ns are not changed.
+# A resident process (daemon subcommand) enables the in-memory index
+# (HashCache.enable_memory()), which is kept between instances and skips
+# the database lookup of files seen by previous runs.
+class HashCache:
+    MEMORY_MAX = 1000000
+    memory: dict[tuple, tuple] | None = None
+    memory_lock = threading.Lock()
+
+    @classmethod
+    def enable_memory(cls):
+        with cls.memory_lock:
+            if cls.memory is None:
+                cls.memory = {}
+
+    def _remember(self, key: tuple, value: tuple):
+        memory = HashCache.memory
+        if memory is None:
+            return
+        with HashCache.memory_lock:
+            if len(memory) >= self.MEMORY_MAX and key not in memory:
+                memory.clear()
+            memory[key] = value
+
+    def __init__(self, path: str | os.PathLike | None = None):
+        if path is None:
+            path = cache_dir() / "hashcache.sqlite3"
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS hash ("
+            "algo TEXT, dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER, digest TEXT, "
+            "PRIMARY KEY (algo, dev, ino))")
+        self.hit = 0
+        self.miss = 0
+
+    # Lookup only (metadata only, no file read)
+    def get(self, st: os.stat_result, algo: str = "sha256") -> str | None:
+        # inode is not available (e.g. DirEntry.stat() on Windows)
+        if st.st_ino == 0:
+            return None
+        key = (algo, st.st_dev, st.st_ino)
+        memory = HashCache.memory
+        if memory is not None:
+            entry = memory.get(key)
+            if entry is not None and entry[:2] == (st.st_size, st.st_mtime_ns):
+                with self.lock:
+                    self.hit += 1
+                return entry[2]
+        with self.lock:
+            row = self.db.execute(
+                "SELECT digest FROM hash WHERE algo = ? AND dev = ? AND ino = ? AND size = ? AND mtime_ns = ?",
+                (algo, st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)).fetchone()
+            if row is not None:
+                self.hit += 1
+            else:
+                self.miss += 1
+        if row is None:
+            return None
+        self._remember(key, (st.st_size, st.st_mtime_ns, row[0]))
+        return row[0]
+
+    def put(self, st: os.stat_result, digest: str, algo: str = "sha256"):
+        if st.st_ino == 0:
+            return
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO hash VALUES (?, ?, ?, ?, ?, ?)",
+                (algo, st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, digest))
+        self._remember((algo, st.st_dev, st.st_ino), (st.st_size, st.st_mtime_ns, digest))
+
+    # Lookup, or read and hash the file
+    def digest(self, path: str | os.PathLike, algo: str = "sha256") -> str:
+        st = os.stat(path)
+        digest = self.get(st, algo)
+        if digest is None:
+            digest = hash_file(path, algo)
+            self.put(st, digest, algo)
+        return digest
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
+        total = self.hit + self.miss
+        if total:
+            log.info(f"Hash cache: {self.hit}/{total} hit ({self.hit / total:.1%})")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
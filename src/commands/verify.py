@@ -0,0 +1,308 @@
+import logging
+import argparse
+import concurrent.futures
+import contextlib
+import dataclasses
+import hashlib
+import mmap
+import os
+import pathlib
+import subprocess
+import tarfile
+import threading
+import time
+import typing
+import zlib
+from . import util, codec, snapshot, metrics, trace
+
+log: logging.Logger = logging.getLogger(__name__)
+
+# Verify that archive files can be read back
+# Each archive is read once through mmap: the raw bytes are hashed
+# (hashlib releases the GIL) and decompressed (decompressor process, or
+# in-process if it is not installed), and the tar stream is walked to the
+# end with reading all member data (header checksums, truncation).
+# The digest is compared with the checksum sidecar if it exists.
+# Archives are verified in parallel, and verified archives are remembered
+# in the hash cache by (device, inode, size, mtime).
+# Snapshot manifests are checked by their chunks: every chunk exists and
+# its content matches its name (each chunk is read once, shared or not).
+
+READ_SIZE = 1024 * 1024
+# hash cache algo name of verified archives (digest: sha256)
+CACHE_ALGO = "verified"
+# hash cache algo name of verified snapshot chunks (digest: chunk id)
+CHUNK_CACHE_ALGO = "chunk"
+
+
+class RawReader:
+    # file-like object (read only) over the mapped archive
+    # hashing bytes as they are read
+    def __init__(self, buf: mmap.mmap):
+        self.buf = buf
+        self.pos = 0
+        self.sha256 = hashlib.sha256()
+
+    def read(self, size: int | None = -1) -> bytes:
+        end = len(self.buf) if size is None or size < 0 else min(self.pos + size, len(self.buf))
+        data = self.buf[self.pos:end]
+        self.pos = end
+        self.sha256.update(data)
+        return data
+
+    def readable(self) -> bool:
+        return True
+
+
+class CountReader:
+    # count bytes of the decompressed stream
+    def __init__(self, fin: typing.BinaryIO):
+        self.fin = fin
+        self.count = 0
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.fin.read(size)
+        self.count += len(data)
+        return data
+
+
+@dataclasses.dataclass
+class Result:
+    name: str
+    # "ok", "cached", "failed"
+    status: str
+    members: int = 0
+    # tar stream bytes
+    size: int = 0
+    elapsed: float = 0.0
+    error: str = ""
+
+
+# Walk the tar stream to the end
+# Return (members, tar stream bytes)
+def walk_tar(fin: typing.BinaryIO) -> tuple[int, int]:
+    reader = CountReader(fin)
+    members = 0
+    with tarfile.open(fileobj=reader, mode="r|") as tf:
+        for member in tf:
+            members += 1
+            # data of regular files and GNU incremental entries (unknown types)
+            if member.isreg() or member.type not in tarfile.SUPPORTED_TYPES:
+                f = tf.extractfile(member)
+                # raise ReadError on short data
+                while f.read(READ_SIZE):
+                    pass
+        end = tf.offset
+    # end-of-archive blocks and padding
+    while reader.read(READ_SIZE):
+        pass
+    # tarfile treats EOF at a header position as the end
+    if reader.count < end + tarfile.BLOCKSIZE:
+        raise RuntimeError("end-of-archive marker not found (truncated tar stream)")
+    return members, reader.count
+
+
+# Decompress by an external program (another core)
+def walk_with_program(comp: codec.Codec, raw: RawReader) -> tuple[int, int]:
+    proc = util.popen(comp.decompress_cmd(), stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def feed():
+        try:
+            while chunk := raw.read(READ_SIZE):
+                proc.stdin.write(chunk)
+        except OSError:
+            # the reader is stopped (error is reported by the reader)
+            pass
+        finally:
+            try:
+                proc.stdin.close()
+            except OSError:
+                pass
+
+    feeder = threading.Thread(target=feed)
+    feeder.start()
+    try:
+        result = walk_tar(proc.stdout)
+    except Exception as e:
+        # a decompressor error breaks the tar stream: report the cause
+        try:
+            returncode = proc.wait(timeout=1)
+        except subprocess.TimeoutExpired:
+            returncode = 0
+        proc.kill()
+        if returncode != 0:
+            raise RuntimeError(f"{comp.dprog} exit code {returncode}") from e
+        raise
+    except BaseException:
+        proc.kill()
+        raise
+    finally:
+        feeder.join()
+        proc.stdout.close()
+        proc.wait()
+    if proc.returncode != 0:
+        raise RuntimeError(f"{comp.dprog} exit code {proc.returncode}")
+    return result
+
+
+def walk_in_process(comp: codec.Codec, raw: RawReader) -> tuple[int, int]:
+    with codec.open_decompress(comp.name, raw) as fin:
+        result = walk_tar(fin)
+    # hash the rest (if any)
+    while raw.read(READ_SIZE):
+        pass
+    return result
+
+
+# Return (members, tar stream bytes, sha256)
+# members is None if the structure is not checked (not tar)
+def read_archive(path: pathlib.Path) -> tuple[int | None, int, str]:
+    comp = codec.by_name(path.name)
+    with path.open("rb") as fin:
+        if os.fstat(fin.fileno()).st_size == 0:
+            raise RuntimeError("empty file")
+        with mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            if hasattr(buf, "madvise") and hasattr(mmap, "MADV_SEQUENTIAL"):
+                buf.madvise(mmap.MADV_SEQUENTIAL)
+            raw = RawReader(buf)
+            if comp is None:
+                # 7z: checksum only
+                while raw.read(READ_SIZE):
+                    pass
+                return None, 0, raw.sha256.hexdigest()
+            if comp.available():
+                members, size = walk_with_program(comp, raw)
+            elif codec.native_decompress_available(comp):
+                members, size = walk_in_process(comp, raw)
+            else:
+                raise RuntimeError(f"{comp.dprog} not found ([Hint] e.g. $ {comp.install})")
+            return members, size, raw.sha256.hexdigest()
+
+
+# Check the chunks of a snapshot manifest
+# verified: chunk ids already verified in this run (shared by threads)
+# Return (files, chunk bytes read)
+def read_manifest(path: pathlib.Path, cache: util.HashCache, force: bool, verified: set[str]) -> tuple[int, int]:
+    store = path.parent
+    files = 0
+    size = 0
+    for entry in snapshot.load_manifest(path)["entries"]:
+        if entry["type"] != "file":
+            continue
+        files += 1
+        for cid in entry["chunks"]:
+            if cid in verified:
+                continue
+            try:
+                st = os.stat(snapshot.chunk_path(store, cid))
+            except FileNotFoundError:
+                raise RuntimeError(f"missing chunk {cid} of {entry['path']}") from None
+            if force or cache.get(st, CHUNK_CACHE_ALGO) != cid:
+                try:
+                    snapshot.get_chunk(store, cid)
+                except zlib.error as e:
+                    raise RuntimeError(f"Broken chunk: {cid}: {e}") from None
+                size += st.st_size
+                cache.put(st, cid, CHUNK_CACHE_ALGO)
+            # set operations are atomic: at worst a chunk is read twice
+            verified.add(cid)
+    return files, size
+
+
+def verify_one(path: pathlib.Path, cache: util.HashCache, force: bool, verified: set[str]) -> Result:
+    start = time.monotonic()
+    if snapshot.manifest_filter_str(path.name):
+        try:
+            with trace.span("read manifest", args={"name": path.name}):
+                files, size = read_manifest(path, cache, force, verified)
+        except Exception as e:
+            return Result(path.name, "failed", elapsed=time.monotonic() - start, error=str(e) or type(e).__name__)
+        return Result(path.name, "ok", files, size, time.monotonic() - start)
+    try:
+        st = os.stat(path)
+        sidecar = util.read_sidecar(path)
+        if not force:
+            cached = cache.get(st, CACHE_ALGO)
+            if cached is not None and sidecar in (None, cached):
+                return Result(path.name, "cached")
+
+        with trace.span("read archive", args={"name": path.name}):
+            members, size, digest = read_archive(path)
+        if sidecar is not None and sidecar != digest:
+            raise RuntimeError(f"checksum mismatch (sidecar {sidecar}, actual {digest})")
+        if members is None and sidecar is None:
+            raise RuntimeError("not a tar archive and no checksum sidecar")
+    except Exception as e:
+        return Result(path.name, "failed", elapsed=time.monotonic() - start, error=str(e) or type(e).__name__)
+
+    # unchanged during the read
+    if os.stat(path).st_mtime_ns == st.st_mtime_ns:
+        cache.put(st, digest, CACHE_ALGO)
+        cache.put(st, digest, "sha256")
+    return Result(path.name, "ok", members or 0, size, time.monotonic() - start)
+
+
+def verify(args: argparse.Namespace):
+    dst = pathlib.Path(args.dst)
+    if not dst.is_dir():
+        raise RuntimeError("DST must be a directory")
+    if args.last is not None and args.last < 1:
+        raise RuntimeError("--last must be >= 1")
+    jobs = args.jobs if args.jobs is not None else util.governor.compress_threads(0)
+    if jobs < 1:
+        raise RuntimeError("--jobs must be >= 1")
+
+    manifests = snapshot.scan_manifests(dst)
+    entries = sorted(util.scan_archives(dst) + manifests, key=lambda e: e.stat().st_mtime)
+    paths = [pathlib.Path(e.path) for e in entries]
+    if args.last is not None:
+        paths = paths[-args.last:]
+    log.info(f"{len(paths)} archive file(s), {jobs} job(s)")
+
+    verified: set[str] = set()
+    start = time.monotonic()
+    # snapshot store: gc does not delete chunks while they are checked
+    with (snapshot.store_lock(dst, exclusive=False) if manifests else contextlib.nullcontext(),
+            util.HashCache(args.hash_cache) as cache,
+            concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor):
+        futures = [executor.submit(metrics.bind(verify_one), path, cache, args.force, verified) for path in paths]
+        results = []
+        for future in futures:
+            r = future.result()
+            results.append(r)
+            if r.status == "ok":
+                log.info(
+                    f"OK: {r.name} ({r.members} members, {r.size} bytes, {r.elapsed:.1f} sec, "
+                    f"{r.size / max(r.elapsed, 1e-9) / 1e6:.1f} MB/s)")
+            elif r.status == "cached":
+                log.info(f"OK (cached): {r.name}")
+            else:
+                log.error(f"FAILED: {r.name}: {r.error}")
+    elapsed = time.monotonic() - start
+    metrics.recorder.add(metrics.INPUT_BYTES, sum(r.size for r in results))
+    metrics.recorder.add(metrics.FILES, sum(r.status == "ok" for r in results))
+
+    failed = [r.name for r in results if r.status == "failed"]
+    log.info(
+        f"{len(results)} archive(s): {sum(r.status == 'ok' for r in results)} verified, "
+        f"{sum(r.status == 'cached' for r in results)} cached, {len(failed)} failed, "
+        f"{sum(r.size for r in results)} bytes, {elapsed:.1f} sec")
+    if failed:
+        raise RuntimeError(f"Verification failed: {', '.join(failed)}")
+    log.info("OK")
+
+
+def main(argv: list[str]):
+    parser = argparse.ArgumentParser(
+        prog=argv[0],
+        description="Verify that archive files can be decompressed and read back (snapshots: their chunks)",
+    )
+    parser.add_argument("--dst", "-d", required=True, help="archive dir")
+    parser.add_argument("--last", type=int, help="verify only the last N archives (by mtime)")
+    parser.add_argument("--jobs", "-j", type=int, help="archives verified at the same time (default: all cores)")
+    parser.add_argument("--force", action="store_true", help="verify archives already verified and not changed")
+    parser.add_argument("--hash-cache", help="file hash cache (default: ~/.cache/bkup/hashcache.sqlite3)")
+
+    args = parser.parse_args(argv[1:])
+
+    verify(args)
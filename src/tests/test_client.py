@@ -1,11 +1,28 @@
 import unittest
 import test.support
 from src import bkup
+from commands import codec, util, rclone, tarengine, sync, snapshot
+from benchmarks import bench, tree
 import os
+import base64
+import platform
 import pathlib
 import tempfile
+import threading
 import time
+import datetime
 import subprocess
+import sys
+import shutil
+import tarfile
+import json
+import hashlib
+import pstats
+import random
+import zlib
+import itertools
+import unittest.mock
+import test.support.os_helper
 
 
 class TestFoo(unittest.TestCase):
@@ -79,10 +96,17 @@ class TestFoo(unittest.TestCase):
         for name in subdir1:
             self.check_tree(dir1 / name, dir2 / name)
 
-    def extract_archive(self, archive_file: pathlib.Path, dst_dir: pathlib.Path):
+    def extract_archive(self, archive_file: pathlib.Path, dst_dir: pathlib.Path, incremental: bool = False):
         exts = archive_file.suffixes
         if exts[0] == ".tar":
-            subprocess.run(["tar", "-C", str(dst_dir), "-xf", str(archive_file)], check=True)
+            cmd = ["tar", "-C", str(dst_dir), "-xf", str(archive_file)]
+            comp = codec.by_name(archive_file.name)
+            if comp is not None:
+                cmd += [f"--use-compress-program={comp.dprog}"]
+            if incremental:
+                # restore deleted files info of GNU tar incremental dump
+                cmd += ["--listed-incremental=/dev/null"]
+            subprocess.run(cmd, check=True)
         elif exts == [".7z"]:
             prog = os.path.expandvars("%ProgramFiles%\\7-Zip\\7z.exe")
             print([prog, "x", f"-o{str(dst_dir)}", str(archive_file)])
@@ -124,6 +148,58 @@ class TestFoo(unittest.TestCase):
             # check src == dst
             self.check_tree(srcdir, dstdir)
 
+    def test_sync_jobs(self):
+        with tempfile.TemporaryDirectory() as src, tempfile.TemporaryDirectory() as dst:
+            srcdir = pathlib.Path(src)
+            src1 = srcdir / "src1"
+            src2 = srcdir / "src2"
+            src3 = srcdir / "src3"
+            dstdir = pathlib.Path(dst)
+
+            for d in (src1, src2, src3):
+                d.mkdir()
+                self.create_test_tree(d, depth=2, dir_count=5, file_count=20)
+
+            # sync src > dst (one process per source)
+            self.call_main([
+                "bkup.py", "sync",
+                "--src", str(src1), str(src2), str(src3),
+                "--dst", str(dstdir),
+                "--jobs", "2",
+                "--force"])
+
+            # check src == dst
+            self.check_tree(srcdir, dstdir)
+
+    @unittest.skipIf(platform.system() == "Windows", "rsync only")
+    def test_sync_jobs_shared_dst(self):
+        with tempfile.TemporaryDirectory() as src, tempfile.TemporaryDirectory() as dst:
+            srcdir = pathlib.Path(src)
+            dstdir = pathlib.Path(dst)
+            (srcdir / "src1").mkdir()
+            (srcdir / "src2").mkdir()
+            (srcdir / "src1" / "a.txt").write_text("a")
+            (srcdir / "src2" / "b.txt").write_text("b")
+
+            # "dir/" sources are copied into DST itself: parallel rsync --delete would delete each other's files
+            with self.assertLogs("commands.sync", "WARNING") as logs:
+                self.call_main([
+                    "bkup.py", "sync",
+                    "--src", f"{srcdir / 'src1'}/", f"{srcdir / 'src2'}/",
+                    "--dst", dst,
+                    "--jobs", "2",
+                    "--force"])
+            self.assertTrue(any("run one rsync" in line for line in logs.output))
+            self.assertEqual(sorted(p.name for p in dstdir.iterdir()), ["a.txt", "b.txt"])
+
+        # Robocopy: the same name is mirrored to the same dir (in parallel)
+        with self.assertRaisesRegex(RuntimeError, "same name"):
+            sync.sync_win_robocopy([r"C:\a\data", r"D:\b\Data"], pathlib.PureWindowsPath(r"E:\backup"), [], [], False, True, 2)
+        # one by one as before
+        with unittest.mock.patch.object(sync, "robocopy_one") as robocopy_one:
+            sync.sync_win_robocopy([r"C:\a\data", r"D:\b\Data"], pathlib.PureWindowsPath(r"E:\backup"), [], [], False, True, 1)
+        self.assertEqual(robocopy_one.call_count, 2)
+
     def test_clean(self):
         now = time.time()
         day = 24.0 * 60 * 60
@@ -146,6 +222,134 @@ class TestFoo(unittest.TestCase):
             result = list(dir.iterdir())
             self.assertEqual(len(result), 10)
 
+    def test_clean_gfs(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            dir = pathlib.Path(tmpdir)
+            names = []
+            # daily archives (2024-01-01 .. 2024-02-29)
+            day = datetime.date(2024, 1, 1)
+            while day.month <= 2:
+                names.append(f"a_h_{day:%Y%m%d}0300.tar.zst")
+                day += datetime.timedelta(days=1)
+            # incremental chains
+            names += [
+                "b_h_full_202311010000.tar.zst", "b_h_inc_202311020000.tar.zst",
+                "b_h_full_202312010000.tar.zst", "b_h_inc_202312020000.tar.zst",
+                "b_h_full_202401010000.tar.zst",
+            ] + [f"b_h_inc_2024010{i}0000.tar.zst" for i in range(2, 6)]
+            for name in names:
+                # mtime is now, time is taken from the name
+                (dir / name).touch()
+
+            self.call_main([
+                "bkup.py", "clean", "--dst", tmpdir, "--keep-daily", "3", "--keep-monthly", "2",
+                "--per-group", "--time-source", "name", "--jobs", "4"])
+
+            result = sorted(p.name for p in dir.iterdir())
+            self.assertEqual(result, [
+                "a_h_202401310300.tar.zst",
+                "a_h_202402270300.tar.zst", "a_h_202402280300.tar.zst", "a_h_202402290300.tar.zst",
+                # full and inc of a kept chain
+                "b_h_full_202312010000.tar.zst",
+                "b_h_full_202401010000.tar.zst",
+                "b_h_inc_202312020000.tar.zst",
+                "b_h_inc_202401020000.tar.zst", "b_h_inc_202401030000.tar.zst",
+                "b_h_inc_202401040000.tar.zst", "b_h_inc_202401050000.tar.zst",
+            ])
+
+    @unittest.skipIf(shutil.which("rclone") is None, "rclone not found")
+    def test_cloudclean(self):
+        now = time.time()
+        day = 24.0 * 60 * 60
+        with tempfile.TemporaryDirectory() as tmpdir:
+            dir = pathlib.Path(tmpdir)
+            for i in range(30):
+                p = dir / f"backup_2024{i:0>4}.tar.zst"
+                p.touch()
+                ts = now - (i + 0.5) * day
+                os.utime(p, (ts, ts))
+            (dir / "other.txt").touch()
+
+            # local file system backend
+            self.call_main([
+                "bkup.py", "cloudclean", "--remote", ":local", "--dst", tmpdir,
+                "--keep-count", "5", "--keep-days", "10", "--jobs", "3"])
+
+            result = [p.name for p in dir.iterdir() if p.name != "other.txt"]
+            self.assertEqual(len(result), 10)
+            self.assertTrue((dir / "other.txt").exists())
+
+    @unittest.skipIf(shutil.which("rclone") is None, "rclone not found")
+    def test_rclone_session(self):
+        for daemon in (True, False):
+            with (self.subTest(daemon=daemon),
+                    tempfile.TemporaryDirectory() as src,
+                    tempfile.TemporaryDirectory() as tmpdir,
+                    rclone.Session(daemon=daemon) as session):
+                self.assertEqual(session.daemon, daemon)
+                if daemon:
+                    # the rc password is not on the command line
+                    password = base64.b64decode(session.auth.split()[1]).decode().split(":", 1)[1]
+                    self.assertNotIn(password, " ".join(session.proc.args))
+                dst = str(pathlib.Path(tmpdir) / "remote")
+                srcfile = pathlib.Path(src) / "a_h_202401010000.tar.zst"
+                srcfile.write_bytes(os.urandom(1024))
+                (pathlib.Path(src) / "latest.txt").write_text(srcfile.name)
+
+                session.mkdir(":local", dst, dry_run=False)
+                session.copy_file(srcfile, ":local", dst, progress=False, dry_run=False)
+                self.assertEqual((pathlib.Path(dst) / srcfile.name).read_bytes(), srcfile.read_bytes())
+                (pathlib.Path(dst) / "other.txt").touch()
+
+                entries = []
+                session.list_files(":local", dst, util.archive_patterns(), entries.append)
+                self.assertEqual([e["Name"] for e in entries], [srcfile.name])
+                self.assertEqual(entries[0]["Size"], 1024)
+
+                session.delete_files(":local", dst, [srcfile.name], jobs=2, dry_run=False)
+                self.assertEqual([p.name for p in pathlib.Path(dst).iterdir()], ["other.txt"])
+
+    @unittest.skipIf(shutil.which("rclone") is None, "rclone not found")
+    def test_cloud_all_missing(self):
+        with tempfile.TemporaryDirectory() as src, tempfile.TemporaryDirectory() as dst:
+            srcdir = pathlib.Path(src)
+            dstdir = pathlib.Path(dst)
+            for i in range(6):
+                (srcdir / f"a_h_2024010{i}0000.tar.zst").write_bytes(os.urandom(1000 + i))
+            (srcdir / "other.txt").touch()
+            # already uploaded
+            shutil.copy2(srcdir / "a_h_202401000000.tar.zst", dstdir)
+            # broken (same size)
+            (dstdir / "a_h_202401010000.tar.zst").write_bytes(os.urandom(1001))
+
+            for no_rcd in ([], ["--no-rcd"]):
+                self.call_main([
+                    "bkup.py", "cloud", "--src", src, "--remote", ":local", "--dst", dst,
+                    "--all-missing", "--transfers", "3", "--hash-cache", str(dstdir / "hashcache.sqlite3")] + no_rcd)
+                for p in srcdir.iterdir():
+                    if p.name != "other.txt":
+                        self.assertEqual((dstdir / p.name).read_bytes(), p.read_bytes())
+                self.assertFalse((dstdir / "other.txt").exists())
+                (dstdir / "a_h_202401050000.tar.zst").unlink()
+                (dstdir / "a_h_202401010000.tar.zst").write_bytes(os.urandom(1001))
+
+    @unittest.skipIf(shutil.which("rsync") is None, "rsync not found")
+    def test_upload_all_missing(self):
+        with tempfile.TemporaryDirectory() as src, tempfile.TemporaryDirectory() as dst:
+            srcdir = pathlib.Path(src)
+            dstdir = pathlib.Path(dst)
+            for i in range(6):
+                (srcdir / f"a_h_2024010{i}0000.tar.zst").write_bytes(os.urandom(1000 + i))
+            (srcdir / "other.txt").touch()
+            shutil.copy2(srcdir / "a_h_202401000000.tar.zst", dstdir)
+
+            self.call_main(["bkup.py", "upload", "--src", src, "--dst", dst, "--all-missing", "--transfers", "3"])
+            self.assertEqual(
+                sorted(p.name for p in dstdir.iterdir()),
+                sorted(p.name for p in srcdir.iterdir() if p.name != "other.txt"))
+            for p in dstdir.iterdir():
+                self.assertEqual(p.read_bytes(), (srcdir / p.name).read_bytes())
+
     def test_archive(self):
         # python 3.9 dependent
         with (tempfile.TemporaryDirectory() as src,
@@ -163,11 +367,12 @@ class TestFoo(unittest.TestCase):
 
             self.call_main(["bkup.py", "archive", "--src", src, "--dst", dst])
 
-            # eusure dst dir has an archive file and latest.txt
-            after = [p.name for p in dstdir.iterdir() if p.name != "latest.txt"]
+            # eusure dst dir has an archive file (+ checksum sidecar, file listing) and latest.txt
+            after = [p.name for p in dstdir.iterdir() if util.name_filter(p)]
             self.assertEqual(len(after), 1)
             archive_file = dstdir / after[0]
             latest_file = dstdir / "latest.txt"
+            self.assertEqual(util.read_sidecar(archive_file), util.hash_file(archive_file))
 
             # check latest.txt
             with latest_file.open("r") as fin:
@@ -187,6 +392,949 @@ class TestFoo(unittest.TestCase):
 
             self.check_tree(srcdir, extdir)
 
+    @unittest.skipIf(platform.system() == "Windows", "tar only")
+    def test_archive_codec(self):
+        for name, comp in codec.CODECS.items():
+            if not comp.available():
+                continue
+            with (self.subTest(codec=name),
+                    tempfile.TemporaryDirectory() as src,
+                    tempfile.TemporaryDirectory() as dst,
+                    tempfile.TemporaryDirectory() as ext):
+                srcdir = pathlib.Path(src)
+                dstdir = pathlib.Path(dst)
+                extdir = pathlib.Path(ext)
+
+                self.create_test_tree(srcdir, depth=1, dir_count=3, file_count=10)
+                self.call_main(["bkup.py", "archive", "--src", src, "--dst", dst, "--codec", name, "--level", "1"])
+
+                after = [p for p in dstdir.iterdir() if util.name_filter(p)]
+                self.assertEqual(len(after), 1)
+                self.assertEqual(util.read_sidecar(after[0]), util.hash_file(after[0]))
+                self.assertTrue(after[0].name.endswith(f".{comp.ext}"))
+                self.extract_archive(after[0], extdir)
+                self.check_tree(srcdir, extdir)
+
+    @unittest.skipIf(platform.system() == "Windows", "tar only")
+    def test_archive_python_engine(self):
+        for name, comp in codec.CODECS.items():
+            if not codec.native_available(comp):
+                continue
+            with (self.subTest(codec=name),
+                    tempfile.TemporaryDirectory() as src,
+                    tempfile.TemporaryDirectory() as dst,
+                    tempfile.TemporaryDirectory() as ext):
+                srcdir = pathlib.Path(src)
+                dstdir = pathlib.Path(dst)
+                extdir = pathlib.Path(ext)
+
+                self.create_test_tree(srcdir, depth=2, dir_count=5, file_count=10)
+                # larger than a block (multi-stream output)
+                (srcdir / "large").write_bytes(os.urandom(1024 * 1024) * 12)
+                self.call_main([
+                    "bkup.py", "archive", "--src", src, "--dst", dst,
+                    "--codec", name, "--level", "1", "--engine", "python"])
+
+                after = [p for p in dstdir.iterdir() if util.name_filter(p)]
+                self.assertEqual(len(after), 1)
+                self.assertTrue(tarengine.index_path(after[0]).exists())
+                self.assertEqual(util.read_sidecar(after[0]), util.hash_file(after[0]))
+                if shutil.which(comp.dprog):
+                    self.extract_archive(after[0], extdir)
+                else:
+                    with tarfile.open(after[0]) as tf:
+                        tf.extractall(extdir)
+                self.check_tree(srcdir, extdir)
+                self.assertEqual((extdir / "large").read_bytes(), (srcdir / "large").read_bytes())
+
+    def test_archive_python_engine_shrink(self):
+        with (tempfile.TemporaryDirectory() as src,
+                tempfile.TemporaryDirectory() as dst):
+            srcdir = pathlib.Path(src)
+            data = os.urandom(300 * 1024)
+            (srcdir / "a_shrink").write_bytes(data)
+            (srcdir / "b_after").write_text("after")
+            gettarinfo = tarfile.TarFile.gettarinfo
+
+            # the file is truncated between gettarinfo() and the read
+            def gettarinfo_truncate(tf, name=None, arcname=None, fileobj=None):
+                tarinfo = gettarinfo(tf, name, arcname, fileobj)
+                if name.endswith("a_shrink"):
+                    os.truncate(name, 1000)
+                return tarinfo
+
+            with (unittest.mock.patch.object(tarfile.TarFile, "gettarinfo", gettarinfo_truncate),
+                    self.assertLogs("commands.tarengine", "WARNING") as logs):
+                self.call_main([
+                    "bkup.py", "archive", "--src", src, "--dst", dst, "--codec", "gzip", "--engine", "python"])
+            self.assertTrue(any("shrank by" in line for line in logs.output))
+            archives = util.scan_archives(pathlib.Path(dst))
+            self.assertEqual(len(archives), 1)
+            # padded with zeros, and the following members are readable
+            with tarfile.open(archives[0]) as tf:
+                self.assertEqual(tf.extractfile("./a_shrink").read(), data[:1000] + bytes(len(data) - 1000))
+                self.assertEqual(tf.extractfile("./b_after").read(), b"after")
+
+    @unittest.skipIf(platform.system() == "Windows", "tar only")
+    def test_archive_stream(self):
+        with (tempfile.TemporaryDirectory() as src,
+                tempfile.TemporaryDirectory() as dst,
+                tempfile.TemporaryDirectory() as remote,
+                tempfile.TemporaryDirectory() as ext):
+            srcdir = pathlib.Path(src)
+            dstdir = pathlib.Path(dst)
+            remotedir = pathlib.Path(remote)
+            extdir = pathlib.Path(ext)
+
+            self.create_test_tree(srcdir, depth=2, dir_count=5, file_count=10)
+            # stand-in ssh: ignore host and run the remote command locally
+            fake_ssh = dstdir / "fake_ssh"
+            fake_ssh.write_text('#!/bin/sh\nshift\nexec sh -c "$1"\n')
+            fake_ssh.chmod(0o700)
+
+            self.call_main([
+                "bkup.py", "archive", "--src", src, "--dst", dst,
+                "--to-ssh", f"localhost:{remote}/sub", "--ssh", str(fake_ssh)])
+
+            # no local archive
+            self.assertEqual([p.name for p in dstdir.iterdir()], ["fake_ssh"])
+            after = [p for p in (remotedir / "sub").iterdir() if not p.name.endswith(".sha256")]
+            self.assertEqual(len(after), 1)
+            self.assertEqual(util.read_sidecar(after[0]), util.hash_file(after[0]))
+            self.extract_archive(after[0], extdir)
+            self.check_tree(srcdir, extdir)
+
+    @unittest.skipIf(platform.system() == "Windows", "tar only")
+    def test_dockervol(self):
+        with (tempfile.TemporaryDirectory() as tmp,
+                tempfile.TemporaryDirectory() as dst,
+                tempfile.TemporaryDirectory() as remote,
+                tempfile.TemporaryDirectory() as ext):
+            tmpdir = pathlib.Path(tmp)
+            dstdir = pathlib.Path(dst)
+            extdir = pathlib.Path(ext)
+            # stand-in docker: tar of TMP/volumes/VOLUME for "-v VOLUME:..." to stdout,
+            # or metadata lines of find + stat
+            voldir = tmpdir / "volumes"
+            for vol in ("p_db", "p_web"):
+                (voldir / vol).mkdir(parents=True)
+                self.create_test_tree(voldir / vol, depth=1, dir_count=2, file_count=5)
+            bindir = tmpdir / "bin"
+            bindir.mkdir()
+            fake_docker = bindir / "docker"
+            fake_docker.write_text(
+                f"#!{sys.executable}\n"
+                "import os, sys, tarfile\n"
+                "args = sys.argv[1:]\n"
+                "vols = [args[i + 1].split(':')[0] for i, a in enumerate(args) if a == '-v']\n"
+                "if 'find' in args:\n"
+                "    for vol in vols:\n"
+                f"        for root, dirs, files in os.walk(f'{voldir}/{{vol}}'):\n"
+                "            for p in [root] + [os.path.join(root, f) for f in files]:\n"
+                "                st = os.lstat(p)\n"
+                f"                path = './' + os.path.relpath(p, '{voldir}')\n"
+                "                print(st.st_ino, st.st_size, int(st.st_mtime), int(st.st_ctime), f'{st.st_mode:x}', path)\n"
+                "    sys.exit(0)\n"
+                "with tarfile.open(fileobj=sys.stdout.buffer, mode='w|') as tf:\n"
+                "    for vol in vols:\n"
+                f"        tf.add(f'{voldir}/{{vol}}', arcname=f'./{{vol}}')\n")
+            fake_docker.chmod(0o700)
+
+            with unittest.mock.patch.dict(os.environ, {"PATH": f"{bindir}{os.pathsep}{os.environ['PATH']}"}):
+                self.call_main(["bkup.py", "dockervol", "--project", "p", "--volume", "db", "--volume", "web", "--dst", dst])
+                single = [p for p in dstdir.iterdir() if util.name_filter(p)]
+                self.assertEqual(len(single), 1)
+                self.assertEqual(util.read_sidecar(single[0]), util.hash_file(single[0]))
+                self.extract_archive(single[0], extdir)
+                self.check_tree(voldir, extdir)
+                single[0].unlink()
+
+                # an archive per volume, in parallel
+                with self.assertLogs("commands.dockervol") as logs:
+                    self.call_main([
+                        "bkup.py", "dockervol", "--project", "p", "--volume", "db", "--volume", "web",
+                        "--dst", dst, "--per-volume", "--jobs", "2"])
+                self.assertTrue(any("2 archive(s), 2 job(s)" in line for line in logs.output))
+                latest = util.read_latest(dstdir)
+                self.assertEqual([p.name.split("_2")[0] for p in latest], ["p_db", "p_web"])
+                for p, vol in zip(latest, ("p_db", "p_web")):
+                    self.assertEqual(util.read_sidecar(p), util.hash_file(p))
+                    self.assertTrue(p.with_name(f"{p.name}.{util.LISTING_EXT}").exists())
+                    shutil.rmtree(extdir)
+                    extdir.mkdir()
+                    self.extract_archive(p, extdir)
+                    self.assertEqual([d.name for d in extdir.iterdir()], [vol])
+                    self.check_tree(voldir / vol, extdir / vol)
+
+                # only changed volumes are archived again
+                self.call_main([
+                    "bkup.py", "dockervol", "--project", "p", "--volume", "db", "--volume", "web",
+                    "--dst", dst, "--per-volume", "--skip-unchanged"])
+                self.assertTrue((dstdir / "p.dockervol.json").is_file())
+                (voldir / "p_web" / "file0").write_text("modified")
+                with self.assertLogs("commands.dockervol") as logs:
+                    self.call_main([
+                        "bkup.py", "dockervol", "--project", "p", "--volume", "db", "--volume", "web",
+                        "--dst", dst, "--per-volume", "--skip-unchanged"])
+                self.assertTrue(any("Not changed: db" in line for line in logs.output))
+                self.assertFalse(any("Not changed: web" in line for line in logs.output))
+                self.assertTrue(any("1 archive(s)" in line for line in logs.output))
+                self.assertEqual(len(util.read_latest(dstdir)), 2)
+                with self.assertLogs("commands.dockervol") as logs:
+                    self.call_main([
+                        "bkup.py", "dockervol", "--project", "p", "--volume", "db", "--volume", "web",
+                        "--dst", dst, "--per-volume", "--skip-unchanged"])
+                self.assertTrue(any("All volumes are not changed" in line for line in logs.output))
+                # no compressor check (nor tar container) for a no-op run
+                with (unittest.mock.patch.object(codec, "check_installed") as check_installed,
+                        self.assertLogs("commands.dockervol") as logs):
+                    self.call_main([
+                        "bkup.py", "dockervol", "--project", "p", "--volume", "db", "--volume", "web",
+                        "--dst", dst, "--per-volume", "--skip-unchanged"])
+                check_installed.assert_not_called()
+                self.assertFalse(any("Compressor:" in line for line in logs.output))
+
+            if shutil.which("rclone") is None:
+                return
+            # all archives in latest.txt are copied
+            self.call_main(["bkup.py", "cloud", "--src", dst, "--remote", ":local", "--dst", remote])
+            for p in latest:
+                self.assertEqual((pathlib.Path(remote) / p.name).read_bytes(), p.read_bytes())
+
+    @unittest.skipIf(platform.system() == "Windows", "tar only")
+    def test_checksum_sidecar(self):
+        with (tempfile.TemporaryDirectory() as src,
+                tempfile.TemporaryDirectory() as dst,
+                tempfile.TemporaryDirectory() as remote):
+            srcdir = pathlib.Path(src)
+            dstdir = pathlib.Path(dst)
+            remotedir = pathlib.Path(remote)
+
+            self.create_test_tree(srcdir, depth=1, dir_count=3, file_count=10)
+            self.call_main(["bkup.py", "archive", "--src", src, "--dst", dst, "--tag", "a"])
+            archive_file = pathlib.Path((dstdir / "latest.txt").read_text().strip())
+            sidecar = util.sidecar_path(archive_file)
+            self.assertEqual(sidecar.read_text(), f"{util.hash_file(archive_file)}  {archive_file.name}\n")
+
+            # same sidecar on the destination: no transfer (rsync is not called)
+            shutil.copy2(archive_file, remotedir)
+            shutil.copy2(sidecar, remotedir)
+            with self.assertLogs("commands.upload") as logs:
+                self.call_main(["bkup.py", "upload", "--src", dst, "--dst", remote, "--verify"])
+            self.assertTrue(any("Already uploaded" in line for line in logs.output))
+
+            if shutil.which("rclone") is not None:
+                (remotedir / archive_file.name).unlink()
+                (remotedir / sidecar.name).unlink()
+                for no_rcd in ([], ["--no-rcd"]):
+                    self.call_main(["bkup.py", "cloud", "--src", dst, "--remote", ":local", "--dst", remote] + no_rcd)
+                    self.assertEqual((remotedir / sidecar.name).read_bytes(), sidecar.read_bytes())
+                    with self.assertLogs("commands.cloud") as logs:
+                        self.call_main(["bkup.py", "cloud", "--src", dst, "--remote", ":local", "--dst", remote] + no_rcd)
+                    self.assertTrue(any("Already uploaded" in line for line in logs.output))
+                    (remotedir / sidecar.name).unlink()
+
+            # clean deletes sidecars with archives
+            old = dstdir / "a_h_202001010000.tar.zst"
+            old.touch()
+            util.write_sidecar(old, util.hash_file(old))
+            os.utime(old, (0, 0))
+            self.call_main(["bkup.py", "clean", "--dst", dst, "--keep-count", "1"])
+            self.assertFalse(old.exists())
+            self.assertFalse(util.sidecar_path(old).exists())
+            self.assertTrue(sidecar.exists())
+
+    @unittest.skipIf(platform.system() == "Windows", "tar only")
+    @unittest.skipIf(shutil.which("zstd") is None, "zstd not found")
+    def test_archive_rsyncable(self):
+        with (tempfile.TemporaryDirectory() as src,
+                tempfile.TemporaryDirectory() as dst,
+                tempfile.TemporaryDirectory() as remote):
+            srcdir = pathlib.Path(src)
+            dstdir = pathlib.Path(dst)
+            remotedir = pathlib.Path(remote)
+            self.create_test_tree(srcdir, depth=2, dir_count=5, file_count=10)
+            (srcdir / "large").write_bytes(os.urandom(4 * 1024 * 1024))
+
+            with self.assertLogs("commands.archive") as logs:
+                self.call_main(["bkup.py", "archive", "--src", src, "--dst", dst, "--tag", "a", "--rsyncable"])
+            self.assertTrue(any("Compressor: zstd" in line and "--rsyncable" in line for line in logs.output))
+            # stable output for the same tree
+            self.call_main(["bkup.py", "archive", "--src", src, "--dst", dst, "--tag", "b", "--rsyncable"])
+            first, second = sorted(p for p in dstdir.iterdir() if util.name_filter(p))
+            self.assertEqual(first.read_bytes(), second.read_bytes())
+
+            with self.assertRaisesRegex(RuntimeError, "rsyncable"):
+                self.call_main(["bkup.py", "archive", "--src", src, "--dst", dst, "--codec", "bzip2", "--rsyncable"])
+
+            if shutil.which("rsync") is None:
+                return
+            # seed the new archive from the previous one on the destination
+            prev = dstdir / f"a_{platform.node()}_202401010000.tar.zst"
+            first.rename(prev)
+            util.write_sidecar(prev, util.hash_file(prev))
+            (dstdir / "latest.txt").write_text(str(prev))
+            self.call_main(["bkup.py", "upload", "--src", dst, "--dst", remote])
+            (srcdir / "dir0" / "file0").write_text("modified")
+            self.call_main(["bkup.py", "archive", "--src", src, "--dst", dst, "--tag", "a", "--rsyncable"])
+            latest = pathlib.Path((dstdir / "latest.txt").read_text().strip())
+            with self.assertLogs("commands.upload") as logs:
+                self.call_main(["bkup.py", "upload", "--src", dst, "--dst", remote, "--delta", "--verify"])
+            self.assertTrue(any("Seed" in line for line in logs.output))
+            self.assertFalse(any("Seed not found" in line for line in logs.output))
+            self.assertEqual((remotedir / latest.name).read_bytes(), latest.read_bytes())
+
+    @unittest.skipIf(platform.system() == "Windows", "tar only")
+    def test_verify(self):
+        with tempfile.TemporaryDirectory() as src, tempfile.TemporaryDirectory() as dst:
+            srcdir = pathlib.Path(src)
+            dstdir = pathlib.Path(dst)
+            hash_cache = str(srcdir / "hashcache.sqlite3")
+            (srcdir / "tree").mkdir()
+            self.create_test_tree(srcdir / "tree", depth=2, dir_count=3, file_count=10)
+            (srcdir / "tree" / "large").write_bytes(os.urandom(3 * 1024 * 1024))
+
+            self.call_main(["bkup.py", "archive", "--src", str(srcdir / "tree"), "--dst", dst, "--tag", "a"])
+            self.call_main([
+                "bkup.py", "archive", "--src", str(srcdir / "tree"), "--dst", dst, "--tag", "b",
+                "--codec", "gzip", "--engine", "python"])
+            archives = sorted(p for p in dstdir.iterdir() if util.name_filter(p))
+            self.assertEqual(len(archives), 2)
+
+            with self.assertLogs("commands.verify") as logs:
+                self.call_main(["bkup.py", "verify", "--dst", dst, "--jobs", "2", "--hash-cache", hash_cache])
+            self.assertEqual(len([line for line in logs.output if "OK: " in line]), 2)
+            # unchanged archives are not read again
+            with self.assertLogs("commands.verify") as logs:
+                self.call_main(["bkup.py", "verify", "--dst", dst, "--hash-cache", hash_cache])
+            self.assertEqual(len([line for line in logs.output if "OK (cached)" in line]), 2)
+
+            # broken compressed data (the sidecar does not match)
+            with archives[0].open("r+b") as f:
+                f.seek(archives[0].stat().st_size // 2)
+                f.write(b"broken")
+            # truncated tar stream (compressed correctly, no sidecar)
+            comp = codec.by_name(archives[1].name)
+            with archives[1].open("rb") as raw, codec.open_decompress(comp.name, raw) as fin:
+                data = fin.read()
+            archives[1].write_bytes(codec.compress_block(comp.name, data[:len(data) // 2], 1))
+            util.sidecar_path(archives[1]).unlink()
+            with self.assertLogs("commands.verify") as logs, self.assertRaises(RuntimeError):
+                self.call_main(["bkup.py", "verify", "--dst", dst, "--hash-cache", hash_cache])
+            errors = [line for line in logs.output if "FAILED" in line]
+            self.assertEqual(len(errors), 2)
+            self.assertIn(archives[0].name, errors[0])
+            self.assertIn(archives[1].name, errors[1])
+
+    @unittest.skipIf(platform.system() == "Windows", "tar only")
+    def test_restore(self):
+        with (tempfile.TemporaryDirectory() as src,
+                tempfile.TemporaryDirectory() as dst,
+                tempfile.TemporaryDirectory() as ext):
+            srcdir = pathlib.Path(src)
+            dstdir = pathlib.Path(dst)
+            extdir = pathlib.Path(ext)
+            self.create_test_tree(srcdir, depth=2, dir_count=3, file_count=10)
+            # several frames
+            (srcdir / "large").write_bytes(os.urandom(1024 * 1024) * 20)
+
+            self.call_main([
+                "bkup.py", "archive", "--src", src, "--dst", dst, "--tag", "a",
+                "--codec", "gzip", "--level", "1", "--engine", "python"])
+            archive = next(p for p in dstdir.iterdir() if util.name_filter(p))
+            self.assertIsNotNone(tarengine.load_index(archive))
+
+            # selected files: only their frames are decompressed
+            with self.assertLogs("commands.restore") as logs:
+                self.call_main(["bkup.py", "restore", "--src", dst, "--dst", str(extdir / "part"), "dir1/file2", "dir2/dir0"])
+            self.assertTrue(any("Decompress 1/" in line for line in logs.output))
+            self.assertEqual((extdir / "part" / "dir1" / "file2").read_text(), "file2")
+            self.check_tree(srcdir / "dir2" / "dir0", extdir / "part" / "dir2" / "dir0")
+            self.assertFalse((extdir / "part" / "large").exists())
+            self.assertFalse((extdir / "part" / "dir0").exists())
+            with self.assertRaisesRegex(RuntimeError, "Not found"):
+                self.call_main(["bkup.py", "restore", "--src", str(archive), "--dst", str(extdir / "none"), "nothing"])
+
+            # all files (frames in parallel)
+            self.call_main(["bkup.py", "restore", "--src", str(archive), "--dst", str(extdir / "all"), "--jobs", "3"])
+            self.check_tree(srcdir, extdir / "all")
+            self.assertEqual((extdir / "all" / "large").read_bytes(), (srcdir / "large").read_bytes())
+
+            # archive without index (tar)
+            self.call_main(["bkup.py", "archive", "--src", src, "--dst", dst, "--tag", "b"])
+            self.call_main(["bkup.py", "restore", "--src", dst, "--dst", str(extdir / "tar"), "dir1"])
+            self.check_tree(srcdir / "dir1", extdir / "tar" / "dir1")
+            self.assertFalse((extdir / "tar" / "large").exists())
+
+            # the index is deleted with the archive
+            self.call_main(["bkup.py", "clean", "--dst", dst, "--keep-count", "1"])
+            self.assertFalse(archive.exists())
+            self.assertFalse(tarengine.index_path(archive).exists())
+
+    @unittest.skipIf(platform.system() == "Windows", "tar only")
+    def test_find(self):
+        with tempfile.TemporaryDirectory() as src, tempfile.TemporaryDirectory() as dst, tempfile.TemporaryDirectory() as tmp:
+            srcdir = pathlib.Path(src)
+            dstdir = pathlib.Path(dst)
+            cat = str(pathlib.Path(tmp) / "catalog.sqlite3")
+            self.create_test_tree(srcdir, depth=1, dir_count=2, file_count=3)
+
+            # listings are made by both engines while writing
+            self.call_main(["bkup.py", "archive", "--src", src, "--dst", dst, "--tag", "a"])
+            (srcdir / "dir0" / "file1").write_text("modified")
+            self.call_main(["bkup.py", "archive", "--src", src, "--dst", dst, "--tag", "b", "--codec", "gzip", "--engine", "python"])
+            self.call_main(["bkup.py", "archive", "--src", src, "--dst", dst, "--tag", "c"])
+            archives = sorted(p for p in dstdir.iterdir() if util.name_filter(p))
+            self.assertEqual(len(archives), 3)
+            for p in archives:
+                self.assertTrue(p.with_name(f"{p.name}.{util.LISTING_EXT}").exists())
+
+            with self.assertLogs("commands.find") as logs:
+                stdout, _ = self.call_main(["bkup.py", "find", "--dst", dst, "--catalog", cat, "dir0/file1"])
+            self.assertTrue(any("3 loaded" in line for line in logs.output))
+            lines = stdout.splitlines()
+            self.assertEqual(lines[0], "dir0/file1")
+            self.assertEqual([line.split()[-1] for line in lines[1:]], ["added", "changed", "same"])
+            self.assertIn(archives[1].name, lines[2])
+
+            # file name pattern, by hash
+            stdout, _ = self.call_main(["bkup.py", "find", "--dst", dst, "--catalog", cat, "file*"])
+            self.assertEqual(len([line for line in stdout.splitlines() if not line.startswith(" ")]), 9)
+            digest = hashlib.sha256(b"modified").hexdigest()
+            stdout, _ = self.call_main(["bkup.py", "find", "--catalog", cat, "--hash", digest])
+            self.assertEqual(stdout.splitlines()[0], "dir0/file1")
+            self.assertEqual(len(stdout.splitlines()), 3)
+
+            # deleted archives are removed from the catalog
+            self.call_main(["bkup.py", "clean", "--dst", dst, "--keep-count", "1"])
+            with self.assertLogs("commands.find") as logs:
+                stdout, _ = self.call_main(["bkup.py", "find", "--dst", dst, "--catalog", cat, "dir0/file1"])
+            self.assertTrue(any("0 loaded, 2 deleted" in line for line in logs.output))
+            self.assertEqual(len(stdout.splitlines()), 2)
+
+    @unittest.skipIf(platform.system() == "Windows", "tar only")
+    def test_archive_incremental(self):
+        with (tempfile.TemporaryDirectory() as src,
+                tempfile.TemporaryDirectory() as dst,
+                tempfile.TemporaryDirectory() as ext):
+            srcdir = pathlib.Path(src)
+            dstdir = pathlib.Path(dst)
+            extdir = pathlib.Path(ext)
+
+            self.create_test_tree(srcdir, depth=2, dir_count=5, file_count=10)
+            self.call_main(["bkup.py", "archive", "--src", src, "--dst", dst, "--tag", "t", "--incremental"])
+            # the snapshot state (all paths of src) is readable only by the owner
+            snar = next(dstdir.glob("t_*.snar"))
+            self.assertEqual(snar.stat().st_mode & 0o077, 0)
+
+            # add, modify and delete
+            (srcdir / "new_file").write_text("new")
+            (srcdir / "dir0" / "file0").write_text("modified")
+            (srcdir / "dir1" / "file1").unlink()
+            self.call_main(["bkup.py", "archive", "--src", src, "--dst", dst, "--tag", "t", "--incremental"])
+
+            archives = sorted(p for p in dstdir.iterdir() if util.name_filter(p) and p.name.startswith("t_"))
+            self.assertEqual(len(archives), 2)
+            full = [p for p in archives if "_full_" in p.name]
+            inc = [p for p in archives if "_inc_" in p.name]
+            self.assertEqual(len(full), 1)
+            self.assertEqual(len(inc), 1)
+            self.assertLess(inc[0].stat().st_size, full[0].stat().st_size)
+
+            # extract full then incremental
+            self.extract_archive(full[0], extdir, incremental=True)
+            self.extract_archive(inc[0], extdir, incremental=True)
+
+            self.check_tree(srcdir, extdir)
+            self.assertEqual((extdir / "dir0" / "file0").read_text(), "modified")
+
+            # restore the chain of the latest (incremental) archive
+            self.call_main(["bkup.py", "restore", "--src", dst, "--dst", str(extdir / "restored")])
+            self.check_tree(srcdir, extdir / "restored")
+            self.assertEqual((extdir / "restored" / "dir0" / "file0").read_text(), "modified")
+
+            # one more in the same minute: a new incremental archive, the previous one is kept
+            time.sleep(1.1)
+            (srcdir / "new_file2").write_text("new2")
+            self.call_main(["bkup.py", "archive", "--src", src, "--dst", dst, "--tag", "t", "--incremental"])
+            archives2 = sorted(p for p in dstdir.iterdir() if util.name_filter(p) and p.name.startswith("t_"))
+            self.assertEqual(len(archives2), 3)
+            self.assertIn(inc[0], archives2)
+            self.call_main(["bkup.py", "restore", "--src", dst, "--dst", str(extdir / "restored2")])
+            self.check_tree(srcdir, extdir / "restored2")
+
+            # selected files: not in some archives of the chain, but in one of them
+            self.call_main(["bkup.py", "restore", "--src", dst, "--dst", str(extdir / "part"), "new_file2", "dir0/file0"])
+            self.assertEqual((extdir / "part" / "new_file2").read_text(), "new2")
+            self.assertEqual((extdir / "part" / "dir0" / "file0").read_text(), "modified")
+            with self.assertRaisesRegex(RuntimeError, "Not found in the archive: nothing"):
+                self.call_main(["bkup.py", "restore", "--src", dst, "--dst", str(extdir / "none"), "new_file2", "nothing"])
+            # other errors of tar are not ignored
+            latest = dstdir / util.read_latest(dstdir)[0].name
+            latest.write_bytes(latest.read_bytes()[:100])
+            with self.assertRaises(subprocess.CalledProcessError):
+                self.call_main(["bkup.py", "restore", "--src", dst, "--dst", str(extdir / "broken"), "new_file2"])
+
+    def test_snapshot(self):
+        # chunk boundaries follow the content: an insertion changes only the chunk around it
+        def split(data: bytes) -> list[bytes]:
+            buf = bytearray(data)
+            result = []
+            pos = 0
+            while pos < len(buf):
+                cut = snapshot.find_cut(buf, pos, len(buf))
+                result.append(bytes(buf[pos:cut]))
+                pos = cut
+            return result
+
+        # fixed data: the number of changed chunks depends on the content
+        data = random.Random(1234).randbytes(16 * 1024 * 1024)
+        chunks = split(data)
+        self.assertGreater(len(chunks), 4)
+        self.assertTrue(all(snapshot.CHUNK_MIN < len(c) <= snapshot.CHUNK_MAX for c in chunks[:-1]))
+        self.assertEqual(b"".join(chunks), data)
+        insert_at = 5000000
+        shifted = set(split(data[:insert_at] + b"inserted" + data[insert_at:]))
+        # chunks before the insertion and well after it are shared
+        ends = list(itertools.accumulate(len(c) for c in chunks))
+        before = [c for c, end in zip(chunks, ends) if end <= insert_at]
+        after = [c for c, end in zip(chunks, ends) if end - len(c) >= insert_at + 2 * snapshot.CHUNK_MAX]
+        self.assertTrue(before and after)
+        self.assertTrue(all(c in shifted for c in before + after))
+
+        with (tempfile.TemporaryDirectory() as src,
+                tempfile.TemporaryDirectory() as dst,
+                tempfile.TemporaryDirectory() as ext):
+            srcdir = pathlib.Path(src)
+            dstdir = pathlib.Path(dst)
+            extdir = pathlib.Path(ext)
+
+            self.create_test_tree(srcdir, depth=2, dir_count=5, file_count=10)
+            # large file (multiple chunks)
+            (srcdir / "large").write_bytes(os.urandom(3 * 1024 * 1024) * 3)
+            (srcdir / "unique").write_text("unique")
+            hash_cache = str(dstdir / "hashcache.sqlite3")
+            self.call_main(["bkup.py", "snapshot", "--src", src, "--dst", dst, "--tag", "t", "--hash-cache", hash_cache])
+            chunks1 = {p.name for p in (dstdir / "chunks").glob("*/*")}
+
+            # manifest name has seconds
+            time.sleep(1.1)
+            (srcdir / "new_file").write_text("new")
+            (srcdir / "unique").unlink()
+            # moved file is found by the hash cache without reading
+            (srcdir / "large").rename(srcdir / "dir0" / "large")
+            with self.assertLogs("commands.snapshot") as logs:
+                self.call_main(["bkup.py", "snapshot", "--src", src, "--dst", dst, "--tag", "t", "--hash-cache", hash_cache])
+            self.assertTrue(any("1 moved file(s), 1 changed file(s)" in line for line in logs.output))
+            chunks2 = {p.name for p in (dstdir / "chunks").glob("*/*")}
+            # only the new file is stored
+            self.assertEqual(len(chunks2 - chunks1), 1)
+            # manifests are not archives (not uploaded without the chunks)
+            self.assertEqual(util.scan_archives(dstdir), [])
+            self.assertEqual(len(snapshot.scan_manifests(dstdir)), 2)
+
+            # keep only the latest snapshot and gc
+            self.call_main(["bkup.py", "clean", "--dst", dst, "--keep-count", "1"])
+            manifests = [p for p in dstdir.iterdir() if p.name.endswith(".snap.json.gz")]
+            self.assertEqual(len(manifests), 1)
+            chunks3 = {p.name for p in (dstdir / "chunks").glob("*/*")}
+            self.assertEqual(len(chunks2 - chunks3), 1)
+
+            # gc waits for a running snapshot (chunks not referenced by a manifest yet)
+            if snapshot.fcntl is not None:
+                with snapshot.store_lock(dstdir, exclusive=False):
+                    cid, _size = snapshot.put_chunk(dstdir, b"in flight")
+                    thread = threading.Thread(target=snapshot.gc, args=(dstdir, False))
+                    thread.start()
+                    thread.join(0.5)
+                    self.assertTrue(thread.is_alive())
+                    self.assertTrue(snapshot.chunk_path(dstdir, cid).exists())
+                thread.join(30)
+                self.assertFalse(snapshot.chunk_path(dstdir, cid).exists())
+
+            self.call_main(["bkup.py", "snapshot", "--dst", dst, "--restore-to", ext])
+            self.check_tree(srcdir, extdir)
+            self.assertEqual((extdir / "dir0" / "large").read_bytes(), (srcdir / "dir0" / "large").read_bytes())
+
+            self.call_main(["bkup.py", "restore", "--src", str(manifests[0]), "--dst", str(extdir / "part"), "dir1"])
+            self.check_tree(srcdir / "dir1", extdir / "part" / "dir1")
+            self.assertEqual(sorted(p.name for p in (extdir / "part").iterdir()), ["dir1"])
+
+            # verify checks the chunks of the manifests
+            self.call_main(["bkup.py", "verify", "--dst", dst, "--hash-cache", hash_cache])
+            chunk = next(p for p in (dstdir / "chunks").glob("*/*"))
+            chunk.write_bytes(zlib.compress(b"broken"))
+            with self.assertRaisesRegex(RuntimeError, "Verification failed"):
+                self.call_main(["bkup.py", "verify", "--dst", dst, "--hash-cache", hash_cache])
+            chunk.unlink()
+            with self.assertLogs("commands.verify", "ERROR") as logs:
+                with self.assertRaises(RuntimeError):
+                    self.call_main(["bkup.py", "verify", "--dst", dst, "--hash-cache", hash_cache])
+            self.assertTrue(any("missing chunk" in line for line in logs.output))
+
+    def test_run(self):
+        with (tempfile.TemporaryDirectory() as src,
+                tempfile.TemporaryDirectory() as dst1,
+                tempfile.TemporaryDirectory() as dst2,
+                tempfile.TemporaryDirectory() as tmpdir):
+            srcdir = pathlib.Path(src)
+            self.create_test_tree(srcdir, depth=1, dir_count=3, file_count=5)
+            # JSON config (tomllib is 3.11+)
+            config = pathlib.Path(tmpdir) / "jobs.json"
+            config.write_text(json.dumps({"job": [
+                {"name": "a", "stage": [
+                    {"name": "archive", "cmd": ["archive", "--src", src, "--dst", dst1, "--tag", "a"]},
+                    {"name": "clean", "cmd": ["clean", "--dst", dst1, "--keep-count", "1"]},
+                ]},
+                {"name": "b", "stage": [
+                    {"name": "archive", "cmd": ["archive", "--src", src, "--dst", dst2, "--tag", "b"]},
+                    {"name": "clean", "cmd": ["clean", "--dst", dst2, "--keep-count", "1"], "after": ["a/clean", "archive"]},
+                ]},
+            ]}))
+
+            with self.assertLogs("commands.run") as logs:
+                self.call_main(["bkup.py", "run", "--config", str(config), "--jobs", "2"])
+            self.assertTrue(any("b/clean: ok" in line for line in logs.output))
+            for dst in (dst1, dst2):
+                self.assertEqual(len(util.scan_archives(pathlib.Path(dst))), 1)
+
+            # a failed stage skips its dependents
+            config.write_text(json.dumps({"job": [
+                {"name": "a", "stage": [
+                    {"name": "archive", "cmd": ["archive", "--src", str(srcdir / "notfound"), "--dst", dst1]},
+                    {"name": "clean", "cmd": ["clean", "--dst", dst1, "--keep-count", "1"]},
+                ]},
+            ]}))
+            with self.assertLogs("commands.run") as logs, self.assertRaises(RuntimeError):
+                with test.support.captured_stdout(), test.support.captured_stderr():
+                    bkup.main(["bkup.py", "run", "--config", str(config)])
+            self.assertTrue(any("a/clean: skipped" in line for line in logs.output))
+
+            # dependency cycle
+            config.write_text(json.dumps({"job": [
+                {"name": "a", "stage": [
+                    {"name": "x", "cmd": ["clean", "--dst", dst1], "after": ["y"]},
+                    {"name": "y", "cmd": ["clean", "--dst", dst1], "after": ["x"]},
+                ]},
+            ]}))
+            with self.assertRaisesRegex(RuntimeError, "cycle"):
+                bkup.main(["bkup.py", "run", "--config", str(config)])
+
+    @unittest.skipIf(platform.system() == "Windows", "tar only")
+    def test_metrics(self):
+        with (tempfile.TemporaryDirectory() as src,
+                tempfile.TemporaryDirectory() as dst,
+                tempfile.TemporaryDirectory() as tmpdir):
+            srcdir = pathlib.Path(src)
+            count = self.create_test_tree(srcdir, depth=1, dir_count=3, file_count=5)
+            jsonl = pathlib.Path(tmpdir) / "metrics.jsonl"
+            prom = pathlib.Path(tmpdir) / "bkup.prom"
+
+            self.call_main([
+                "bkup.py", "--metrics", str(jsonl), "--metrics-prom", str(prom),
+                "archive", "--src", src, "--dst", dst, "--codec", "zstd"])
+            records = [json.loads(line) for line in jsonl.read_text().splitlines()]
+            self.assertEqual(len(records), 1)
+            record = records[0]
+            self.assertEqual(record["stage"], "archive")
+            self.assertTrue(record["ok"])
+            progs = [p["prog"] for p in record["processes"]]
+            self.assertIn("tar", progs)
+            self.assertIn("zstd", progs)
+            self.assertTrue(all(p["returncode"] == 0 and p["maxrss_kb"] > 0 for p in record["processes"]))
+            counters = record["counters"]
+            self.assertEqual(counters["files"], count)
+            archive_file = util.read_latest(pathlib.Path(dst))[0]
+            self.assertEqual(counters["output_bytes"], archive_file.stat().st_size)
+            self.assertGreater(counters["input_bytes"], counters["output_bytes"])
+            self.assertIn("ratio", record)
+            text = prom.read_text()
+            self.assertIn('bkup_stage_success{stage="archive",command="archive"} 1', text)
+            self.assertIn('bkup_stage_bytes{stage="archive",command="archive",kind="output"}', text)
+
+            # stages of run (in parallel)
+            config = pathlib.Path(tmpdir) / "jobs.json"
+            config.write_text(json.dumps({"job": [
+                {"name": name, "stage": [
+                    {"name": "archive", "cmd": ["archive", "--src", src, "--dst", str(pathlib.Path(dst) / name), "--codec", "zstd"]},
+                    {"name": "verify", "cmd": ["verify", "--dst", str(pathlib.Path(dst) / name)]},
+                ]} for name in ("a", "b")]}))
+            with self.assertLogs("commands.run"):
+                self.call_main([
+                    "bkup.py", "--metrics", str(jsonl), "--metrics-prom", str(prom),
+                    "run", "--config", str(config), "--jobs", "2"])
+            records = {r["stage"]: r for r in map(json.loads, jsonl.read_text().splitlines()[1:])}
+            self.assertEqual(set(records), {"a/archive", "a/verify", "b/archive", "b/verify", "run"})
+            for name in ("a", "b"):
+                self.assertEqual(records[f"{name}/archive"]["command"], "archive")
+                self.assertEqual(records[f"{name}/archive"]["counters"]["files"], count)
+                self.assertEqual(sorted(p["prog"] for p in records[f"{name}/archive"]["processes"]), ["tar", "zstd"])
+                self.assertEqual(records[f"{name}/verify"]["counters"]["files"], 1)
+            self.assertEqual(records["run"]["processes"], [])
+            text = prom.read_text()
+            self.assertNotIn('stage="archive"', text)
+            self.assertIn('bkup_stage_success{stage="b/verify",command="verify"} 1', text)
+
+    @unittest.skipIf(platform.system() == "Windows", "tar only")
+    def test_trace(self):
+        with (tempfile.TemporaryDirectory() as src,
+                tempfile.TemporaryDirectory() as dst,
+                tempfile.TemporaryDirectory() as tmpdir):
+            self.create_test_tree(pathlib.Path(src), depth=1, dir_count=3, file_count=5)
+            trace_path = pathlib.Path(tmpdir) / "trace.json"
+
+            with self.assertLogs("commands.trace") as logs:
+                self.call_main([
+                    "bkup.py", "--trace", str(trace_path), "--profile",
+                    "archive", "--src", src, "--dst", dst, "--codec", "zstd"])
+            self.assertTrue(any("Profile" in line and "archive.py" in line for line in logs.output))
+            events = json.loads(trace_path.read_text())["traceEvents"]
+            spans = {e["name"]: e for e in events if e["ph"] == "X"}
+            command = spans["archive"]
+            self.assertEqual(command["cat"], "command")
+            self.assertTrue(command["args"]["ok"])
+            # phases and child processes within the command
+            for name in ("tar pipeline", "listing", "tar", "zstd"):
+                self.assertGreaterEqual(spans[name]["ts"], command["ts"])
+                self.assertLessEqual(spans[name]["ts"] + spans[name]["dur"], command["ts"] + command["dur"])
+            self.assertEqual(spans["tar pipeline"]["tid"], command["tid"])
+            # the file listing is read from the stream in another thread
+            self.assertNotEqual(spans["tap"]["tid"], command["tid"])
+            for prog in ("tar", "zstd"):
+                self.assertEqual(spans[prog]["cat"], "process")
+                self.assertEqual(spans[prog]["args"]["returncode"], 0)
+                self.assertIn("maxrss_kb", spans[prog]["args"])
+                self.assertIn({"ph": "M", "name": "thread_name", "pid": command["pid"], "tid": spans[prog]["tid"],
+                               "args": {"name": f"{prog} [{spans[prog]['tid']}]"}}, events)
+            stats = pstats.Stats(f"{trace_path}.prof")
+            self.assertTrue(any(func[2] == "archive" for func in stats.stats))
+
+            # stages of run (a failed stage is marked)
+            config = pathlib.Path(tmpdir) / "jobs.json"
+            config.write_text(json.dumps({"job": [
+                {"name": "a", "stage": [{"name": "archive", "cmd": ["archive", "--src", src, "--dst", dst]}]},
+                {"name": "b", "stage": [{"name": "archive", "cmd": ["archive", "--src", str(pathlib.Path(src) / "none"), "--dst", dst]}]},
+            ]}))
+            with self.assertLogs("commands.run"), self.assertRaises(RuntimeError):
+                with test.support.captured_stdout(), test.support.captured_stderr():
+                    bkup.main(["bkup.py", "--trace", str(trace_path), "run", "--config", str(config), "--jobs", "2"])
+            events = json.loads(trace_path.read_text())["traceEvents"]
+            spans = {e["name"]: e for e in events if e["ph"] == "X"}
+            self.assertEqual(spans["a/archive"]["cat"], "stage")
+            self.assertTrue(spans["a/archive"]["args"]["ok"])
+            self.assertFalse(spans["b/archive"]["args"]["ok"])
+            self.assertFalse(spans["run"]["args"]["ok"])
+            self.assertNotEqual(spans["a/archive"]["tid"], spans["run"]["tid"])
+
+    @unittest.skipIf(platform.system() == "Windows", "Unix socket")
+    def test_daemon(self):
+        from commands import daemon
+        # 2026-10-18 is Sunday
+        t = datetime.datetime(2026, 10, 18, 12, 34, 56)
+        self.assertEqual(daemon.Cron("*/15 * * * *").next(t), datetime.datetime(2026, 10, 18, 12, 45))
+        self.assertEqual(daemon.Cron("30 3 * * 1-5").next(t), datetime.datetime(2026, 10, 19, 3, 30))
+        self.assertEqual(daemon.Cron("@monthly").next(t), datetime.datetime(2026, 11, 1))
+        self.assertEqual(daemon.Cron("0 0 29 2 *").next(t), datetime.datetime(2028, 2, 29))
+        # day or weekday (Friday 23rd comes before the 13th)
+        self.assertEqual(daemon.Cron("0 0 13 * 5").next(t), datetime.datetime(2026, 10, 23))
+        for expr in ("61 * * * *", "* * *", "0 0 31 2 *"):
+            with self.assertRaises(RuntimeError):
+                daemon.Cron(expr).next(t)
+
+        with (tempfile.TemporaryDirectory() as src,
+                tempfile.TemporaryDirectory() as dst,
+                tempfile.TemporaryDirectory() as tmpdir):
+            self.create_test_tree(pathlib.Path(src), depth=1, dir_count=3, file_count=5)
+            config = pathlib.Path(tmpdir) / "jobs.json"
+            config.write_text(json.dumps({
+                "limits": {"cpu": 1},
+                "job": [
+                    {"name": "a", "schedule": "0 0 1 1 *", "stage": [
+                        {"name": "archive", "cmd": ["archive", "--src", src, "--dst", dst, "--tag", "a"]}]},
+                    {"name": "b", "stage": [
+                        {"name": "archive", "cmd": ["archive", "--src", src, "--dst", dst, "--tag", "b"]},
+                        {"name": "clean", "cmd": ["clean", "--dst", dst, "--keep-count", "1"]}]},
+                ]}))
+
+            # scheduled jobs at startup, and exit
+            with self.assertLogs("commands.daemon") as logs:
+                self.call_main(["bkup.py", "daemon", "--config", str(config), "--now", "--max-runs", "1", "--no-socket"])
+            self.assertTrue(any("[a] OK" in line for line in logs.output))
+            self.assertEqual([p.name.split("_")[0] for p in util.scan_archives(pathlib.Path(dst))], ["a"])
+
+            # trigger and status over the socket
+            sock = pathlib.Path(tmpdir) / "daemon.sock"
+            bkupd = daemon.Daemon(config, 2, sock)
+            thread = threading.Thread(target=bkupd.serve)
+            with self.assertLogs("commands.daemon"):
+                thread.start()
+                try:
+                    for _ in range(100):
+                        if sock.exists():
+                            break
+                        time.sleep(0.1)
+                    self.call_main(["bkup.py", "daemon", "--socket", str(sock), "--trigger", "b"])
+                    with self.assertRaisesRegex(RuntimeError, "Unknown job"):
+                        daemon.request(sock, {"cmd": "run", "job": "none"})
+                    for _ in range(300):
+                        if daemon.request(sock, {"cmd": "status"})["runs"] > 0:
+                            break
+                        time.sleep(0.1)
+                    stdout, _stderr = self.call_main(["bkup.py", "daemon", "--socket", str(sock), "--status"])
+                finally:
+                    daemon.request(sock, {"cmd": "shutdown"})
+                    thread.join(60)
+            status = json.loads(stdout)
+            jobs = {job["name"]: job for job in status["jobs"]}
+            self.assertEqual(jobs["a"]["schedule"], "0 0 1 1 *")
+            self.assertEqual(jobs["a"]["next"][:10], f"{datetime.date.today().year + 1}-01-01")
+            self.assertIsNone(jobs["b"]["next"])
+            self.assertEqual(jobs["b"]["last"]["result"], "ok")
+            self.assertEqual(jobs["b"]["last"]["trigger"], "manual")
+            self.assertEqual(jobs["b"]["last"]["stages"]["b/clean"]["result"], "ok")
+            self.assertEqual(status["limits"]["cpu"], {"limit": 1, "used": 0, "waiting": 0})
+            self.assertFalse(thread.is_alive())
+            self.assertFalse(sock.exists())
+            # clean --keep-count 1
+            self.assertEqual(len(util.scan_archives(pathlib.Path(dst))), 1)
+
+    def test_benchmark_tree(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            name, spec = tree.parse_spec("small,files=50,depth=3,fanout=2,size=uniform:1K:8K,sparse=1,sparse_size=1M")
+            self.assertEqual(name, "small_files-50_depth-3_fanout-2_size-uniform:1K:8K_sparse-1_sparse_size-1M")
+            dir = pathlib.Path(tmpdir) / "tree"
+            stats = tree.generate(dir, spec)
+            files = [p for p in dir.rglob("*") if p.is_file()]
+            self.assertEqual(len(files), stats.files)
+            self.assertEqual(stats.files, 51)
+            self.assertEqual(stats.dirs, 1 + 2 + 4 + 8)
+            self.assertEqual(sum(p.stat().st_size for p in files), stats.bytes)
+            self.assertTrue(all(1024 <= p.stat().st_size <= 8192 for p in files if p.suffix == ".dat"))
+            # deterministic, and reused while the spec is the same
+            digests = {p: util.hash_file(p) for p in files}
+            with self.assertLogs("benchmarks.tree") as logs:
+                tree.generate(dir, spec)
+            self.assertTrue(any("Reuse tree" in line for line in logs.output))
+            tree.generate(dir, tree.parse_spec("small,files=3")[1])
+            self.assertEqual(len(list(dir.rglob("*.dat"))), 3)
+            tree.generate(dir, spec)
+            self.assertEqual({p: util.hash_file(p) for p in files}, digests)
+
+            with self.assertRaisesRegex(RuntimeError, "Unknown tree preset"):
+                tree.parse_spec("nothing")
+            with self.assertRaisesRegex(RuntimeError, "Invalid tree option"):
+                tree.parse_spec("small,foo=1")
+            with self.assertRaisesRegex(RuntimeError, "Invalid size distribution"):
+                tree.parse_spec("small,size=normal:1")
+
+    @unittest.skipIf(platform.system() == "Windows", "tar only")
+    def test_benchmark(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            work = pathlib.Path(tmpdir) / "work"
+            out = pathlib.Path(tmpdir) / "base.json"
+            argv = [
+                "benchmarks", "--tree", "small,files=20", "--command", "archive", "verify", "clean",
+                "--jobs", "1", "2", "--repeat", "2", "--work", str(work)]
+            with self.assertLogs("benchmarks.bench"):
+                bench.main(argv + ["--out", str(out)])
+            results = json.loads(out.read_text())
+            self.assertEqual(set(results["results"]), {
+                f"small_files-20/{command}/j{jobs}" if command == "clean" else f"small_files-20/{command}/zstd/j{jobs}"
+                for command in ("archive", "verify", "clean") for jobs in (1, 2)})
+            result = results["results"]["small_files-20/archive/zstd/j1"]
+            self.assertEqual(len(result["walls"]), 2)
+            self.assertEqual(result["counters"]["files"], 20)
+            self.assertIn("ratio", result)
+            self.assertEqual(results["results"]["small_files-20/clean/j2"]["counters"]["files"], bench.CLEAN_FILES - bench.CLEAN_KEEP)
+
+            # compare with the baseline
+            with self.assertLogs("benchmarks.bench"):
+                bench.main(argv + ["--out", str(pathlib.Path(tmpdir) / "now.json"), "--baseline", str(out), "--threshold", "10"])
+            baseline = json.loads(out.read_text())
+            case = baseline["results"]["small_files-20/archive/zstd/j1"]
+            case["wall"] /= 10
+            with self.assertLogs("benchmarks.bench") as logs:
+                self.assertEqual(bench.compare(results, baseline, 0.2, 0.0), ["small_files-20/archive/zstd/j1"])
+            self.assertTrue(any("REGRESSION" in line for line in logs.output))
+            self.assertEqual(bench.compare(results, baseline, 0.2, 60.0), [])
+
+    @unittest.skipIf(platform.system() == "Windows", "stand-in commands are shell scripts")
+    def test_wsl_bridge(self):
+        with tempfile.TemporaryDirectory() as tmpdir, test.support.os_helper.EnvironmentVarGuard() as env:
+            tmp = pathlib.Path(tmpdir)
+            bindir = tmp / "bin"
+            bindir.mkdir()
+            calls = tmp / "calls"
+            # stand-in wslpath: /home => \\wsl.localhost, others => Z:
+            (bindir / "wslpath").write_text(f"""#!{sys.executable}
+import sys
+with open({str(calls)!r}, "a") as f:
+    print("wslpath", *sys.argv[1:], file=f)
+p = sys.argv[2]
+if p.startswith("/home/"):
+    print("\\\\\\\\wsl.localhost\\\\Ubuntu" + p.replace("/", "\\\\"))
+elif p.startswith("/"):
+    print("Z:" + p.replace("/", "\\\\"))
+else:
+    print("/unc/" + "/".join(x for x in p.split("\\\\") if x))
+""")
+            (bindir / "powershell.exe").write_text(f"""#!{sys.executable}
+import sys
+with open({str(calls)!r}, "a") as f:
+    print("powershell", *sys.argv[1:], file=f)
+print('{{"UserName":"alice","ProgramFiles":"C:\\\\\\\\Program Files"}}')
+""")
+            for p in bindir.iterdir():
+                p.chmod(0o755)
+            conf = tmp / "wsl.conf"
+            conf.write_text('[automount]\nroot = "/win"\n')
+            env["PATH"] = f"{bindir}{os.pathsep}{env['PATH']}"
+            env["XDG_CACHE_HOME"] = str(tmp / "cache")
+            env["WSL_DISTRO_NAME"] = "Ubuntu"
+
+            def bridge() -> util.WslBridge:
+                wsl = util.WslBridge()
+                wsl.WSL_CONF = str(conf)
+                return wsl
+
+            def call_count() -> int:
+                return len(calls.read_text().splitlines()) if calls.exists() else 0
+
+            paths = ["/win/c/Users/a/", "/srv/x", "/home/u", "/srv/x", "/win/q/data"]
+            expected = [
+                pathlib.PureWindowsPath("C:/Users/a"), pathlib.PureWindowsPath("Z:/srv/x"), None,
+                pathlib.PureWindowsPath("Z:/srv/x"), pathlib.PureWindowsPath("Z:/win/q/data")]
+            # /win/c is a drive mount, /win/q is not
+            with (unittest.mock.patch.object(util, "_is_wsl", True),
+                    unittest.mock.patch.object(util.WslBridge, "_is_mount", lambda self, drive: drive == "c")):
+                wsl = bridge()
+                self.assertEqual(wsl.to_winpaths(paths), expected)
+                # one wslpath per unique non-drive path, no call for /win/c
+                self.assertEqual(call_count(), 3)
+                self.assertEqual(wsl.to_winpaths(paths), expected)
+                self.assertEqual(call_count(), 3)
+                self.assertEqual(wsl.to_wslpaths(["D:\\data\\x", "\\\\server\\share"]), [
+                    pathlib.Path("/win/d/data/x"), pathlib.Path("/unc/server/share")])
+                self.assertEqual(call_count(), 4)
+
+                # one powershell call for all variables
+                self.assertEqual(wsl.winenvs(["UserName", "ProgramFiles"]), {"UserName": "alice", "ProgramFiles": "C:\\Program Files"})
+                self.assertEqual(wsl.winenvs(["UserName"]), {"UserName": "alice"})
+                self.assertEqual(call_count(), 5)
+
+                # disk cache
+                wsl = bridge()
+                self.assertEqual(wsl.to_winpaths(paths), expected)
+                self.assertEqual(wsl.winenvs(["UserName"]), {"UserName": "alice"})
+                self.assertEqual(call_count(), 5)
+
+                # invalidated by wsl.conf change
+                conf.write_text('[automount]\nroot = /win/\n')
+                os.utime(conf, ns=(0, 0))
+                wsl = bridge()
+                self.assertEqual(wsl.to_winpaths(paths), expected)
+                self.assertEqual(call_count(), 8)
+
 
 if __name__ == '__main__':
     unittest.main()